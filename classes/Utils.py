@@ -488,6 +488,23 @@ def process_stnlist(cnn, stnlist_in, print_summary=True, summary_title=None):
     return stnlist
 
 
+def station_filter(stnlist, alias=None):
+    """
+    Build a set-based WHERE condition to select the records of a list of stations in a single query
+    :param stnlist: list of station dictionaries (NetworkCode, StationCode)
+    :param alias: table alias to prefix the NetworkCode and StationCode fields (optional)
+    :return: string with the condition (FALSE if the list is empty)
+    """
+    if not stnlist:
+        return 'FALSE'
+
+    prefix = alias + '.' if alias else ''
+
+    return '(%s"NetworkCode", %s"StationCode") IN (%s)' % \
+           (prefix, prefix, ', '.join(['(\'%s\', \'%s\')' % (stn['NetworkCode'], stn['StationCode'])
+                                       for stn in stnlist]))
+
+
 def get_norm_year_str(year):
     
     # mk 4 digit year
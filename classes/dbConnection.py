@@ -15,6 +15,10 @@ import inspect
 import re
 from datetime import datetime
 from decimal import Decimal
+from itertools import groupby
+
+# number of rows written by each transaction of bulk_insert
+BULK_BATCH_SIZE = 100000
 
 
 class dbErrInsert(Exception):
@@ -37,6 +41,24 @@ class IntegrityError(pg.IntegrityError):
     pass
 
 
+def copy_value(value):
+    """
+    format a value for the text format of COPY
+    """
+    if value is None:
+        return '\\N'
+    elif isinstance(value, bool):
+        return 't' if value else 'f'
+    elif isinstance(value, float):
+        return repr(value)
+    elif isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
 class Cnn(pg.DB):
 
     def __init__(self, configfile, use_float=False):
@@ -191,6 +213,63 @@ class Cnn(pg.DB):
             self.rollback_transac()
             raise
 
+    def bulk_insert(self, table, rows, columns=None, keys=None, upsert=True, batch_size=BULK_BATCH_SIZE):
+        """
+        Insert a large number of rows using COPY. Each batch is copied to a temporary table and then moved to the
+        destination table in a single transaction
+        :param table: destination table
+        :param rows: list of tuples (ordered as columns) or, if columns is None, list of dictionaries. Columns of the
+                     dictionaries that do not exist in the table are ignored
+        :param columns: list of columns of the tuples in rows
+        :param keys: columns that identify a row. If None, rows are appended
+        :param upsert: if True, rows that already exist (same keys) are replaced. Otherwise, they are left untouched
+                       and the new row is discarded
+        :param batch_size: number of rows per transaction
+        :return: number of rows processed
+        """
+        if columns is None:
+            # rows are dictionaries: group the rows that have the same set of columns
+            fields = self.get_columns(table).keys()
+
+            def row_columns(row):
+                return tuple(sorted(c for c in row.keys() if c in fields))
+
+            count = 0
+            for cols, group in groupby(sorted(rows, key=row_columns), key=row_columns):
+                count += self.bulk_insert(table, [tuple(row[c] for c in cols) for row in group], list(cols), keys,
+                                          upsert, batch_size)
+            return count
+
+        fields = ', '.join('"%s"' % c for c in columns)
+
+        if keys is None:
+            move = 'INSERT INTO %s (%s) SELECT %s FROM bulk_insert' % (table, fields, fields)
+        else:
+            match = ' AND '.join('t."%s" = s."%s"' % (k, k) for k in keys)
+
+            if upsert:
+                move = 'DELETE FROM %s t USING bulk_insert s WHERE %s; ' \
+                       'INSERT INTO %s (%s) SELECT %s FROM bulk_insert' % (table, match, table, fields, fields)
+            else:
+                move = 'INSERT INTO %s (%s) SELECT %s FROM bulk_insert s WHERE NOT EXISTS ' \
+                       '(SELECT 1 FROM %s t WHERE %s)' % (table, fields, fields, table, match)
+
+        for i in range(0, len(rows), batch_size):
+            try:
+                self.cursor.execute('CREATE TEMPORARY TABLE bulk_insert ON COMMIT DROP AS '
+                                    'SELECT %s FROM %s WITH NO DATA' % (fields, table))
+
+                self.cursor.copy_from(('\t'.join(copy_value(v) for v in row) + '\n'
+                                       for row in rows[i:i + batch_size]), 'bulk_insert', columns=columns)
+
+                self.cursor.execute(move)
+                self.cursor_conn.commit()
+            except pg.Error:
+                self.cursor_conn.rollback()
+                raise
+
+        return len(rows)
+
     def update(self, table, row=None, **kw):
         err = None
         for i in range(3):
@@ -9,6 +9,7 @@ Class that handles all the date conversions betweem different systems and format
 """
 
 import math
+import numpy as np
 from datetime import datetime
 from json import JSONEncoder
 
@@ -201,6 +202,123 @@ def mjd2date(mjd):
     return int(year),int(month),int(day)
 
 
+def yeardoy2fyear_array(year, doy, hour=12, minute=0, second=0):
+    """
+    vectorized version of yeardoy2fyear
+    """
+    year = np.asarray(year).astype(int)
+    doy = np.asarray(doy).astype(int)
+
+    # default number of days in a year (check for leap years)
+    diy = np.where(year % 4 == 0, 366., 365.)
+
+    if np.any(doy < 1) or np.any(doy > diy):
+        raise pyDateException('invalid day of year')
+
+    return year + ((doy - 1) + np.asarray(hour).astype(int) / 24. + np.asarray(minute) / 1440. +
+                   np.asarray(second) / 86400.) / diy
+
+
+def fyear2yeardoy_array(fyear):
+    """
+    vectorized version of fyear2yeardoy
+    """
+    fyear = np.asarray(fyear, dtype=float)
+
+    year = np.floor(fyear)
+    fractionOfyear = fyear - year
+
+    days = np.where(year % 4 == 0, 366, 365)
+
+    doy = np.floor(days*fractionOfyear) + 1
+    hh = (days*fractionOfyear - np.floor(days*fractionOfyear))*24.
+    hour = np.floor(hh)
+    mm = (hh - np.floor(hh))*60.
+    minute = np.floor(mm)
+    ss = (mm - np.floor(mm))*60.
+    second = np.floor(ss)
+
+    return year.astype(int), doy.astype(int), hour.astype(int), minute.astype(int), second.astype(int)
+
+
+# first day of each month (non leap and leap years), with a 13th element to compute the days of year of December
+_fday = np.array([[0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334, 365],
+                  [0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335, 366]])
+
+
+def date2doy_array(year, month, day):
+    """
+    vectorized version of date2doy (without the fractional year)
+    """
+    year = np.asarray(year).astype(int)
+    month = np.asarray(month).astype(int)
+    day = np.asarray(day).astype(int)
+
+    return _fday[(year % 4 == 0).astype(int), month - 1] + day
+
+
+def doy2date_array(year, doy):
+    """
+    vectorized version of doy2date
+    """
+    year = np.asarray(year).astype(int)
+    doy = np.asarray(doy).astype(int)
+
+    leap = (year % 4 == 0).astype(int)
+
+    if np.any(doy < 1) or np.any(doy > 365 + leap):
+        raise pyDateException('day of year input is invalid')
+
+    # number of months whose last day of year is before doy
+    month = np.sum(doy[..., np.newaxis] > _fday[leap, 1:], axis=-1) + 1
+    day = doy - _fday[leap, month - 1]
+
+    return month, day
+
+
+def date2mjd_array(year, month, day):
+    """
+    vectorized version of date2gpsDate + gpsDate2mjd
+    :return: gpsWeek, gpsWeekDay, mjd
+    """
+    year = np.asarray(year).astype(int)
+    month = np.asarray(month).astype(int)
+    day = np.asarray(day).astype(int)
+
+    year = np.where(month <= 2, year - 1, year)
+    month = np.where(month <= 2, month + 12, month)
+
+    julianDay = np.floor(365.25 * year) + np.floor(30.6001 * (month + 1.)) + day + 1720981.5
+
+    gpsWeek = np.floor((julianDay - 2444244.5)/7.).astype(int)
+    gpsWeekDay = ((julianDay - 2444244.5) % 7).astype(int)
+
+    return gpsWeek, gpsWeekDay, gpsWeek * 7 + 44244 + gpsWeekDay
+
+
+def mjd2date_array(mjd):
+    """
+    vectorized version of mjd2date
+    """
+    jd = np.asarray(mjd, dtype=float) + 2400000.5
+
+    ijd = np.floor(jd + 0.5)
+
+    a = ijd + 32044.
+    b = np.floor((4. * a + 3.) / 146097.)
+    c = a - np.floor((b * 146097.) / 4.)
+
+    d = np.floor((4. * c + 3.) / 1461.)
+    e = c - np.floor((1461. * d) / 4.)
+    m = np.floor((5. * e + 2.) / 153.)
+
+    day   = e - np.floor((153. * m + 2.) / 5.) + 1.
+    month = m + 3. - 12. * np.floor(m / 10.)
+    year  = b * 100. + d - 4800. + np.floor(m / 10.)
+
+    return year.astype(int), month.astype(int), day.astype(int)
+
+
 def parse_stninfo(stninfo_datetime):
 
     sdate = stninfo_datetime.split()
@@ -216,22 +334,96 @@ def parse_stninfo(stninfo_datetime):
         return int(sdate[0]), int(sdate[1]), int(sdate[2]), int(sdate[3]), int(sdate[4])
 
 
+# maximum number of entries kept by the memoization caches of the Date class
+DATE_CACHE_SIZE = 200000
+
+# calendar fields (month, day, gpsWeek, gpsWeekDay, mjd) of the year, doy pairs already computed
+_yeardoy_cache = {}
+# calendar fields (year, month, day, doy, gpsWeek, gpsWeekDay) of the mjds already computed
+_mjd_cache = {}
+
+
+def _memoize(cache, key, value):
+
+    if len(cache) >= DATE_CACHE_SIZE:
+        cache.clear()
+
+    cache[key] = value
+
+    return value
+
+
+def _yeardoy_fields(year, doy):
+
+    key = (int(year), int(doy))
+
+    try:
+        return _yeardoy_cache[key]
+    except KeyError:
+        month, day = doy2date(year, doy)
+        gpsWeek, gpsWeekDay = date2gpsDate(year, month, day)
+
+        return _memoize(_yeardoy_cache, key, (month, day, gpsWeek, gpsWeekDay, gpsDate2mjd(gpsWeek, gpsWeekDay)))
+
+
+def _mjd_fields(mjd):
+
+    try:
+        return _mjd_cache[mjd]
+    except KeyError:
+        year, month, day = mjd2date(mjd)
+        doy, _ = date2doy(year, month, day)
+        gpsWeek, gpsWeekDay = date2gpsDate(year, month, day)
+
+        return _memoize(_mjd_cache, mjd, (year, month, day, doy, gpsWeek, gpsWeekDay))
+
+
+def _lazy(name):
+    # property that computes the derived fields of the Date object on first access
+    attr = '_' + name
+
+    def getter(self):
+        value = getattr(self, attr)
+
+        if value is None and not self._resolved:
+            self._resolve()
+            value = getattr(self, attr)
+
+        return value
+
+    return property(getter)
+
+
 class Date(object):
+    """
+    Only the input args are stored when the object is created, the rest of the fields are computed (and cached) the
+    first time one of them is accessed. The calendar fields of repeated dates are memoized.
+    """
+    __slots__ = ('_mjd', '_fyear', '_year', '_doy', '_day', '_month', '_gpsWeek', '_gpsWeekDay', '_resolved',
+                 'hour', 'minute', 'second', 'from_stninfo')
+
+    mjd        = _lazy('mjd')
+    year       = _lazy('year')
+    doy        = _lazy('doy')
+    day        = _lazy('day')
+    month      = _lazy('month')
+    gpsWeek    = _lazy('gpsWeek')
+    gpsWeekDay = _lazy('gpsWeekDay')
 
     def __init__(self, **kwargs):
 
         # init
-        self.mjd        = None
-        self.fyear      = None
-        self.year       = None
-        self.doy        = None
-        self.day        = None
-        self.month      = None
-        self.gpsWeek    = None
-        self.gpsWeekDay = None
-        self.hour       = 12 # DDG 03-28-2017: include hour and minute to work with station info object
-        self.minute     = 0
-        self.second     = 0
+        self._mjd        = None
+        self._fyear      = None
+        self._year       = None
+        self._doy        = None
+        self._day        = None
+        self._month      = None
+        self._gpsWeek    = None
+        self._gpsWeekDay = None
+        self.hour        = 12 # DDG 03-28-2017: include hour and minute to work with station info object
+        self.minute      = 0
+        self.second      = 0
 
         self.from_stninfo = False
 
@@ -245,25 +437,25 @@ class Date(object):
                 if int(arg) < 1900:
                     # the date is in 2 digit format
                     if int(arg) > 80:
-                        self.year = int(arg) + 1900
+                        self._year = int(arg) + 1900
                     else:
-                        self.year = int(arg) + 2000
+                        self._year = int(arg) + 2000
                 else:
-                    self.year = arg
+                    self._year = arg
             elif key == 'doy':
-                self.doy = arg
+                self._doy = arg
             elif key == 'day':
-                self.day = arg
+                self._day = arg
             elif key == 'month':
-                self.month = arg
+                self._month = arg
             elif key == 'gpsweek':
-                self.gpsWeek = arg
+                self._gpsWeek = arg
             elif key == 'gpsweekday':
-                self.gpsWeekDay = arg
+                self._gpsWeekDay = arg
             elif key in ('fyear','fractionalyear','fracyear'):
-                self.fyear = arg
+                self._fyear = arg
             elif key == 'mjd':
-                self.mjd = arg
+                self._mjd = arg
             elif key == 'hour':  # DDG 03-28-2017: include hour to work with station info object
                 self.hour = arg
             elif key == 'minute':  # DDG 03-28-2017: include minute to work with station info object
@@ -272,9 +464,9 @@ class Date(object):
                 self.second = arg
             elif key == 'datetime':  # DDG 03-28-2017: handle conversion from datetime to pyDate
                 if isinstance(arg, datetime):
-                    self.day = arg.day
-                    self.month = arg.month
-                    self.year = arg.year
+                    self._day = arg.day
+                    self._month = arg.month
+                    self._year = arg.year
                     self.hour = arg.hour
                     self.minute = arg.minute
                     self.second = arg.second
@@ -285,11 +477,11 @@ class Date(object):
                 self.from_stninfo = True
 
                 if isinstance(arg, str) or isinstance(arg, unicode):
-                    self.year, self.doy, self.hour, self.minute, self.second = parse_stninfo(arg)
+                    self._year, self._doy, self.hour, self.minute, self.second = parse_stninfo(arg)
                 elif isinstance(arg, datetime):
-                    self.day = arg.day
-                    self.month = arg.month
-                    self.year = arg.year
+                    self._day = arg.day
+                    self._month = arg.month
+                    self._year = arg.year
                     self.hour = arg.hour
                     self.minute = arg.minute
                     self.second = arg.second
@@ -301,72 +493,82 @@ class Date(object):
             else:
                 raise pyDateException('unrecognized input arg: '+key+'\n')
 
-        # make due with what we gots
-        if self.year is not None and self.doy is not None:
+        # make due with what we gots (the input args that can raise exceptions are validated here)
+        if self._year is not None and self._doy is not None:
 
-            # compute the month and day of month
-            self.month, self.day = doy2date(self.year, self.doy)
+            if int(self._doy) < 1 or int(self._doy) > (366 if int(self._year) % 4 == 0 else 365):
+                raise pyDateException('day of year input is invalid')
 
-            # compute the fractional year
-            self.fyear = yeardoy2fyear(self.year, self.doy,self.hour, self.minute, self.second)
+        elif self._gpsWeek is not None and self._gpsWeekDay is not None:
+            pass
 
-            # compute the gps date
-            self.gpsWeek, self.gpsWeekDay = date2gpsDate(self.year, self.month, self.day)
+        elif self._year is not None and self._month is not None and self._day:
 
-            self.mjd = gpsDate2mjd(self.gpsWeek,self.gpsWeekDay)
+            # initialize day of year and fractional year from date
+            self._doy, self._fyear = date2doy(self._year, self._month, self._day, self.hour, self.minute, self.second)
 
-        elif self.gpsWeek is not None and self.gpsWeekDay is not None:
+        elif self._fyear is not None:
 
-            # initialize modified julian day from gps date
-            self.mjd = gpsDate2mjd(self.gpsWeek, self.gpsWeekDay)
+            # initialize year and day of year
+            self._year, self._doy, self.hour, self.minute, self.second = fyear2yeardoy(self._fyear)
 
-            # compute year, month, and day of month from modified julian day
-            self.year, self.month,self.day = mjd2date(self.mjd)
+        elif self._mjd is None:
+            if not self.from_stninfo:
+                # if empty Date object from a station info, it means that it should be printed as 9999 999 00 00 00
+                raise pyDateException('not enough independent input args to compute full date')
 
-            # compute day of year from month and day of month
-            self.doy, self.fyear = date2doy(self.year, self.month, self.day, self.hour, self.minute, self.second)
+            # nothing to compute
+            self._resolved = True
+            return
 
-        elif self.year is not None and self.month is not None and self.day:
+        self._resolved = False
 
-            # initialize day of year and fractional year from date
-            self.doy, self.fyear = date2doy(self.year, self.month, self.day, self.hour, self.minute, self.second)
+    @property
+    def fyear(self):
 
-            # compute the gps date
-            self.gpsWeek, self.gpsWeekDay = date2gpsDate(self.year, self.month, self.day)
+        if self._fyear is None:
+            if not self._resolved:
+                self._resolve()
 
-            # init the modified julian date
-            self.mjd = gpsDate2mjd(self.gpsWeek, self.gpsWeekDay)
+            # the fractional year is computed separately (it is not needed to obtain the rest of the fields)
+            if self._year is not None:
+                self._fyear = yeardoy2fyear(self._year, self._doy, self.hour, self.minute, self.second)
 
-        elif self.fyear is not None:
+        return self._fyear
 
-            # initialize year and day of year
-            self.year, self.doy, self.hour, self.minute, self.second = fyear2yeardoy(self.fyear)
+    def _resolve(self):
+        """
+        compute the fields that were not given as input args (except for the fractional year)
+        """
+        self._resolved = True
 
-            # set the month and day of month
-            # compute the month and day of month
-            self.month, self.day = doy2date(self.year, self.doy)
+        if self._year is not None and self._doy is not None:
 
-            # compute the gps date
-            self.gpsWeek, self.gpsWeekDay = date2gpsDate(self.year, self.month, self.day)
+            # compute the month, day of month and gps date
+            month, day, self._gpsWeek, self._gpsWeekDay, self._mjd = _yeardoy_fields(self._year, self._doy)
 
-            # finally, compute modified jumlian day
-            self.mjd = gpsDate2mjd(self.gpsWeek, self.gpsWeekDay)
+            if self._month is None:
+                self._month, self._day = month, day
 
-        elif self.mjd is not None:
+        elif self._gpsWeek is not None and self._gpsWeekDay is not None:
+
+            # initialize modified julian day from gps date
+            self._mjd = gpsDate2mjd(self._gpsWeek, self._gpsWeekDay)
 
             # compute year, month, and day of month from modified julian day
-            self.year, self.month, self.day = mjd2date(self.mjd)
+            self._year, self._month, self._day, self._doy, _, _ = _mjd_fields(self._mjd)
 
-            # compute day of year from month and day of month
-            self.doy, self.fyear = date2doy(self.year, self.month, self.day, self.hour, self.minute, self.second)
+        elif self._mjd is not None:
 
-            # compute the gps date
-            self.gpsWeek, self.gpsWeekDay = date2gpsDate(self.year, self.month, self.day)
+            # compute year, month, and day of month from modified julian day
+            self._year, self._month, self._day, self._doy, self._gpsWeek, self._gpsWeekDay = _mjd_fields(self._mjd)
 
-        else:
-            if not self.from_stninfo:
-                # if empty Date object from a station info, it means that it should be printed as 9999 999 00 00 00
-                raise pyDateException('not enough independent input args to compute full date')
+    def __getstate__(self):
+        return dict((key, getattr(self, key)) for key in self.__slots__)
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
 
     def strftime(self):
         return self.datetime().strftime('%Y-%m-%d %H:%M:%S')
@@ -493,3 +695,135 @@ class Date(object):
             _, fyear = date2doy(self.year, self.month, self.day, 23, 59, 59)
             return fyear
 
+
+
+class DateArray(object):
+    """
+    Vectorized version of the Date class to convert arrays of epochs at once. Accepts the same combinations of input
+    args as Date (year and doy, gpsWeek and gpsWeekDay, year month and day, fyear or mjd) but passed as arrays. All
+    the fields are numpy arrays. Indexing with an integer returns a Date object, indexing with a slice or mask
+    returns a DateArray.
+    """
+    def __init__(self, **kwargs):
+
+        self.mjd        = None
+        self.fyear      = None
+        self.year       = None
+        self.doy        = None
+        self.day        = None
+        self.month      = None
+        self.gpsWeek    = None
+        self.gpsWeekDay = None
+        self.hour       = 12
+        self.minute     = 0
+        self.second     = 0
+
+        for key in kwargs:
+
+            arg = kwargs[key]
+            key = key.lower()
+
+            if key == 'year':
+                arg = np.asarray(arg).astype(int)
+                # dates in 2 digit format
+                self.year = np.where(arg < 1900, np.where(arg > 80, arg + 1900, arg + 2000), arg)
+            elif key == 'doy':
+                self.doy = np.asarray(arg).astype(int)
+            elif key == 'day':
+                self.day = np.asarray(arg).astype(int)
+            elif key == 'month':
+                self.month = np.asarray(arg).astype(int)
+            elif key == 'gpsweek':
+                self.gpsWeek = np.asarray(arg).astype(int)
+            elif key == 'gpsweekday':
+                self.gpsWeekDay = np.asarray(arg).astype(int)
+            elif key in ('fyear', 'fractionalyear', 'fracyear'):
+                self.fyear = np.asarray(arg, dtype=float)
+            elif key == 'mjd':
+                self.mjd = np.asarray(arg)
+            elif key == 'hour':
+                self.hour = arg
+            elif key == 'minute':
+                self.minute = arg
+            elif key == 'second':
+                self.second = arg
+            else:
+                raise pyDateException('unrecognized input arg: '+key+'\n')
+
+        if self.year is not None and self.doy is not None:
+
+            self.month, self.day = doy2date_array(self.year, self.doy)
+
+            self.fyear = yeardoy2fyear_array(self.year, self.doy, self.hour, self.minute, self.second)
+
+            self.gpsWeek, self.gpsWeekDay, self.mjd = date2mjd_array(self.year, self.month, self.day)
+
+        elif self.gpsWeek is not None and self.gpsWeekDay is not None:
+
+            self.mjd = self.gpsWeek * 7 + 44244 + self.gpsWeekDay
+
+            self.year, self.month, self.day = mjd2date_array(self.mjd)
+
+            self.doy = date2doy_array(self.year, self.month, self.day)
+
+            self.fyear = yeardoy2fyear_array(self.year, self.doy, self.hour, self.minute, self.second)
+
+        elif self.year is not None and self.month is not None and self.day is not None:
+
+            self.doy = date2doy_array(self.year, self.month, self.day)
+
+            self.fyear = yeardoy2fyear_array(self.year, self.doy, self.hour, self.minute, self.second)
+
+            self.gpsWeek, self.gpsWeekDay, self.mjd = date2mjd_array(self.year, self.month, self.day)
+
+        elif self.fyear is not None:
+
+            self.year, self.doy, self.hour, self.minute, self.second = fyear2yeardoy_array(self.fyear)
+
+            self.month, self.day = doy2date_array(self.year, self.doy)
+
+            self.gpsWeek, self.gpsWeekDay, self.mjd = date2mjd_array(self.year, self.month, self.day)
+
+        elif self.mjd is not None:
+
+            self.year, self.month, self.day = mjd2date_array(self.mjd)
+
+            self.doy = date2doy_array(self.year, self.month, self.day)
+
+            self.fyear = yeardoy2fyear_array(self.year, self.doy, self.hour, self.minute, self.second)
+
+            self.gpsWeek, self.gpsWeekDay, _ = date2mjd_array(self.year, self.month, self.day)
+
+        else:
+            raise pyDateException('not enough independent input args to compute full date')
+
+    def __len__(self):
+        return self.year.size
+
+    def __getitem__(self, item):
+
+        if isinstance(item, (int, long, np.integer)):
+            return Date(year=int(self.year[item]), doy=int(self.doy[item]),
+                        hour=int(np.asarray(self.hour).take(item) if np.ndim(self.hour) else self.hour),
+                        minute=int(np.asarray(self.minute).take(item) if np.ndim(self.minute) else self.minute),
+                        second=int(np.asarray(self.second).take(item) if np.ndim(self.second) else self.second))
+        else:
+            out = DateArray.__new__(DateArray)
+
+            for key, val in self.__dict__.items():
+                out.__dict__[key] = val[item] if np.ndim(val) else val
+
+            return out
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return 'pyDate.DateArray(' + str(len(self)) + ' dates)'
+
+    def dates(self):
+        """
+        :return: list of Date objects
+        """
+        return list(self)
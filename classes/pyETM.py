@@ -8,10 +8,14 @@ Author: Demian D. Gomez
 import numpy as np
 import pyStationInfo
 import pyDate
+import Utils
 from numpy import sin
 from numpy import cos
 from numpy import pi
 from scipy.stats import chi2
+from scipy.linalg import cho_factor
+from scipy.linalg import cho_solve
+from scipy.spatial import cKDTree
 import pyEvents
 from zlib import crc32
 from Utils import ct2lg
@@ -19,6 +23,8 @@ from Utils import lg2ct
 from Utils import rotlg2ct
 from os.path import getmtime
 from itertools import repeat
+from itertools import groupby
+from bisect import bisect_left
 from pyBunch import Bunch
 from pprint import pprint
 import traceback
@@ -31,6 +37,7 @@ import pg
 import matplotlib
 from io import BytesIO
 import base64
+import json
 import logging
 from logging import INFO, ERROR, WARNING, DEBUG, StreamHandler, Formatter
 
@@ -136,6 +143,9 @@ CO_SEISMIC_DECAY = 20
 EQ_MIN_DAYS = 15
 JP_MIN_DAYS = 5
 
+# magnitude bins of the earthquake spatial index (each bin searched with the radius of its largest event)
+EQ_INDEX_BIN = 0.5
+
 DEFAULT_RELAXATION = np.array([0.5])
 DEFAULT_POL_TERMS = 2
 DEFAULT_FREQUENCIES = np.array((1/365.25, 1/(365.25/2)))  # (1 yr, 6 months) expressed in 1/days (one year = 365.25)
@@ -146,6 +156,13 @@ SIGMA_FLOOR_V = 0.15
 ESTIMATION = 0
 DATABASE = 1
 
+# least squares solvers: SVD of the (tall) design matrix or Cholesky factorization of the normal equations
+LSQ_SVD = 0
+LSQ_NEQ = 1
+
+# maximum number of elements (systems x rows x columns) stacked by adjust_lsq_batch in a single group
+BATCH_MAX_SIZE = 2 ** 22
+
 VERSION = '1.2.1'
 
 
@@ -208,10 +225,13 @@ def to_list(dictionary):
 
 
 class PppSoln(object):
-    """"class to extract the PPP solutions from the database"""
-
-    def __init__(self, cnn, NetworkCode, StationCode):
+    """"class to extract the PPP solutions from the database (or the time series store, if given)"""
 
+    def __init__(self, cnn, NetworkCode, StationCode, store=None, data=None):
+        """
+        :param data: dictionary with the records of this station already fetched by load_ppp_soln (station, excluded,
+                     table, hash and rnx_no_ppp). Items that are not present are queried from the database
+        """
         self.NetworkCode = NetworkCode
         self.StationCode = StationCode
         self.hash = 0
@@ -219,11 +239,17 @@ class PppSoln(object):
         self.type = 'ppp'
         self.stack_name = 'ppp'
 
+        if data is None:
+            data = dict()
+
         # get the station from the stations table
-        stn = cnn.query('SELECT * FROM stations WHERE "NetworkCode" = \'%s\' AND "StationCode" = \'%s\''
-                        % (NetworkCode, StationCode))
+        if 'station' in data:
+            stn = data['station']
+        else:
+            stn = cnn.query('SELECT * FROM stations WHERE "NetworkCode" = \'%s\' AND "StationCode" = \'%s\''
+                            % (NetworkCode, StationCode))
 
-        stn = stn.dictresult()[0]
+            stn = stn.dictresult()[0]
 
         if stn['lat'] is not None:
             self.lat = np.array([float(stn['lat'])])
@@ -246,87 +272,324 @@ class PppSoln(object):
             # exclude ppp solutions in the exclude table and any solution that is more than 20 meters from the simple
             # linear trend calculated above
 
-            self.excluded = cnn.query_float('SELECT "Year", "DOY" FROM ppp_soln_excl '
-                                            'WHERE "NetworkCode" = \'%s\' AND "StationCode" = \'%s\''
-                                            % (NetworkCode, StationCode))
+            if 'excluded' in data:
+                self.excluded = data['excluded']
+            else:
+                self.excluded = cnn.query_float('SELECT "Year", "DOY" FROM ppp_soln_excl '
+                                                'WHERE "NetworkCode" = \'%s\' AND "StationCode" = \'%s\''
+                                                % (NetworkCode, StationCode))
+
+            if 'table' in data:
+                # columns [X, Y, Z, Year, DOY] fetched by load_ppp_soln
+                table = data['table']
+                ppp_hash = [[data['hash']]]
+            elif store is not None and store.has_station(NetworkCode, StationCode):
+                # columns [X, Y, Z, Year, DOY] from the time series store (read only views, no copies)
+                ts = store.get_station(NetworkCode, StationCode)
+                table = [ts['x'], ts['y'], ts['z'], ts['year'], ts['doy']]
+                ppp_hash = [[int(np.sum(ts['hash']))]]
+            else:
+                table = np.array(cnn.query_float(
+                    'SELECT "X", "Y", "Z", "Year", "DOY" FROM ppp_soln p1 '
+                    'WHERE p1."NetworkCode" = \'%s\' AND p1."StationCode" = \'%s\' ORDER BY "Year", "DOY"'
+                    % (NetworkCode, StationCode)), dtype=float).reshape((-1, 5)).transpose()
+                ppp_hash = None
 
-            self.table = cnn.query_float(
-                'SELECT "X", "Y", "Z", "Year", "DOY" FROM ppp_soln p1 '
-                'WHERE p1."NetworkCode" = \'%s\' AND p1."StationCode" = \'%s\' ORDER BY "Year", "DOY"'
-                % (NetworkCode, StationCode))
+            dist = np.sqrt(np.square(table[0] - x) + np.square(table[1] - y) + np.square(table[2] - z))
+            excluded = np.in1d(table[3] * 1000 + table[4], [item[0] * 1000 + item[1] for item in self.excluded])
 
-            self.table = [item for item in self.table
-                          if np.sqrt(np.square(item[0] - x) + np.square(item[1] - y) + np.square(item[2] - z)) <=
-                          self.max_dist and item[3:] not in self.excluded]
+            valid = np.logical_and(dist <= self.max_dist, np.logical_not(excluded))
+            blunders = np.logical_and(dist > self.max_dist, np.logical_not(excluded))
 
-            self.blunders = [item for item in self.table
-                             if np.sqrt(np.square(item[0] - x) + np.square(item[1] - y) + np.square(item[2] - z)) >
-                             self.max_dist and item[3:] not in self.excluded]
+            self.blunders = np.array([column[blunders] for column in table]).transpose().tolist()
 
-            self.solutions = len(self.table)
+            if not np.all(valid):
+                table = [column[valid] for column in table]
 
-            self.ts_blu = np.array([pyDate.Date(year=item[3], doy=item[4]).fyear for item in self.blunders])
+            self.table = table
 
-            if self.solutions >= 1:
-                a = np.array(self.table)
+            self.solutions = self.table[0].size
 
-                self.x = a[:, 0]
-                self.y = a[:, 1]
-                self.z = a[:, 2]
-                self.t = np.array([pyDate.Date(year=item[0], doy=item[1]).fyear for item in a[:, 3:5]])
-                self.mjd = np.array([pyDate.Date(year=item[0], doy=item[1]).mjd for item in a[:, 3:5]])
+            if self.blunders:
+                self.ts_blu = pyDate.DateArray(year=[item[3] for item in self.blunders],
+                                               doy=[item[4] for item in self.blunders]).fyear
+            else:
+                self.ts_blu = np.array([])
+
+            if self.solutions >= 1:
+                self.x = self.table[0]
+                self.y = self.table[1]
+                self.z = self.table[2]
 
-                self.date = [pyDate.Date(year=item[0], doy=item[1]) for item in a[:, 3:5]]
+                self.date = pyDate.DateArray(year=self.table[3], doy=self.table[4])
+                self.t = self.date.fyear
+                self.mjd = self.date.mjd
 
                 # continuous time vector for plots
                 ts = np.arange(np.min(self.mjd), np.max(self.mjd) + 1, 1)
                 self.mjds = ts
-                self.ts = np.array([pyDate.Date(mjd=tts).fyear for tts in ts])
+                self.ts = pyDate.DateArray(mjd=ts).fyear
             else:
                 if len(self.blunders) >= 1:
                     raise pyETMException('No viable PPP solutions available for %s.%s (all blunders!)\n'
                                          '  -> min distance to station coordinate is %.1f meters'
-                                         % (NetworkCode, StationCode, np.array([item[5]
-                                                                                for item in self.blunders]).min()))
+                                         % (NetworkCode, StationCode, dist[blunders].min()))
                 else:
                     raise pyETMException('No PPP solutions available for %s.%s' % (NetworkCode, StationCode))
 
             # get a list of the epochs with files but no solutions.
             # This will be shown in the outliers plot as a special marker
 
-            rnx = cnn.query(
-                'SELECT r."ObservationFYear" FROM rinex_proc as r '
-                'LEFT JOIN ppp_soln as p ON '
-                'r."NetworkCode" = p."NetworkCode" AND '
-                'r."StationCode" = p."StationCode" AND '
-                'r."ObservationYear" = p."Year"    AND '
-                'r."ObservationDOY"  = p."DOY"'
-                'WHERE r."NetworkCode" = \'%s\' AND r."StationCode" = \'%s\' AND '
-                'p."NetworkCode" IS NULL' % (NetworkCode, StationCode))
-
-            self.rnx_no_ppp = rnx.getresult()
+            if 'rnx_no_ppp' in data:
+                self.rnx_no_ppp = data['rnx_no_ppp']
+            else:
+                rnx = cnn.query(
+                    'SELECT r."ObservationFYear" FROM rinex_proc as r '
+                    'LEFT JOIN ppp_soln as p ON '
+                    'r."NetworkCode" = p."NetworkCode" AND '
+                    'r."StationCode" = p."StationCode" AND '
+                    'r."ObservationYear" = p."Year"    AND '
+                    'r."ObservationDOY"  = p."DOY"'
+                    'WHERE r."NetworkCode" = \'%s\' AND r."StationCode" = \'%s\' AND '
+                    'p."NetworkCode" IS NULL' % (NetworkCode, StationCode))
+
+                self.rnx_no_ppp = rnx.getresult()
 
             self.ts_ns = np.array([item for item in self.rnx_no_ppp])
 
             self.completion = 100. - float(len(self.ts_ns)) / float(len(self.ts_ns) + len(self.t)) * 100.
 
-            ppp_hash = cnn.query_float('SELECT sum(hash) FROM ppp_soln p1 '
-                                       'WHERE p1."NetworkCode" = \'%s\' AND p1."StationCode" = \'%s\''
-                                       % (NetworkCode, StationCode))
+            if ppp_hash is None:
+                ppp_hash = cnn.query_float('SELECT sum(hash) FROM ppp_soln p1 '
+                                           'WHERE p1."NetworkCode" = \'%s\' AND p1."StationCode" = \'%s\''
+                                           % (NetworkCode, StationCode))
 
-            self.hash = crc32(str(len(self.t) + len(self.blunders)) + ' ' + str(self.auto_x) + str(self.auto_y) +
-                              str(self.auto_z) + str(ts[0]) + ' ' + str(ts[-1]) + ' ' + str(ppp_hash[0][0]) + VERSION)
+            self.hash = ppp_soln_hash(len(self.t) + len(self.blunders), self.auto_x, self.auto_y, self.auto_z,
+                                      ts[0], ts[-1], ppp_hash[0][0])
 
         else:
             raise pyETMException('Station %s.%s has no valid metadata in the stations table.'
                                  % (NetworkCode, StationCode))
 
 
+def load_ppp_soln(cnn, stations, store=None):
+    """
+    Bulk load the PPP solutions of a list of stations using one set-based query per table (stations, ppp_soln_excl,
+    ppp_soln and rinex_proc) instead of five queries per station
+    :param cnn: connection to the database
+    :param stations: list of station dictionaries (NetworkCode, StationCode)
+    :param store: time series store with the PPP solutions (optional). Stations in the store are not queried
+    :return: dictionary of PppSoln objects (key net.stn). Stations that could not be loaded are not included
+    """
+    data = dict()
+    for stn in stations:
+        data[stn['NetworkCode'] + '.' + stn['StationCode']] = {'excluded': [], 'rnx_no_ppp': []}
+
+    where = Utils.station_filter(stations)
+
+    for stn in cnn.query('SELECT * FROM stations WHERE %s' % where).dictresult():
+        data[stn['NetworkCode'] + '.' + stn['StationCode']]['station'] = stn
+
+    for r in cnn.query_float('SELECT "NetworkCode", "StationCode", "Year", "DOY" FROM ppp_soln_excl WHERE %s'
+                             % where):
+        data[r[0] + '.' + r[1]]['excluded'].append((r[2], r[3]))
+
+    # stations that are not in the time series store
+    if store is not None:
+        query = [stn for stn in stations if not store.has_station(stn['NetworkCode'], stn['StationCode'])]
+    else:
+        query = stations
+
+    if query:
+        rs = cnn.query_float('SELECT "NetworkCode", "StationCode", "X", "Y", "Z", "Year", "DOY", "hash" '
+                             'FROM ppp_soln WHERE %s ORDER BY "NetworkCode", "StationCode", "Year", "DOY"'
+                             % Utils.station_filter(query))
+
+        for key, rows in groupby(rs, key=lambda r: r[0] + '.' + r[1]):
+            rows = list(rows)
+            data[key]['table'] = np.array([r[2:7] for r in rows], dtype=float).transpose()
+            data[key]['hash'] = sum([r[7] for r in rows])
+
+        for stn in query:
+            key = stn['NetworkCode'] + '.' + stn['StationCode']
+            if 'table' not in data[key]:
+                data[key]['table'] = np.zeros((5, 0))
+                data[key]['hash'] = None
+
+    rnx = cnn.query('SELECT r."NetworkCode", r."StationCode", r."ObservationFYear" FROM rinex_proc as r '
+                    'LEFT JOIN ppp_soln as p ON '
+                    'r."NetworkCode" = p."NetworkCode" AND '
+                    'r."StationCode" = p."StationCode" AND '
+                    'r."ObservationYear" = p."Year"    AND '
+                    'r."ObservationDOY"  = p."DOY"'
+                    'WHERE %s AND p."NetworkCode" IS NULL' % Utils.station_filter(stations, 'r'))
+
+    for r in rnx.getresult():
+        data[r[0] + '.' + r[1]]['rnx_no_ppp'].append((r[2],))
+
+    solutions = dict()
+
+    for key, stn_data in data.items():
+        if 'station' in stn_data:
+            try:
+                solutions[key] = PppSoln(cnn, key.split('.')[0], key.split('.')[1], store, stn_data)
+            except pyETMException:
+                # leave it out: PPPETM will reproduce the error when the station is requested
+                pass
+
+    return solutions
+
+
+def ppp_soln_hash(solutions, auto_x, auto_y, auto_z, first, last, hash_sum):
+    """
+    Hash value of the PPP time series of a station (see PppSoln)
+    :param solutions: number of solutions (including blunders)
+    :param auto_x: station coordinate from the stations table (1 element array, same for auto_y and auto_z)
+    :param first: mjd of the first solution
+    :param last: mjd of the last solution
+    :param hash_sum: sum of the hash values of the ppp_soln records
+    """
+    return crc32(str(solutions) + ' ' + str(auto_x) + str(auto_y) + str(auto_z) + str(first) + ' ' + str(last) +
+                 ' ' + str(hash_sum) + VERSION)
+
+
+def ppp_digest(cnn, NetworkCode, StationCode, last):
+    """
+    Digest of the PPP solutions of a station up to a given epoch (coordinates, hash and excluded flag of each record)
+    computed by the database, plus the reference frames of these solutions. Used by update_ppp_etm to verify that the
+    epochs in the saved normal equations did not change without reading them
+    :param last: last epoch (Year * 1000 + DOY)
+    :return: md5 digest and list of reference frames
+    """
+    rs = cnn.query_float('SELECT md5(string_agg(concat_ws(\',\', p."X", p."Y", p."Z", p."Year", p."DOY", p."hash", '
+                         'e."Year"), \';\' ORDER BY p."Year", p."DOY")) as digest, '
+                         'string_agg(DISTINCT p."ReferenceFrame", \',\') as frames '
+                         'FROM ppp_soln p LEFT JOIN ppp_soln_excl e ON '
+                         'p."NetworkCode" = e."NetworkCode" AND p."StationCode" = e."StationCode" AND '
+                         'p."Year" = e."Year" AND p."DOY" = e."DOY" '
+                         'WHERE p."NetworkCode" = \'%s\' AND p."StationCode" = \'%s\' AND '
+                         'p."Year" * 1000 + p."DOY" <= %i' % (NetworkCode, StationCode, last), as_dict=True)[0]
+
+    return rs['digest'], sorted(rs['frames'].split(',')) if rs['frames'] else []
+
+
+def etm_stamp(cnn, NetworkCode, StationCode):
+    """
+    md5 of the records that define the functional model of the ETM of a station (station record, station information
+    and etm_params), obtained with a single query
+    """
+    where = '"NetworkCode" = \'%s\' AND "StationCode" = \'%s\'' % (NetworkCode, StationCode)
+
+    return cnn.query_float('SELECT md5(concat_ws(\'|\', '
+                           '(SELECT s::text FROM stations s WHERE %s), '
+                           '(SELECT string_agg(i::text, \',\' ORDER BY "DateStart") FROM stationinfo i WHERE %s), '
+                           '(SELECT string_agg(p::text, \',\' ORDER BY p::text) FROM etm_params p WHERE %s))) as stamp'
+                           % (where, where, where), as_dict=True)[0]['stamp']
+
+
+def load_gamit_soln_data(cnn, stations, stack_name):
+    """
+    Bulk load the metadata used by GamitSoln (station record and epochs with RINEX files but no solutions in the stack)
+    of a list of stations using one set-based query per table
+    :param cnn: connection to the database
+    :param stations: list of station dictionaries (NetworkCode, StationCode)
+    :param stack_name: name of the stack
+    :return: dictionary of station data (key net.stn) to be passed to GamitSoln
+    """
+    data = dict()
+    for stn in stations:
+        data[stn['NetworkCode'] + '.' + stn['StationCode']] = {'rnx_no_ppp': []}
+
+    for stn in cnn.query_float('SELECT * FROM stations WHERE %s' % Utils.station_filter(stations), as_dict=True):
+        data[stn['NetworkCode'] + '.' + stn['StationCode']]['station'] = stn
+
+    rnx = cnn.query(
+        'SELECT r.* FROM rinex_proc as r '
+        'LEFT JOIN stacks as p ON '
+        'r."NetworkCode" = p."NetworkCode" AND '
+        'r."StationCode" = p."StationCode" AND '
+        'r."ObservationYear" = p."Year"    AND '
+        'r."ObservationDOY"  = p."DOY"     AND '
+        'p."name" = \'%s\''
+        'WHERE %s AND p."NetworkCode" IS NULL' % (stack_name, Utils.station_filter(stations, 'r')))
+
+    for r in rnx.dictresult():
+        data[r['NetworkCode'] + '.' + r['StationCode']]['rnx_no_ppp'].append(r)
+
+    return data
+
+
+def load_etm_metadata(cnn, stations, data):
+    """
+    Bulk load the metadata used to build the ETM of a list of stations (etm_params, station information and the
+    earthquakes that can affect each station) using one set-based query per table. With this metadata, the ETMs can
+    be created without a connection to the database (see the metadata parameter of ETM)
+    :param cnn: connection to the database
+    :param stations: list of station dictionaries (NetworkCode, StationCode)
+    :param data: dictionary of station data returned by load_gamit_soln_data (updated with the ETM metadata)
+    :return: data
+    """
+    for stn in stations:
+        data[stn['NetworkCode'] + '.' + stn['StationCode']].update({'etm_params': [], 'stationinfo': []})
+
+    for p in cnn.query_float('SELECT * FROM etm_params WHERE %s' % Utils.station_filter(stations), as_dict=True):
+        data[p['NetworkCode'] + '.' + p['StationCode']]['etm_params'].append(p)
+
+    for r in cnn.query('SELECT * FROM stationinfo WHERE %s ORDER BY "NetworkCode", "StationCode", "DateStart"'
+                       % Utils.station_filter(stations)).dictresult():
+        data[r['NetworkCode'] + '.' + r['StationCode']]['stationinfo'].append(r)
+
+    index = get_earthquake_index(cnn)
+
+    for stn in stations:
+        station = data[stn['NetworkCode'] + '.' + stn['StationCode']]
+
+        if station.get('station') is not None and station['station']['lat'] is not None:
+            # events that can affect the station (any date): the date criteria are applied by Earthquakes
+            ids = index.find(float(station['station']['lat']), float(station['station']['lon']))
+            station['earthquakes'] = (index.events[ids], index.dates[ids])
+
+    return data
+
+
+def find_etm_params(metadata, soln, obj, **fields):
+    """
+    Select the etm_params records of a station from the metadata loaded by load_etm_metadata
+    :param metadata: station metadata
+    :param soln: solution type
+    :param obj: object (polynomial, periodic or jump)
+    :param fields: other fields that the records should match
+    :return: list of records
+    """
+    return [p for p in metadata['etm_params'] if p['soln'] == soln and p['object'] == obj and
+            all(p[k] == v for k, v in fields.items())]
+
+
+def get_etm_param(cnn, metadata, NetworkCode, StationCode, soln, obj):
+    """
+    Obtain the etm_params record of the polynomial or periodic terms of a station from the metadata (if provided) or
+    from the database. Raises pg.DatabaseError if the record does not exist (same as cnn.get)
+    """
+    if metadata is not None and 'etm_params' in metadata:
+        records = find_etm_params(metadata, soln, obj)
+
+        if not records:
+            raise pg.DatabaseError('No %s record in etm_params for %s.%s' % (obj, NetworkCode, StationCode))
+
+        return records[0]
+    else:
+        return cnn.get('etm_params', {'NetworkCode': NetworkCode, 'StationCode': StationCode, 'soln': soln,
+                                      'object': obj}, ['NetworkCode', 'StationCode', 'soln', 'object'])
+
+
 class GamitSoln(object):
     """"class to extract the GAMIT polyhedrons from the database"""
 
-    def __init__(self, cnn, polyhedrons, NetworkCode, StationCode, stack_name):
-
+    def __init__(self, cnn, polyhedrons, NetworkCode, StationCode, stack_name, data=None):
+        """
+        :param data: dictionary with the records of this station already fetched by load_gamit_soln_data (station and
+                     rnx_no_ppp). Items that are not present are queried from the database
+        """
         self.NetworkCode = NetworkCode
         self.StationCode = StationCode
         self.stack_name = stack_name
@@ -334,9 +597,15 @@ class GamitSoln(object):
 
         self.type = 'gamit'
 
+        if data is None:
+            data = dict()
+
         # get the station from the stations table
-        stn = cnn.query_float('SELECT * FROM stations WHERE "NetworkCode" = \'%s\' AND "StationCode" = \'%s\''
-                              % (NetworkCode, StationCode), as_dict=True)[0]
+        if 'station' in data:
+            stn = data['station']
+        else:
+            stn = cnn.query_float('SELECT * FROM stations WHERE "NetworkCode" = \'%s\' AND "StationCode" = \'%s\''
+                                  % (NetworkCode, StationCode), as_dict=True)[0]
 
         if stn['lat'] is not None:
             self.lat = np.array([float(stn['lat'])])
@@ -351,40 +620,47 @@ class GamitSoln(object):
             else:
                 self.max_dist = 20
 
-            self.solutions = len(polyhedrons)
+            if isinstance(polyhedrons, dict):
+                # columns from the time series store (read only views, no copies)
+                a = [polyhedrons['x'], polyhedrons['y'], polyhedrons['z'], polyhedrons['year'], polyhedrons['doy']]
+                self.solutions = a[0].size
+            else:
+                self.solutions = len(polyhedrons)
+                a = np.array(polyhedrons, dtype=float).reshape((self.solutions, -1)).transpose()
 
             # blunders
             self.blunders = []
             self.ts_blu = np.array([])
 
             if self.solutions >= 1:
-                a = np.array(polyhedrons, dtype=float)
 
-                if np.sqrt(np.square(np.sum(np.square(a[0, 0:3])))) > 6.3e3:
+                if np.sqrt(np.square(np.sum(np.square([a[0][0], a[1][0], a[2][0]])))) > 6.3e3:
                     # coordinates given in XYZ
-                    nb = np.sqrt(np.square(np.sum(
-                        np.square(a[:, 0:3] - np.array([stn['auto_x'], stn['auto_y'], stn['auto_z']])), axis=1))) \
-                         <= self.max_dist
+                    nb = np.sqrt(np.square(np.square(a[0] - stn['auto_x']) + np.square(a[1] - stn['auto_y']) +
+                                           np.square(a[2] - stn['auto_z']))) <= self.max_dist
                 else:
                     # coordinates are differences
-                    nb = np.sqrt(np.square(np.sum(np.square(a[:, 0:3]), axis=1))) <= self.max_dist
+                    nb = np.sqrt(np.square(np.square(a[0]) + np.square(a[1]) + np.square(a[2]))) <= self.max_dist
 
                 if np.any(nb):
-                    self.x = a[nb, 0]
-                    self.y = a[nb, 1]
-                    self.z = a[nb, 2]
-                    self.t = np.array([pyDate.Date(year=item[0], doy=item[1]).fyear for item in a[nb, 3:5]])
-                    self.mjd = np.array([pyDate.Date(year=item[0], doy=item[1]).mjd for item in a[nb, 3:5]])
+                    if not np.all(nb):
+                        a = [column[nb] for column in a]
+
+                    self.x = a[0]
+                    self.y = a[1]
+                    self.z = a[2]
 
-                    self.date = [pyDate.Date(year=item[0], doy=item[1]) for item in a[nb, 3:5]]
+                    self.date = pyDate.DateArray(year=a[3], doy=a[4])
+                    self.t = self.date.fyear
+                    self.mjd = self.date.mjd
 
                     # continuous time vector for plots
                     ts = np.arange(np.min(self.mjd), np.max(self.mjd) + 1, 1)
                     self.mjds = ts
-                    self.ts = np.array([pyDate.Date(mjd=tts).fyear for tts in ts])
+                    self.ts = pyDate.DateArray(mjd=ts).fyear
                 else:
-                    dd = np.sqrt(np.square(np.sum(
-                        np.square(a[:, 0:3] - np.array([stn['auto_x'], stn['auto_y'], stn['auto_z']])), axis=1)))
+                    dd = np.sqrt(np.square(np.square(a[0] - stn['auto_x']) + np.square(a[1] - stn['auto_y']) +
+                                           np.square(a[2] - stn['auto_z'])))
 
                     raise pyETMException('No viable GAMIT solutions available for %s.%s (all blunders!)\n'
                                          '  -> min distance to station coordinate is %.1f meters'
@@ -394,18 +670,21 @@ class GamitSoln(object):
 
             # get a list of the epochs with files but no solutions.
             # This will be shown in the outliers plot as a special marker
-            rnx = cnn.query(
-                'SELECT r.* FROM rinex_proc as r '
-                'LEFT JOIN stacks as p ON '
-                'r."NetworkCode" = p."NetworkCode" AND '
-                'r."StationCode" = p."StationCode" AND '
-                'r."ObservationYear" = p."Year"    AND '
-                'r."ObservationDOY"  = p."DOY"     AND '
-                'p."name" = \'%s\''
-                'WHERE r."NetworkCode" = \'%s\' AND r."StationCode" = \'%s\' AND '
-                'p."NetworkCode" IS NULL' % (stack_name, NetworkCode, StationCode))
-
-            self.rnx_no_ppp = rnx.dictresult()
+            if 'rnx_no_ppp' in data:
+                self.rnx_no_ppp = data['rnx_no_ppp']
+            else:
+                rnx = cnn.query(
+                    'SELECT r.* FROM rinex_proc as r '
+                    'LEFT JOIN stacks as p ON '
+                    'r."NetworkCode" = p."NetworkCode" AND '
+                    'r."StationCode" = p."StationCode" AND '
+                    'r."ObservationYear" = p."Year"    AND '
+                    'r."ObservationDOY"  = p."DOY"     AND '
+                    'p."name" = \'%s\''
+                    'WHERE r."NetworkCode" = \'%s\' AND r."StationCode" = \'%s\' AND '
+                    'p."NetworkCode" IS NULL' % (stack_name, NetworkCode, StationCode))
+
+                self.rnx_no_ppp = rnx.dictresult()
             self.ts_ns = np.array([float(item['ObservationFYear']) for item in self.rnx_no_ppp])
 
             self.completion = 100. - float(len(self.ts_ns)) / float(len(self.ts_ns) + len(self.t)) * 100.
@@ -428,14 +707,15 @@ class ListSoln(GamitSoln):
 
 class JumpTable:
 
-    def __init__(self, cnn, NetworkCode, StationCode, soln, t, FitEarthquakes=True, FitGenericJumps=True):
+    def __init__(self, cnn, NetworkCode, StationCode, soln, t, FitEarthquakes=True, FitGenericJumps=True,
+                 metadata=None):
 
         self.table = []
 
         # get earthquakes for this station
-        self.earthquakes = Earthquakes(cnn, NetworkCode, StationCode, soln, t, FitEarthquakes)
+        self.earthquakes = Earthquakes(cnn, NetworkCode, StationCode, soln, t, FitEarthquakes, metadata)
 
-        self.generic_jumps = GenericJumps(cnn, NetworkCode, StationCode, soln, t, FitGenericJumps)
+        self.generic_jumps = GenericJumps(cnn, NetworkCode, StationCode, soln, t, FitGenericJumps, metadata)
 
         jumps = self.earthquakes.table + self.generic_jumps.table
 
@@ -908,18 +1188,201 @@ class CoSeisJump(Jump):
         return 'pyPPPETM.CoSeisJump(' + str(self) + ')'
 
 
+def eq_max_distance(mag):
+    """
+    Maximum distance (in km) at which an earthquake of magnitude mag produces a jump, obtained by solving Mike's
+    expression used by Earthquakes (-0.8717 * (log10(dist) - 2.25) + 0.4901 * (mag - 6.6928) > 0) for dist
+    """
+    return 10 ** (2.25 + 0.4901 * (mag - 6.6928) / 0.8717)
+
+
+def sphere_xyz(lat, lon):
+    # unit vectors on the sphere used by the spatial index
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+
+    return np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+
+
+class EarthquakeIndex(object):
+    """
+    In-memory spatial index of the earthquakes table. The events are split in magnitude bins and each bin is stored
+    in a kd-tree (unit vectors on the sphere) that is searched using the maximum distance of its largest event. This
+    way, each ETM only evaluates the handful of events that can actually affect the station. The index is updated
+    incrementally: only the events added to the table since the last update are loaded.
+    """
+    def __init__(self, cnn, since=None, events=None):
+        """
+        :param cnn: connection to the database
+        :param since: datetime; only index the events after this date (default: all the events)
+        :param events: tuple with the events and their dates (see load_etm_metadata). If provided, the index is built
+                       with these events and the database is not used
+        """
+        self.since = since
+        self.count = 0
+        self.last = None
+        # lat, lon, mag, year, month, day, hour, minute, second
+        self.events = np.zeros((0, 9))
+        self.dates = np.array([], dtype='datetime64[us]')
+        self.bins = []
+
+        if events is not None:
+            self.build(events[0], events[1])
+        else:
+            self.update(cnn)
+
+    def where(self, since=None):
+
+        where = [('date > \'%s\'' % str(d)) for d in (self.since, since) if d is not None]
+
+        return (' WHERE ' + ' AND '.join(where)) if where else ''
+
+    def load(self, cnn, since=None):
+
+        jumps = cnn.query_float('SELECT * FROM earthquakes%s ORDER BY date' % self.where(since), as_dict=True)
+
+        events = np.array([[float(jump['lat']), float(jump['lon']), float(jump['mag']),
+                            int(jump['date'].year), int(jump['date'].month), int(jump['date'].day),
+                            int(jump['date'].hour), int(jump['date'].minute), int(jump['date'].second)]
+                           for jump in jumps]).reshape((-1, 9))
+
+        return events, np.array([jump['date'] for jump in jumps], dtype='datetime64[us]')
+
+    def update(self, cnn):
+        """
+        Load the events added to the earthquakes table since the last update (the whole table if the number of
+        events does not match, e.g. if events were deleted)
+        :return: True if the index changed
+        """
+        rs = cnn.query_float('SELECT count(*) as n, max(date) as last FROM earthquakes%s' % self.where(),
+                             as_dict=True)[0]
+
+        if int(rs['n']) == self.count and rs['last'] == self.last:
+            return False
+
+        events = None
+
+        if self.last is not None and rs['last'] is not None and rs['last'] > self.last:
+            events, dates = self.load(cnn, self.last)
+
+            if self.count + events.shape[0] == int(rs['n']):
+                events = np.concatenate((self.events, events))
+                dates = np.concatenate((self.dates, dates))
+            else:
+                events = None
+
+        if events is None:
+            events, dates = self.load(cnn)
+
+        self.build(events, dates)
+        self.last = rs['last']
+
+        return True
+
+    def build(self, events, dates):
+
+        self.events = events
+        self.dates = dates
+        self.count = events.shape[0]
+
+        # build the kd-trees of each magnitude bin
+        self.bins = []
+        if self.count:
+            mbin = np.floor(events[:, 2] / EQ_INDEX_BIN)
+            xyz = sphere_xyz(events[:, 0], events[:, 1])
+
+            for b in np.unique(mbin):
+                ids = np.where(mbin == b)[0]
+                # angular distance converted to chord length (padded to avoid round off problems at the border)
+                angle = min(eq_max_distance(events[ids, 2].max()) / 6371., pi)
+                self.bins.append((cKDTree(xyz[ids]), ids, 2 * np.sin(angle / 2) * (1 + 1e-6) + 1e-9))
+
+    def get_events(self, lat, lon, sdate=None, edate=None, pdate=None):
+        """
+        Obtain the earthquakes that can produce a jump at a given location, using the same criteria of the
+        earthquakes query in Earthquakes: events between sdate and edate and M7+ events between pdate and sdate
+        :param lat: latitude of the station
+        :param lon: longitude of the station
+        :param sdate: start date of the time series (pyDate.Date), None = no date filter
+        :param edate: end date of the time series (pyDate.Date), None = no date filter
+        :param pdate: start date for the M7+ events (pyDate.Date), default is 5 years before sdate
+        :return: array with [lat, lon, mag, year, month, day, hour, minute, second] of each event, sorted by date
+        """
+        return self.events[self.find(lat, lon, sdate, edate, pdate)]
+
+    def find(self, lat, lon, sdate=None, edate=None, pdate=None):
+        """
+        Same as get_events, but returns the indices of the events in the index
+        """
+        xyz = sphere_xyz(np.array([lat]), np.array([lon]))[0]
+
+        ids = [ids[tree.query_ball_point(xyz, radius)] for tree, ids, radius in self.bins]
+        ids = np.sort(np.concatenate(ids)).astype(int) if ids else np.array([], dtype=int)
+
+        if sdate is not None and edate is not None and ids.size:
+            d = self.dates[ids]
+
+            def bound(date):
+                return np.datetime64('%04i-%02i-%02i' % (date.year, date.month, date.day), 'us')
+
+            sd = bound(sdate)
+            pd = bound(pyDate.Date(fyear=sdate.fyear - 5) if pdate is None else pdate)
+
+            ids = ids[np.logical_or(np.logical_and(d >= sd, d <= bound(edate)),
+                                    np.logical_and(np.logical_and(d >= pd, d <= sd), self.events[ids, 2] >= 7))]
+
+        eq = self.events[ids]
+
+        # exact evaluation of the criteria
+        dist = distance(lon, lat, eq[:, 1], eq[:, 0])
+
+        with np.errstate(divide='ignore'):
+            m = -0.8717 * (np.log10(dist) - 2.25) + 0.4901 * (eq[:, 2] - 6.6928)
+
+        return ids[m > 0]
+
+
+# earthquake index shared by all the ETMs of this process (see get_earthquake_index)
+_earthquake_index = None
+
+
+def get_earthquake_index(cnn):
+    """
+    Obtain the earthquake spatial index of this process. The index is built the first time and then updated
+    incrementally with the events added to the earthquakes table
+    """
+    global _earthquake_index
+
+    if _earthquake_index is None:
+        _earthquake_index = EarthquakeIndex(cnn)
+    else:
+        _earthquake_index.update(cnn)
+
+    return _earthquake_index
+
+
+def count_events(cnn, lat, lon, t_min, t_max):
+    """
+    Number of earthquakes that can produce a jump at a station with solutions between t_min and t_max (fractional
+    years), using the same criteria of Earthquakes
+    """
+    return int(len(get_earthquake_index(cnn).find(lat, lon, pyDate.Date(fyear=t_min), pyDate.Date(fyear=t_max),
+                                                  pyDate.Date(fyear=t_min - 5))))
+
+
 class Earthquakes:
 
-    def __init__(self, cnn, NetworkCode, StationCode, soln, t, FitEarthquakes=True):
+    def __init__(self, cnn, NetworkCode, StationCode, soln, t, FitEarthquakes=True, metadata=None):
 
         self.StationCode = StationCode
         self.NetworkCode = NetworkCode
 
         # station location
-        stn = cnn.query('SELECT * FROM stations WHERE "NetworkCode" = \'%s\' AND "StationCode" = \'%s\''
-                        % (NetworkCode, StationCode))
-
-        stn = stn.dictresult()[0]
+        if metadata is not None and 'station' in metadata:
+            stn = metadata['station']
+        else:
+            stn = cnn.query('SELECT * FROM stations WHERE "NetworkCode" = \'%s\' AND "StationCode" = \'%s\''
+                            % (NetworkCode, StationCode)).dictresult()[0]
 
         # load metadata
         lat = float(stn['lat'])
@@ -934,38 +1397,36 @@ class Earthquakes:
 
         # get the earthquakes based on Mike's expression
         # earthquakes before the start data: only magnitude 7+
-        jumps = cnn.query_float('SELECT * FROM earthquakes '
-                                'WHERE date BETWEEN \'%s\' AND \'%s\' UNION '
-                                'SELECT * FROM earthquakes '
-                                'WHERE date BETWEEN \'%s\' AND \'%s\' AND mag >= 7 '
-                                'ORDER BY date'
-                                % (sdate.yyyymmdd(), edate.yyyymmdd(),
-                                   pyDate.Date(fyear=t.min() - 5).yyyymmdd(), sdate.yyyymmdd()), as_dict=True)
-
-        # check if data range returned any jumps
-        if jumps and FitEarthquakes:
-            eq = [[float(jump['lat']), float(jump['lon']), float(jump['mag']),
-                   int(jump['date'].year), int(jump['date'].month), int(jump['date'].day),
-                   int(jump['date'].hour), int(jump['date'].minute), int(jump['date'].second)] for jump in jumps]
-
-            eq = np.array(list(eq))
+        # use the spatial index to only retrieve the events that can affect this station
+        if metadata is not None and 'earthquakes' in metadata:
+            index = EarthquakeIndex(None, events=metadata['earthquakes'])
+        else:
+            index = get_earthquake_index(cnn)
 
-            dist = distance(lon, lat, eq[:, 1], eq[:, 0])
+        eq = index.get_events(lat, lon, sdate, edate, pyDate.Date(fyear=t.min() - 5))
 
-            m = -0.8717 * (np.log10(dist) - 2.25) + 0.4901 * (eq[:, 2] - 6.6928)
+        # check if data range returned any jumps
+        if eq.shape[0] and FitEarthquakes:
             # build the earthquake jump table
             # remove event events that happened the same day
 
             eq_jumps = list(set((float(eqs[2]), pyDate.Date(year=int(eqs[3]), month=int(eqs[4]), day=int(eqs[5]),
                                                             hour=int(eqs[6]), minute=int(eqs[7]), second=int(eqs[8])))
-                                for eqs in eq[m > 0, :]))
+                                for eqs in eq))
 
             eq_jumps.sort(key=lambda x: (x[1], -x[0]))
 
+            # mjd of the events (sorted) to find the candidates of each window using bisection. The window test is
+            # done on the candidates (one extra day on each side) to keep the exact comparison of the dates
+            eq_mjd = [d.mjd for _, d in eq_jumps]
+
             # open the jumps table
-            jp = cnn.query_float('SELECT * FROM etm_params WHERE "NetworkCode" = \'%s\' AND "StationCode" = \'%s\' '
-                                 'AND soln = \'%s\' AND jump_type <> 0 AND object = \'jump\''
-                                 % (NetworkCode, StationCode, soln.type), as_dict=True)
+            if metadata is not None and 'etm_params' in metadata:
+                jp = [j for j in find_etm_params(metadata, soln.type, 'jump') if j['jump_type'] != 0]
+            else:
+                jp = cnn.query_float('SELECT * FROM etm_params WHERE "NetworkCode" = \'%s\' AND '
+                                     '"StationCode" = \'%s\' AND soln = \'%s\' AND jump_type <> 0 AND '
+                                     'object = \'jump\'' % (NetworkCode, StationCode, soln.type), as_dict=True)
 
             # start by collapsing all earthquakes for the same day.
             # Do not allow more than one earthquake on the same day
@@ -981,7 +1442,9 @@ class Earthquakes:
                         continue
 
                 # obtain jumps in a EQ_MIN_DAYS window
-                jumps = [(m, d) for m, d in eq_jumps if date <= d < date + EQ_MIN_DAYS]
+                jumps = [(m, d) for m, d in eq_jumps[bisect_left(eq_mjd, date.mjd - 1):
+                                                     bisect_left(eq_mjd, date.mjd + EQ_MIN_DAYS + 2)]
+                         if date <= d < date + EQ_MIN_DAYS]
 
                 if len(jumps) > 1:
                     # if more than one jump, get the max magnitude
@@ -1052,7 +1515,7 @@ class Earthquakes:
 
 class GenericJumps(object):
 
-    def __init__(self, cnn, NetworkCode, StationCode, soln, t, FitGenericJumps=True):
+    def __init__(self, cnn, NetworkCode, StationCode, soln, t, FitGenericJumps=True, metadata=None):
 
         self.solution_type = soln.type
         self.table = []
@@ -1080,14 +1543,16 @@ class GenericJumps(object):
             self.add_metadata_jumps = False
 
         # open the jumps table
-        jp = cnn.query('SELECT * FROM etm_params WHERE "NetworkCode" = \'%s\' AND "StationCode" = \'%s\' '
-                       'AND soln = \'%s\' AND jump_type = 0 AND object = \'jump\''
-                       % (NetworkCode, StationCode, self.solution_type))
-
-        jp = jp.dictresult()
+        if metadata is not None and 'etm_params' in metadata:
+            jp = find_etm_params(metadata, self.solution_type, 'jump', jump_type=0)
+        else:
+            jp = cnn.query('SELECT * FROM etm_params WHERE "NetworkCode" = \'%s\' AND "StationCode" = \'%s\' '
+                           'AND soln = \'%s\' AND jump_type = 0 AND object = \'jump\''
+                           % (NetworkCode, StationCode, self.solution_type)).dictresult()
 
         # get station information
-        self.stninfo = pyStationInfo.StationInfo(cnn, NetworkCode, StationCode)
+        self.stninfo = pyStationInfo.StationInfo(cnn, NetworkCode, StationCode,
+                                                 records=metadata.get('stationinfo') if metadata else None)
 
         for stninfo in self.stninfo.records[1:]:
 
@@ -1131,11 +1596,12 @@ class GenericJumps(object):
                                            fit=True if '-' not in table else False))
 
         # now check the jump table to add specific jumps
-        jp = cnn.query('SELECT * FROM etm_params WHERE "NetworkCode" = \'%s\' AND "StationCode" = \'%s\' '
-                       'AND soln = \'%s\' AND jump_type = 0 AND object = \'jump\' '
-                       'AND action = \'+\'' % (NetworkCode, StationCode, self.solution_type))
-
-        jp = jp.dictresult()
+        if metadata is not None and 'etm_params' in metadata:
+            jp = find_etm_params(metadata, self.solution_type, 'jump', jump_type=0, action='+')
+        else:
+            jp = cnn.query('SELECT * FROM etm_params WHERE "NetworkCode" = \'%s\' AND "StationCode" = \'%s\' '
+                           'AND soln = \'%s\' AND jump_type = 0 AND object = \'jump\' '
+                           'AND action = \'+\'' % (NetworkCode, StationCode, self.solution_type)).dictresult()
 
         table = [j.date for j in self.table]
 
@@ -1150,16 +1616,13 @@ class GenericJumps(object):
 class Periodic(EtmFunction):
     """"class to determine the periodic terms to be included in the ETM"""
 
-    def __init__(self, cnn, NetworkCode, StationCode, soln, t, FitPeriodic=True):
+    def __init__(self, cnn, NetworkCode, StationCode, soln, t, FitPeriodic=True, metadata=None):
 
         super(Periodic, self).__init__(NetworkCode=NetworkCode, StationCode=StationCode, soln=soln)
 
         try:
             # load the frequencies from the database
-            etm_param = cnn.get('etm_params',
-                                {'NetworkCode': NetworkCode, 'StationCode': StationCode, 'soln': soln.type,
-                                 'object': 'periodic'},
-                                ['NetworkCode', 'StationCode', 'soln', 'object'])
+            etm_param = get_etm_param(cnn, metadata, NetworkCode, StationCode, soln.type, 'periodic')
 
             self.p.frequencies = np.array([float(p) for p in etm_param['frequencies']])
 
@@ -1280,7 +1743,7 @@ class Periodic(EtmFunction):
 class Polynomial(EtmFunction):
     """"class to build the linear portion of the design matrix"""
 
-    def __init__(self, cnn, NetworkCode, StationCode, soln, t, t_ref=0, interseismic=None):
+    def __init__(self, cnn, NetworkCode, StationCode, soln, t, t_ref=0, interseismic=None, metadata=None):
 
         super(Polynomial, self).__init__(NetworkCode=NetworkCode, StationCode=StationCode, soln=soln)
 
@@ -1313,10 +1776,7 @@ class Polynomial(EtmFunction):
         else:
             try:
                 # load the number of terms from the database
-                etm_param = cnn.get('etm_params',
-                                    {'NetworkCode': NetworkCode, 'StationCode': StationCode, 'soln': soln.type,
-                                     'object': 'polynomial'},
-                                    ['NetworkCode', 'StationCode', 'soln', 'object'])
+                etm_param = get_etm_param(cnn, metadata, NetworkCode, StationCode, soln.type, 'polynomial')
 
                 self.terms = int(etm_param['terms'])
 
@@ -1443,6 +1903,17 @@ class Design(np.ndarray):
         # Finally, we must return the newly created object:
         return A
 
+    def __reduce__(self):
+        # keep the attributes of the design matrix when pickling (ndarray only saves the data)
+        reconstruct, arguments, state = super(Design, self).__reduce__()
+
+        return reconstruct, arguments, (state, self.__dict__)
+
+    def __setstate__(self, state):
+
+        super(Design, self).__setstate__(state[0])
+        self.__dict__.update(state[1])
+
     def __call__(self, ts=None, constrains=False):
 
         if ts is None:
@@ -1501,10 +1972,63 @@ class Design(np.ndarray):
             return v
 
 
+class NormalEquations(object):
+    """
+    Normal equations of a design matrix. The Cholesky factorizations of the (scaled) normal matrix for the last two
+    weight vectors are kept so that they can be reused when the weights do not change: the three components share
+    unit weights in the first iteration of adjust_lsq, and the covariance matrix is computed with the weights of the
+    last iteration that passed the chi-square test
+    """
+    def __init__(self, design, A):
+
+        self.design = design
+        self.A = A
+        # list of (P, scale, cho) tuples, most recent first
+        self.factorizations = []
+
+    def factorize(self, P):
+
+        for i, (fP, scale, cho) in enumerate(self.factorizations):
+            if np.array_equal(P, fP):
+                # move to the front of the list
+                self.factorizations.insert(0, self.factorizations.pop(i))
+                return scale, cho
+
+        N = np.dot(self.A.transpose(), np.multiply(P[:, None], self.A))
+
+        d = np.diag(N)
+        if np.any(d <= 0):
+            raise np.linalg.LinAlgError('Normal matrix has empty columns')
+
+        # scale the normal matrix to unit diagonal to improve the conditioning of the factorization
+        scale = 1. / np.sqrt(d)
+        cho = cho_factor(N * np.outer(scale, scale))
+
+        self.factorizations = [(P.copy(), scale, cho)] + self.factorizations[0:1]
+
+        return scale, cho
+
+    def solve(self, P, L):
+
+        scale, cho = self.factorize(P)
+
+        return scale * cho_solve(cho, scale * np.dot(self.A.transpose(), np.multiply(P, L)))
+
+    def inverse(self, P):
+
+        scale, cho = self.factorize(P)
+
+        return np.outer(scale, scale) * cho_solve(cho, np.eye(scale.size))
+
+
 class ETM:
 
     def __init__(self, cnn, soln, no_model=False, FitEarthquakes=True, FitGenericJumps=True, FitPeriodic=True,
-                 interseismic=None):
+                 interseismic=None, solver=LSQ_SVD, metadata=None):
+        """
+        :param metadata: dictionary with the station metadata loaded by load_etm_metadata (and load_gamit_soln_data).
+                         Items that are not present are queried from the database
+        """
 
         # to display more verbose warnings
         # warnings.showwarning = self.warn_with_traceback
@@ -1523,6 +2047,9 @@ class ETM:
         self.FitEarthquakes = FitEarthquakes
         self.FitGenericJumps = FitGenericJumps
         self.FitPeriodic = FitPeriodic
+        # least squares solver and cache of the normal equations (used with LSQ_NEQ)
+        self.solver = solver
+        self.neq = None
 
         self.NetworkCode = soln.NetworkCode
         self.StationCode = soln.StationCode
@@ -1531,10 +2058,11 @@ class ETM:
 
         # save the function objects
         self.Linear = Polynomial(cnn, soln.NetworkCode, soln.StationCode, self.soln, self.soln.t,
-                                 interseismic=interseismic)
-        self.Periodic = Periodic(cnn, soln.NetworkCode, soln.StationCode, self.soln, self.soln.t, FitPeriodic)
+                                 interseismic=interseismic, metadata=metadata)
+        self.Periodic = Periodic(cnn, soln.NetworkCode, soln.StationCode, self.soln, self.soln.t, FitPeriodic,
+                                 metadata)
         self.Jumps = JumpTable(cnn, soln.NetworkCode, soln.StationCode, self.soln, self.soln.t,
-                               FitEarthquakes, FitGenericJumps)
+                               FitEarthquakes, FitGenericJumps, metadata)
         # calculate the hash value for this station
         # now hash also includes the timestamp of the last time pyETM was modified.
         self.hash = soln.hash
@@ -1558,97 +2086,15 @@ class ETM:
 
         if self.A is not None:
             # try to load the last ETM solution from the database
-
-            etm_objects = cnn.query_float('SELECT * FROM etms WHERE "NetworkCode" = \'%s\' '
-                                          'AND "StationCode" = \'%s\' AND soln = \'%s\' AND stack = \'%s\''
-                                          % (self.NetworkCode, self.StationCode, self.soln.type,
-                                             self.soln.stack_name), as_dict=True)
-
-            # DDG: Attention: it is not always possible to retrieve the parameters from the database using the hash
-            # strategy. The jump table is determined and their hash values calculated. The fit attribute goes into the
-            # hash value. When an unrealistic jump is detected, the jump is removed from the fit and the final
-            # parameters are saved without this jump. Thus, when loading the object, the jump will be added to fit but
-            # it will not be present in the database.
-            db_hash_sum = sum([obj['hash'] for obj in etm_objects])
-            jumps_hash = sum([o.p.hash for o in self.Jumps.table if o.fit])
-            ob_hash_sum = self.Periodic.p.hash + self.Linear.p.hash + self.hash + jumps_hash
-            cn_object_sum = len([o.p.hash for o in self.Jumps.table if o.fit]) + 2
-
-            # -1 to account for the var_factor entry
-            if len(etm_objects) - 1 == cn_object_sum and db_hash_sum == ob_hash_sum:
-                logger.info('ETM -> Loading parameters from database (db hash %i; ob hash %i)'
-                            % (db_hash_sum, ob_hash_sum))
-                # load the parameters from th db
-                self.load_parameters(etm_objects, l)
-                # signal the outside world that the parameters were loaded from the database (no need to save them)
-                self.param_origin = DATABASE
-            else:
-                logger.info('ETM -> Estimating parameters (db hash %i; ob hash %i)'
-                            % (db_hash_sum, ob_hash_sum))
-                # signal the outside world that the parameters were estimated (and need to be saves)
-                self.param_origin = ESTIMATION
-                # purge table and recompute
-                cnn.query('DELETE FROM etms WHERE "NetworkCode" = \'%s\' AND '
-                          '"StationCode" = \'%s\' AND soln = \'%s\' AND stack = \'%s\''
-                          % (self.NetworkCode, self.StationCode, self.soln.type, self.soln.stack_name))
-
-                if self.soln.type == 'dra':
-                    # if the solution is of type 'dra', delete the excluded solutions
-                    cnn.query('DELETE FROM gamit_soln_excl WHERE "NetworkCode" = \'%s\' AND '
-                              '"StationCode" = \'%s\'' % (self.NetworkCode, self.StationCode))
-
-                # use the default parameters from the objects
-                t_ref = self.Linear.p.t_ref
+            if not self.load_db_parameters(cnn, l):
                 j = 0
-                do_again = False
                 while j < 10:
-                    c = []
-                    f = []
-                    s = []
-                    r = []
-                    p = []
-                    factor = []
-                    for i in range(3):
+                    adjustment = [self.adjust_lsq(self.A, l[i]) for i in range(3)]
 
-                        x, sigma, index, residuals, fact, w = self.adjust_lsq(self.A, l[i])
-
-                        c.append(x)
-                        s.append(sigma)
-                        f.append(index)
-                        r.append(residuals)
-                        factor.append(fact)
-                        p.append(w)
-
-                    self.C = np.array(c)
-                    self.S = np.array(s)
-                    self.F = np.array(f)
-                    self.R = np.array(r)
-                    self.factor = np.array(factor)
-                    self.P = np.array(p)
-
-                    # load_parameters to the objects
-                    self.Linear.load_parameters(self.C, self.S, t_ref)
-                    self.Jumps.load_parameters(self.C, self.S)
-                    self.Periodic.load_parameters(params=self.C, sigmas=self.S)
-
-                    # determine if any jumps are unrealistic
-                    for jump in self.Jumps.table:
-                        if jump.fit and jump.p.jump_type in (CO_SEISMIC_JUMP_DECAY, CO_SEISMIC_DECAY) \
-                                and np.any(np.abs(jump.p.params[:, -jump.nr:]) > 0.5):
-                            # unrealistic, remove
-                            jump.remove_from_fit()
-                            do_again = True
-                            logger.info('ETM -> Unrealistic jump detected (%s : %s), removing and redoing fit'
-                                        % (np.array_str(jump.p.params[:, -jump.nr:].flatten(), precision=1),
-                                           type_dict[jump.p.jump_type]))
-
-                    if not do_again:
+                    if not self.apply_adjustment(adjustment, soln):
                         break
-                    else:
-                        self.A = Design(self.Linear, self.Jumps, self.Periodic)
-                        if soln:
-                            self.As = self.A(soln.ts)
-                        j += 1
+
+                    j += 1
 
             # load the covariances using the correlations
             self.process_covariance()
@@ -1658,6 +2104,192 @@ class ETM:
         else:
             logger.info('ETM -> Empty design matrix')
 
+    def load_db_parameters(self, cnn, l):
+        """
+        Compare the hash of the ETM objects against the etms table. If the hash values agree, the parameters are loaded
+        from the database. Otherwise, the etms records of this station are purged so that the parameters can be estimated
+        :param cnn: connection to the database. If None, the parameters are always estimated and the etms table is left
+                    to the caller (e.g. ETMs computed in the nodes by the Stacker)
+        :param l: NEU observation vector
+        :return: True if the parameters were loaded from the database, False if they need to be estimated
+        """
+        if cnn is None:
+            self.param_origin = ESTIMATION
+            return False
+
+        etm_objects = cnn.query_float('SELECT * FROM etms WHERE "NetworkCode" = \'%s\' '
+                                      'AND "StationCode" = \'%s\' AND soln = \'%s\' AND stack = \'%s\''
+                                      % (self.NetworkCode, self.StationCode, self.soln.type,
+                                         self.soln.stack_name), as_dict=True)
+
+        # the normal equations (see update_ppp_etm) are not part of the parameter set
+        etm_objects = [obj for obj in etm_objects if obj['object'] != 'neq']
+
+        # DDG: Attention: it is not always possible to retrieve the parameters from the database using the hash
+        # strategy. The jump table is determined and their hash values calculated. The fit attribute goes into the
+        # hash value. When an unrealistic jump is detected, the jump is removed from the fit and the final
+        # parameters are saved without this jump. Thus, when loading the object, the jump will be added to fit but
+        # it will not be present in the database.
+        db_hash_sum = sum([obj['hash'] for obj in etm_objects])
+        jumps_hash = sum([o.p.hash for o in self.Jumps.table if o.fit])
+        ob_hash_sum = self.Periodic.p.hash + self.Linear.p.hash + self.hash + jumps_hash
+        cn_object_sum = len([o.p.hash for o in self.Jumps.table if o.fit]) + 2
+
+        # -1 to account for the var_factor entry
+        if len(etm_objects) - 1 == cn_object_sum and db_hash_sum == ob_hash_sum:
+            logger.info('ETM -> Loading parameters from database (db hash %i; ob hash %i)'
+                        % (db_hash_sum, ob_hash_sum))
+            # load the parameters from th db
+            self.load_parameters(etm_objects, l)
+            # signal the outside world that the parameters were loaded from the database (no need to save them)
+            self.param_origin = DATABASE
+
+            return True
+        else:
+            logger.info('ETM -> Estimating parameters (db hash %i; ob hash %i)'
+                        % (db_hash_sum, ob_hash_sum))
+            # signal the outside world that the parameters were estimated (and need to be saves)
+            self.param_origin = ESTIMATION
+
+            # purge table and recompute
+            cnn.query('DELETE FROM etms WHERE "NetworkCode" = \'%s\' AND '
+                      '"StationCode" = \'%s\' AND soln = \'%s\' AND stack = \'%s\''
+                      % (self.NetworkCode, self.StationCode, self.soln.type, self.soln.stack_name))
+
+            if self.soln.type == 'dra':
+                # if the solution is of type 'dra', delete the excluded solutions
+                cnn.query('DELETE FROM gamit_soln_excl WHERE "NetworkCode" = \'%s\' AND '
+                          '"StationCode" = \'%s\'' % (self.NetworkCode, self.StationCode))
+
+            return False
+
+    def get_normal_equations(self, l):
+        """
+        Accumulate the normal equations of the current adjustment using the final weights of each component
+        :param l: NEU observation vector
+        :return: dictionary with the normal matrices, the normal vectors, the weighted sum of the squared observations,
+                 the scale of the weights and the number of observations; None if the adjustment is not consistent
+                 with the current design matrix
+        """
+        A = self.A(constrains=True)
+
+        if self.C.shape != (3, A.shape[1]) or self.P.shape != (3, A.shape[0]):
+            return None
+
+        dof = (self.A.shape[0] - self.A.shape[1])
+
+        N = []
+        b = []
+        lpl = []
+        pfac = []
+
+        for i in range(3):
+            L = self.A.get_l(l[i], constrains=True)
+            P = self.P[i]
+
+            N.append(np.dot(A.transpose(), np.multiply(P[:, None], A)))
+            b.append(np.dot(A.transpose(), np.multiply(P, L)))
+            lpl.append(np.dot(L, np.multiply(P, L)))
+
+            # the weights are P = (f / pfac)^2, where the variance factor is pfac * So
+            v = L - np.dot(A, self.C[i])
+            So = np.sqrt(np.dot(v, np.multiply(P, v)) / dof)
+            pfac.append(self.factor[i] / So if So > 0 else 1.)
+
+        return {'N': np.array(N), 'b': np.array(b), 'lpl': np.array(lpl), 'pfac': np.array(pfac),
+                'factor': np.array(self.factor, dtype=float), 'rows': self.A.shape[0]}
+
+    def normal_equations_row(self, cnn):
+        """
+        Normal equations of the adjustment, saved with the parameters so that update_ppp_etm can add the epochs that
+        arrive later without loading the time series. Only PPP ETMs whose functional model can't be changed by new
+        epochs (all the periodic terms and metadata jumps are fitted and no co-seismic jump is waiting for enough data
+        to fit its decay) are saved
+        :param cnn: connection to the database
+        :return: etms row (dictionary) with the normal equations or None if the ETM can't be updated
+        """
+        if self.A is None or self.soln.type != 'ppp' or self.A.constrains.size \
+                or (self.FitPeriodic and self.Periodic.frequency_count < self.Periodic.nyquist.size) \
+                or (self.FitGenericJumps and not self.Jumps.generic_jumps.add_metadata_jumps and
+                    any([jump.p.jump_type == ANTENNA_CHANGE for jump in self.Jumps.generic_jumps.table])) \
+                or any([jump.fit and jump.p.jump_type == CO_SEISMIC_JUMP for jump in self.Jumps.table]):
+            return None
+
+        normal = self.get_normal_equations(self.l)
+
+        if normal is None:
+            return None
+
+        params = np.concatenate((normal['N'].flatten(), normal['b'].flatten(), normal['lpl'], normal['pfac'],
+                                 normal['factor']))
+
+        # last epoch in the normal equations (blunders included: they should not be queried as new epochs)
+        last = int(max((self.soln.table[3] * 1000 + self.soln.table[4]).max(),
+                       max([item[3] * 1000 + item[4] for item in self.soln.blunders] or [0])))
+
+        digest, frames = ppp_digest(cnn, self.NetworkCode, self.StationCode, last)
+
+        # jumps after the last epoch become part of the model when new epochs arrive
+        pending = [jump.date.fyear for jump in self.Jumps.table if jump.date.fyear >= self.soln.t.max()]
+
+        metadata = json.dumps({'rows': normal['rows'], 'columns': self.A.shape[1], 'last': last,
+                               'digest': digest, 'frames': frames,
+                               'stamp': etm_stamp(cnn, self.NetworkCode, self.StationCode),
+                               'solutions': len(self.soln.t) + len(self.soln.blunders),
+                               'mjd': [int(self.soln.mjd.min()), int(self.soln.mjd.max())],
+                               't': [float(self.soln.t.min()), float(self.soln.t.max())],
+                               'events': count_events(cnn, self.soln.lat[0], self.soln.lon[0],
+                                                      self.soln.t.min(), self.soln.t.max()),
+                               'pending': min(pending) if pending else None})
+
+        return {'NetworkCode': self.NetworkCode, 'StationCode': self.StationCode, 'soln': self.soln.type,
+                'object': 'neq', 'params': to_postgres(params), 'metadata': metadata, 'hash': int(self.hash),
+                'stack': self.soln.stack_name}
+
+    def apply_adjustment(self, adjustment, soln=None):
+        """
+        Load the result of the least squares adjustment of the N, E and U components into the ETM objects and check
+        for unrealistic jumps
+        :param adjustment: list with the output of adjust_lsq for each component
+        :param soln: solution object used to rebuild the continuous design matrix (if jumps are removed)
+        :return: True if any jump was removed and the adjustment needs to be repeated
+        """
+        # use the default parameters from the objects
+        t_ref = self.Linear.p.t_ref
+        do_again = False
+
+        c, s, f, r, factor, p = zip(*adjustment)
+
+        self.C = np.array(c)
+        self.S = np.array(s)
+        self.F = np.array(f)
+        self.R = np.array(r)
+        self.factor = np.array(factor)
+        self.P = np.array(p)
+
+        # load_parameters to the objects
+        self.Linear.load_parameters(self.C, self.S, t_ref)
+        self.Jumps.load_parameters(self.C, self.S)
+        self.Periodic.load_parameters(params=self.C, sigmas=self.S)
+
+        # determine if any jumps are unrealistic
+        for jump in self.Jumps.table:
+            if jump.fit and jump.p.jump_type in (CO_SEISMIC_JUMP_DECAY, CO_SEISMIC_DECAY) \
+                    and np.any(np.abs(jump.p.params[:, -jump.nr:]) > 0.5):
+                # unrealistic, remove
+                jump.remove_from_fit()
+                do_again = True
+                logger.info('ETM -> Unrealistic jump detected (%s : %s), removing and redoing fit'
+                            % (np.array_str(jump.p.params[:, -jump.nr:].flatten(), precision=1),
+                               type_dict[jump.p.jump_type]))
+
+        if do_again:
+            self.A = Design(self.Linear, self.Jumps, self.Periodic)
+            if soln:
+                self.As = self.A(soln.ts)
+
+        return do_again
+
     def process_covariance(self):
 
         cov = np.zeros((3, 1))
@@ -1697,25 +2329,45 @@ class ETM:
                           'residual) VALUES (\'%s\', \'%s\', \'%s\', %i ,%i, %.4f)'
                           % (self.NetworkCode, self.StationCode, self.soln.stack_name, date.year, date.doy, r))
 
-    def save_parameters(self, cnn):
+    def parameter_rows(self, cnn=None):
+        """
+        :param cnn: connection to the database, needed to save the normal equations of PPP ETMs (see
+                    normal_equations_row)
+        :return: list of etms rows (dictionaries) with the estimated parameters. Empty if the parameters were loaded
+                 from the database
+        """
+        rows = []
+
         # only save the parameters when they've been estimated, not when loaded from database
         if self.param_origin == ESTIMATION:
-            # insert linear parameters
-            cnn.insert('etms', row=to_postgres(self.Linear.p.toDict()))
+            # linear parameters
+            rows.append(to_postgres(self.Linear.p.toDict()))
 
-            # insert jumps
+            # jumps
             for jump in self.Jumps.table:
                 if jump.fit:
-                    cnn.insert('etms', row=to_postgres(jump.p.toDict()))
+                    rows.append(to_postgres(jump.p.toDict()))
+
+            # periodic params
+            rows.append(to_postgres(self.Periodic.p.toDict()))
+
+            # variance factors
+            rows.append({'NetworkCode': self.NetworkCode, 'StationCode': self.StationCode, 'soln': self.soln.type,
+                         'object': 'var_factor', 'params': to_postgres(self.factor), 'hash': int(self.hash),
+                         'stack': self.soln.stack_name})
 
-            # insert periodic params
-            cnn.insert('etms', row=to_postgres(self.Periodic.p.toDict()))
+            # normal equations to update the parameters when new epochs are added
+            neq = self.normal_equations_row(cnn) if cnn is not None else None
 
-            # save the variance factors
-            cnn.query('INSERT INTO etms ("NetworkCode", "StationCode", soln, object, params, hash, stack) VALUES '
-                      '(\'%s\', \'%s\', \'%s\', \'var_factor\', \'%s\', %i, \'%s\')'
-                      % (self.NetworkCode, self.StationCode, self.soln.type, to_postgres(self.factor),
-                         self.hash, self.soln.stack_name))
+            if neq is not None:
+                rows.append(neq)
+
+        return rows
+
+    def save_parameters(self, cnn):
+
+        for row in self.parameter_rows(cnn):
+            cnn.insert('etms', row=row)
 
     def plot(self, pngfile=None, t_win=None, residuals=False, plot_missing=True,
              ecef=False, plot_outliers=True, fileio=None):
@@ -2184,89 +2836,86 @@ class ETM:
         # jmp = 'pre' returns the coordinate immediately before a jump
         # jmp = 'post' returns the coordinate immediately after a jump
         # jmp = None returns either the coordinate before or after, depending on the time of the jump.
+        # (the coordinate is the same in both cases: the date of the jump is returned in window)
+
+        xyz, sig, window, source = self.get_xyz_s_batch(pyDate.DateArray(year=[year], doy=[doy]), sigma_h, sigma_v,
+                                                        force_model)
+
+        return xyz, sig, window[0], source[0]
+
+    def get_xyz_s_batch(self, dates, sigma_h=SIGMA_FLOOR_H, sigma_v=SIGMA_FLOOR_V, force_model=False):
+        """
+        Vectorized version of get_xyz_s: obtain the X Y Z and sigmas of many dates at once. The model coordinates of
+        all the dates are obtained with a single matrix product
+        :param dates: pyDate.DateArray or list of pyDate.Date objects (only year and doy are used)
+        :param sigma_h: horizontal sigma floor
+        :param sigma_v: vertical sigma floor
+        :param force_model: return the ETM coordinate even if a valid solution exists
+        :return: xyz (3 x n), sigmas (3 x n), list of windows (date of the jump or None) and list of sources
+        """
+        if not isinstance(dates, pyDate.DateArray):
+            dates = pyDate.DateArray(year=[date.year for date in dates], doy=[date.doy for date in dates])
 
-        # find this epoch in the t vector
-        date = pyDate.Date(year=year, doy=doy)
-        window = None
+        mjd = dates.mjd
+        n = mjd.size
 
+        # jumps that produce a window
+        windows = dict()
         for jump in self.Jumps.table:
-            if jump.date == date and \
-                    jump.p.jump_type in (GENERIC_JUMP, CO_SEISMIC_JUMP_DECAY, ANTENNA_CHANGE, CO_SEISMIC_JUMP) \
-                    and jump.fit:
-                if np.sqrt(np.sum(np.square(jump.p.params[:, 0]))) > 0.02:
-                    window = jump.date
-                    # if no pre or post specified, then determine using the time of the jump
-                    if jmp is None:
-                        if (jump.date.datetime().hour + jump.date.datetime().minute / 60.0) < 12:
-                            jmp = 'post'
-                        else:
-                            jmp = 'pre'
-                    # use the previous or next date to get the APR
-                    # if jmp == 'pre':
-                    #    date -= 1
-                    # else:
-                    #    date += 1
+            if jump.p.jump_type in (GENERIC_JUMP, CO_SEISMIC_JUMP_DECAY, ANTENNA_CHANGE, CO_SEISMIC_JUMP) \
+                    and jump.fit and np.sqrt(np.sum(np.square(jump.p.params[:, 0]))) > 0.02:
+                windows[jump.date.mjd] = jump.date
 
-        index = np.where(self.soln.mjd == date.mjd)
-        index = index[0]
+        window = [windows.get(m) for m in mjd.tolist()]
 
-        neu = np.zeros((3, 1))
+        # find the epochs in the solution vector
+        order = np.argsort(self.soln.mjd, kind='mergesort')
+        smjd = self.soln.mjd[order]
+        pos = np.minimum(np.searchsorted(smjd, mjd), smjd.size - 1)
+        found = smjd[pos] == mjd
+        index = order[pos]
 
         L = self.L
         ref_pos = np.array([self.soln.auto_x, self.soln.auto_y, self.soln.auto_z])
+        name = self.soln.stack_name.upper()
 
-        if index.size and self.A is not None:
-            # found a valid epoch in the t vector
-            # now see if this epoch was filtered
-            if np.all(self.F[:, index]) and force_model is False:
-                # the coordinate is good
-                xyz = L[:, index]
-                sig = self.R[:, index]
-                source = self.soln.stack_name.upper() + ' with ETM solution: good'
+        xyz = np.zeros((3, n))
+        sig = np.zeros((3, n))
+        source = np.empty(n, dtype=object)
 
-            else:
-                # the coordinate is marked as bad
-                # get the requested epoch from the ETM
-                idt = np.argmin(np.abs(self.soln.ts - date.fyear))
+        if self.A is not None:
+            good = found.copy()
+            good[found] = np.all(self.F[:, index[found]], axis=0) & (force_model is False)
 
-                for i in range(3):
-                    neu[i] = np.dot(self.As[idt, :], self.C[i])
+            # epochs that come from the model: nearest epoch of the continuous time vector
+            model = np.logical_not(good)
 
-                xyz = self.rotate_2xyz(neu) + ref_pos
-                # Use the deviation from the ETM multiplied by 2.5 to estimate the error
-                sig = 2.5 * self.R[:, index]
-                source = self.soln.stack_name.upper() + ' with ETM solution: filtered'
+            if np.any(model):
+                ts = self.soln.ts
+                fyear = dates.fyear[model]
+                idt = np.minimum(np.searchsorted(ts, fyear), ts.size - 1)
+                # choose the previous epoch if it is closer (or equally close, like argmin)
+                prev = np.maximum(idt - 1, 0)
+                idt = np.where(np.abs(ts[prev] - fyear) <= np.abs(ts[idt] - fyear), prev, idt)
 
-        elif not index.size and self.A is not None:
+                neu = np.dot(self.As[idt, :], self.C.transpose()).transpose()
+                xyz[:, model] = self.rotate_2xyz(neu) + ref_pos
 
-            # the coordinate doesn't exist, get it from the ETM
-            idt = np.argmin(np.abs(self.soln.ts - date.fyear))
-            source = 'No ' + self.soln.stack_name.upper() + ' solution: ETM'
+            xyz[:, good] = L[:, index[good]]
+            sig[:, good] = self.R[:, index[good]]
+            source[good] = name + ' with ETM solution: good'
 
-            for i in range(3):
-                neu[i] = np.dot(self.As[idt, :], self.C[i])
+            # the coordinate is marked as bad: use the deviation from the ETM multiplied by 2.5 to estimate the error
+            filtered = np.logical_and(found, model)
+            sig[:, filtered] = 2.5 * self.R[:, index[filtered]]
+            source[filtered] = name + ' with ETM solution: filtered'
 
-            xyz = self.rotate_2xyz(neu) + ref_pos
-            # since there is no way to estimate the error,
+            # the coordinate doesn't exist: since there is no way to estimate the error,
             # use the nominal sigma multiplied by 2.5
-            sig = 2.5 * self.factor[:, np.newaxis]
+            missing = np.logical_not(found)
+            sig[:, missing] = 2.5 * np.array(self.factor, dtype=float)[:, np.newaxis]
+            source[missing] = 'No ' + name + ' solution: ETM'
 
-        elif index.size and self.A is None:
-
-            # no ETM (too few points), but we have a solution for the requested day
-            xyz = L[:, index]
-            # set the uncertainties in NEU by hand
-            sig = np.array([[9.99], [9.99], [9.99]])
-            source = self.soln.stack_name.upper() + ' solution, no ETM'
-
-        else:
-            # no ETM (too few points) and no solution for this day, get average
-            source = 'No ' + self.soln.stack_name.upper() + ' solution, no ETM: mean coordinate'
-            xyz = np.mean(L, axis=1)[:, np.newaxis]
-            # set the uncertainties in NEU by hand
-            sig = np.array([[9.99], [9.99], [9.99]])
-
-        if self.A is not None:
             # get the velocity of the site
             if np.sqrt(np.square(self.Linear.p.params[0, 1]) +
                        np.square(self.Linear.p.params[1, 1]) +
@@ -2274,12 +2923,23 @@ class ETM:
                 # fast moving station! bump up the sigma floor
                 sigma_h = 99.9
                 sigma_v = 99.9
-                source += '. fast moving station, bumping up sigmas'
+                source = np.array([src + '. fast moving station, bumping up sigmas' for src in source],
+                                  dtype=object)
+        else:
+            # no ETM (too few points): use the solution or the average coordinate
+            # set the uncertainties in NEU by hand
+            xyz[:, found] = L[:, index[found]]
+            source[found] = name + ' solution, no ETM'
+
+            xyz[:, np.logical_not(found)] = np.mean(L, axis=1)[:, np.newaxis]
+            source[np.logical_not(found)] = 'No ' + name + ' solution, no ETM: mean coordinate'
+
+            sig[:] = 9.99
 
         # apply floor sigmas
         sig = np.sqrt(np.square(sig) + np.square(np.array([[sigma_h], [sigma_h], [sigma_v]])))
 
-        return xyz, sig, window, source
+        return xyz, sig, window, source.tolist()
 
     def rotate_2neu(self, ecef):
 
@@ -2433,6 +3093,16 @@ class ETM:
         self.factor = factor
         self.P = np.array(p)
 
+    def normal_equations(self, Ai, A):
+        """
+        Return the NormalEquations object of design matrix Ai. The object is shared by the three components as long as
+        the design matrix does not change
+        """
+        if self.neq is None or self.neq.design is not Ai:
+            self.neq = NormalEquations(Ai, A)
+
+        return self.neq
+
     def adjust_lsq(self, Ai, Li):
 
         A = Ai(constrains=True)
@@ -2452,14 +3122,24 @@ class ETM:
 
         P = Ai.get_p(constrains=True)
 
+        neq = self.normal_equations(Ai, A) if self.solver == LSQ_NEQ else None
+
         while not cst_pass and iteration <= 10:
 
-            W = np.sqrt(P)
+            if neq is not None:
+                try:
+                    C = neq.solve(P, L)
+                except np.linalg.LinAlgError:
+                    # normal matrix is not positive definite: use the SVD solution from now on
+                    neq = None
+
+            if neq is None:
+                W = np.sqrt(P)
 
-            Aw = np.multiply(W[:, None], A)
-            Lw = np.multiply(W, L)
+                Aw = np.multiply(W[:, None], A)
+                Lw = np.multiply(W, L)
 
-            C = np.linalg.lstsq(Aw, Lw, rcond=-1)[0]
+                C = np.linalg.lstsq(Aw, Lw, rcond=-1)[0]
 
             v = L - np.dot(A, C)
 
@@ -2499,7 +3179,16 @@ class ETM:
         P[P < np.finfo(np.float).eps] = 1e-6
 
         # some statistics
-        SS = np.linalg.inv(np.dot(A.transpose(), np.multiply(P[:, None], A)))
+        SS = None
+        if neq is not None:
+            try:
+                # if the weights did not change after the last solution, the factorization is reused
+                SS = neq.inverse(P)
+            except np.linalg.LinAlgError:
+                pass
+
+        if SS is None:
+            SS = np.linalg.inv(np.dot(A.transpose(), np.multiply(P[:, None], A)))
 
         sigma = So*np.sqrt(np.diag(SS))
 
@@ -2548,21 +3237,26 @@ class ETM:
         """
 
         filt = self.F[0] * self.F[1] * self.F[2]
-        dates = [pyDate.Date(mjd=mjd) for mjd in self.soln.mjd[~filt]]
+        dates = pyDate.DateArray(mjd=self.soln.mjd[~filt]).dates()
 
         return [(net, stn, date) for net, stn, date in zip(repeat(self.NetworkCode), repeat(self.StationCode), dates)]
 
 
 class PPPETM(ETM):
 
-    def __init__(self, cnn, NetworkCode, StationCode, plotit=False, no_model=False, interseismic=None):
+    def __init__(self, cnn, NetworkCode, StationCode, plotit=False, no_model=False, interseismic=None,
+                 solver=LSQ_SVD, store=None, ppp_soln=None):
 
         # load all the PPP coordinates available for this station
         # exclude ppp solutions in the exclude table and any solution that is more than 100 meters from the auto coord
+        # (unless the solutions were already loaded using load_ppp_soln)
 
-        self.ppp_soln = PppSoln(cnn, NetworkCode, StationCode)
+        if ppp_soln is None:
+            self.ppp_soln = PppSoln(cnn, NetworkCode, StationCode, store)
+        else:
+            self.ppp_soln = ppp_soln
 
-        ETM.__init__(self, cnn, self.ppp_soln, no_model)
+        ETM.__init__(self, cnn, self.ppp_soln, no_model, solver=solver)
 
         # no offset applied
         self.L = np.array([self.soln.x,
@@ -2583,9 +3277,16 @@ class PPPETM(ETM):
 class GamitETM(ETM):
 
     def __init__(self, cnn, NetworkCode, StationCode, plotit=False,
-                 no_model=False, gamit_soln=None, stack_name=None, interseismic=None):
+                 no_model=False, gamit_soln=None, stack_name=None, interseismic=None, defer_adjustment=False,
+                 solver=LSQ_SVD, store=None, metadata=None):
 
-        if gamit_soln is None:
+        if gamit_soln is None and store is not None and store.has_station(NetworkCode, StationCode):
+            # read the stack time series from the time series store
+            self.polyhedrons = store.get_station(NetworkCode, StationCode)
+
+            self.gamit_soln = GamitSoln(cnn, self.polyhedrons, NetworkCode, StationCode, stack_name)
+
+        elif gamit_soln is None:
             self.polyhedrons = cnn.query_float('SELECT "X", "Y", "Z", "Year", "DOY" FROM stacks '
                                                'WHERE "name" = \'%s\' AND "NetworkCode" = \'%s\' AND '
                                                '"StationCode" = \'%s\' '
@@ -2598,7 +3299,8 @@ class GamitETM(ETM):
             # load the GAMIT polyhedrons
             self.gamit_soln = gamit_soln
 
-        ETM.__init__(self, cnn, self.gamit_soln, no_model, interseismic=interseismic)
+        ETM.__init__(self, cnn, self.gamit_soln, no_model, interseismic=interseismic, solver=solver,
+                     metadata=metadata)
 
         # no offset applied
         self.L = np.array([self.gamit_soln.x,
@@ -2613,10 +3315,13 @@ class GamitETM(ETM):
         if interseismic:
             self.l -= self.Linear.interseismic
 
-        self.run_adjustment(cnn, self.l, plotit, self.gamit_soln)
-        # save parameters to db
-        # the object will also save parameters if the list object is invoked
-        self.save_parameters(cnn)
+        # when defer_adjustment is True, the adjustment (and saving the parameters) is left to the caller, usually
+        # to process many stations at once using run_batch_adjustment
+        if not defer_adjustment:
+            self.run_adjustment(cnn, self.l, plotit, self.gamit_soln)
+            # save parameters to db
+            # the object will also save parameters if the list object is invoked
+            self.save_parameters(cnn)
 
     def get_etm_soln_list(self, use_ppp_model=False, cnn=None):
         # this function return the values of the ETM ONLY
@@ -2647,9 +3352,9 @@ class GamitETM(ETM):
                        for x, y, z, net_stn, year, doy, fyear in
                        zip(rxyz[0].tolist(), rxyz[1].tolist(), rxyz[2].tolist(),
                            repeat(self.NetworkCode + '.' + self.StationCode),
-                           [date.year for date in self.gamit_soln.date],
-                           [date.doy for date in self.gamit_soln.date],
-                           [date.fyear for date in self.gamit_soln.date])]
+                           self.gamit_soln.date.year.tolist(),
+                           self.gamit_soln.date.doy.tolist(),
+                           self.gamit_soln.date.fyear.tolist())]
         else:
             raise pyETMException_NoDesignMatrix('No design matrix available for %s.%s' %
                                                 (self.NetworkCode, self.StationCode))
@@ -2717,8 +3422,8 @@ class DailyRep(ETM):
                        zip(rxyz[0].tolist(), rxyz[1].tolist(), rxyz[2].tolist(),
                            px.tolist(), py.tolist(), pz.tolist(),
                            repeat(self.NetworkCode), repeat(self.StationCode),
-                           [date.year for date in self.gamit_soln.date],
-                           [date.doy for date in self.gamit_soln.date])]
+                           self.gamit_soln.date.year.tolist(),
+                           self.gamit_soln.date.doy.tolist())]
         else:
             raise pyETMException_NoDesignMatrix('No design matrix available for %s.%s' %
                                                    (self.NetworkCode, self.StationCode))
@@ -2745,3 +3450,481 @@ class FileETM(ETM):
                                             self.soln.z - self.soln.auto_z]))
 
         self.run_adjustment(cnn, self.l, plotit, poly_list)
+
+
+def lstsq_batch(Aw, Lw):
+    """
+    Stacked version of np.linalg.lstsq(Aw, Lw, rcond=-1): minimum norm solution of each system using the SVD. Singular
+    values below machine precision (relative to the largest one) are discarded, as done by LAPACK's gelsd. Zero padded
+    columns produce zero singular values and, therefore, zero parameters
+    :param Aw: array of shape (systems, rows, columns)
+    :param Lw: array of shape (systems, rows)
+    :return: array of shape (systems, columns) with the solution of each system
+    """
+    U, sv, Vt = np.linalg.svd(Aw, full_matrices=False)
+
+    cutoff = np.finfo(np.float).eps * np.max(sv, axis=1)[:, np.newaxis]
+    inv_s = np.zeros(sv.shape)
+    inv_s[sv > cutoff] = 1. / sv[sv > cutoff]
+
+    return np.einsum('nji,nj->ni', Vt, inv_s * np.einsum('nmj,nm->nj', U, Lw))
+
+
+def neq_batch(A, L, P, cols):
+    """
+    Stacked solution of the normal equations using the Cholesky factorization of each (scaled) normal matrix
+    :param A: array of shape (systems, rows, columns)
+    :param L: array of shape (systems, rows)
+    :param P: array of shape (systems, rows) with the weights
+    :param cols: mask of shape (systems, columns) with the columns that are not padding
+    :return: array of shape (systems, columns) with the solution of each system
+    """
+    k = A.shape[2]
+
+    N = np.einsum('nmi,nm,nmj->nij', A, P, A)
+    b = np.einsum('nmi,nm->ni', A, np.multiply(P, L))
+
+    # ones in the diagonal of the padded columns (b is zero there, so the parameters are zero)
+    N[:, np.arange(k), np.arange(k)] += np.logical_not(cols)
+
+    d = np.diagonal(N, axis1=1, axis2=2)
+    if np.any(d <= 0):
+        raise np.linalg.LinAlgError('Normal matrix has empty columns')
+
+    scale = 1. / np.sqrt(d)
+
+    # raises LinAlgError if any of the normal matrices is not positive definite
+    Lc = np.linalg.cholesky(N * scale[:, :, None] * scale[:, None, :])
+
+    y = np.linalg.solve(Lc, (scale * b)[:, :, None])
+
+    return scale * np.linalg.solve(np.transpose(Lc, (0, 2, 1)), y)[:, :, 0]
+
+
+def adjust_lsq_group(systems, solver=LSQ_SVD):
+    """
+    Robust least squares of a group of systems stacked into zero padded 3D arrays. The chi-square test and reweighting
+    is performed in lockstep: systems that pass the test are frozen while the rest continue iterating
+    :param systems: list of tuples (A, L, Ai) with A and L including the constrains and Ai the Design object
+    :param solver: LSQ_SVD or LSQ_NEQ. If the normal equations cannot be factorized, the SVD is used
+    :return: list with the output of ETM.adjust_lsq for each system
+    """
+    n = len(systems)
+    m = max([A.shape[0] for A, _, _ in systems])
+    k = max([A.shape[1] for A, _, _ in systems])
+
+    A = np.zeros((n, m, k))
+    L = np.zeros((n, m))
+    # masks of the rows and columns that belong to each system (the rest is padding)
+    rows = np.zeros((n, m), dtype=bool)
+    cols = np.zeros((n, k), dtype=bool)
+
+    for i, (Ac, Lc, _) in enumerate(systems):
+        A[i, :Ac.shape[0], :Ac.shape[1]] = Ac
+        L[i, :Ac.shape[0]] = Lc
+        rows[i, :Ac.shape[0]] = True
+        cols[i, :Ac.shape[1]] = True
+
+    dof = np.array([Ai.shape[0] - Ai.shape[1] for _, _, Ai in systems], dtype=float)
+    X1 = chi2.ppf(1 - 0.05 / 2, dof)
+    X2 = chi2.ppf(0.05 / 2, dof)
+
+    factor = np.ones(n)
+    So = np.ones(n)
+    C = np.zeros((n, k))
+    v = np.zeros((n, m))
+    s = np.zeros((n, m))
+
+    # padded rows have zero weight
+    P = rows.astype(float)
+
+    active = np.ones(n, dtype=bool)
+    iteration = 0
+
+    while np.any(active) and iteration <= 10:
+        a = np.where(active)[0]
+
+        if solver == LSQ_NEQ:
+            try:
+                C[a] = neq_batch(A[a], L[a], P[a], cols[a])
+            except np.linalg.LinAlgError:
+                # use the SVD solution from now on
+                solver = LSQ_SVD
+
+        if solver != LSQ_NEQ:
+            W = np.sqrt(P[a])
+
+            Aw = np.multiply(W[:, :, None], A[a])
+            Lw = np.multiply(W, L[a])
+
+            C[a] = lstsq_batch(Aw, Lw)
+
+        v[a] = L[a] - np.einsum('nmk,nk->nm', A[a], C[a])
+
+        # unit variance
+        So[a] = np.sqrt(np.sum(np.multiply(P[a], np.square(v[a])), axis=1) / dof[a])
+
+        x = np.power(So[a], 2) * dof[a]
+
+        # obtain the overall uncertainty predicted by lsq
+        factor[a] = factor[a] * So[a]
+
+        # calculate the normalized sigmas
+        s[a] = np.abs(np.divide(v[a], factor[a][:, np.newaxis]))
+
+        failed = np.logical_or(x < X2[a], x > X1[a])
+
+        # reweigh the systems that did not pass the Chi2 test (same as in ETM.adjust_lsq)
+        r = a[failed]
+        if r.size:
+            sw = np.power(10, LIMIT - s[r])
+            sw[sw < np.finfo(np.float).eps] = np.finfo(np.float).eps
+            f = np.where(s[r] > LIMIT, sw, 1.)
+
+            P[r] = np.square(np.divide(f, factor[r][:, np.newaxis])) * rows[r]
+
+        # systems that passed the test are done
+        active[a[np.logical_not(failed)]] = False
+
+        iteration += 1
+
+    # make sure there are no values below eps. Otherwise matrix becomes singular
+    P[np.logical_and(P < np.finfo(np.float).eps, rows)] = 1e-6
+
+    # some statistics: put ones in the diagonal of the padded columns to be able to invert the normal matrices
+    N = np.einsum('nmi,nm,nmj->nij', A, P, A)
+    N[:, np.arange(k), np.arange(k)] += np.logical_not(cols)
+
+    SS = np.linalg.inv(N)
+
+    sigma = So[:, np.newaxis] * np.sqrt(np.diagonal(SS, axis1=1, axis2=2))
+
+    results = []
+    for i, (Ac, _, Ai) in enumerate(systems):
+        mi, ki = Ac.shape
+        # mark observations with sigma <= LIMIT
+        index = Ai.remove_constrains(s[i, :mi] <= LIMIT)
+
+        results.append((C[i, :ki], sigma[i, :ki], index, Ai.remove_constrains(v[i, :mi]), factor[i], P[i, :mi]))
+
+    return results
+
+
+def adjust_lsq_batch(designs, observations, solver=LSQ_SVD):
+    """
+    Vectorized version of ETM.adjust_lsq. The systems are sorted by size and stacked in groups of at most
+    BATCH_MAX_SIZE elements to keep the zero padding and the memory footprint bounded
+    :param designs: list of Design objects
+    :param observations: list of observation vectors (one per Design object)
+    :param solver: LSQ_SVD or LSQ_NEQ
+    :return: list with the output of ETM.adjust_lsq (C, sigma, index, v, factor, P) for each system. If the
+             adjustment of a group fails (singular matrices) the items of the group are returned as None
+    """
+    systems = [(Ai(constrains=True), Ai.get_l(Li, constrains=True), Ai) for Ai, Li in zip(designs, observations)]
+
+    # sort by number of rows (largest first)
+    order = sorted(range(len(systems)), key=lambda i: systems[i][0].shape[0], reverse=True)
+
+    results = [None] * len(systems)
+
+    groups = []
+    group = []
+    for i in order:
+        if group:
+            m = systems[group[0]][0].shape[0]
+            k = max([systems[j][0].shape[1] for j in group + [i]])
+            if (len(group) + 1) * m * k > BATCH_MAX_SIZE:
+                groups.append(group)
+                group = []
+
+        group.append(i)
+
+    if group:
+        groups.append(group)
+
+    for group in groups:
+        try:
+            for i, result in zip(group, adjust_lsq_group([systems[j] for j in group], solver)):
+                results[i] = result
+
+        except np.linalg.LinAlgError as e:
+            logger.info('ETM -> Batch adjustment of %i systems failed (%s)' % (len(group), str(e)))
+
+    return results
+
+
+def run_batch_adjustment(cnn, etms, solver=LSQ_SVD):
+    """
+    Equivalent to calling ETM.run_adjustment for each ETM object in the list, but the least squares adjustments of
+    all the stations (and components) that need to be estimated are performed at once using adjust_lsq_batch. The ETM
+    objects should have been created with defer_adjustment=True. Parameters are not saved to the database.
+    :param cnn: connection to the database
+    :param etms: list of ETM objects
+    :param solver: LSQ_SVD or LSQ_NEQ
+    :return: list of ETM objects for which the adjustment could not be computed (their design matrix is set to None)
+    """
+    pending = []
+    failed = []
+
+    for etm in etms:
+        if etm.A is None:
+            logger.info('ETM -> Empty design matrix')
+        elif not etm.load_db_parameters(cnn, etm.l):
+            pending.append(etm)
+
+    j = 0
+    while pending and j < 10:
+
+        results = adjust_lsq_batch([etm.A for etm in pending for _ in range(3)],
+                                   [etm.l[i] for etm in pending for i in range(3)], solver)
+
+        redo = []
+        for k, etm in enumerate(pending):
+            adjustment = results[k * 3:k * 3 + 3]
+
+            try:
+                # systems that could not be solved in the batch are solved individually
+                adjustment = [etm.adjust_lsq(etm.A, etm.l[i]) if adjustment[i] is None else adjustment[i]
+                              for i in range(3)]
+
+            except np.linalg.LinAlgError as e:
+                logger.info('ETM -> Adjustment failed for %s.%s: %s' % (etm.NetworkCode, etm.StationCode, str(e)))
+                etm.A = None
+                failed.append(etm)
+                continue
+
+            if etm.apply_adjustment(adjustment, etm.soln):
+                redo.append(etm)
+
+        pending = redo
+        j += 1
+
+    for etm in etms:
+        if etm.A is not None:
+            # load the covariances using the correlations
+            etm.process_covariance()
+
+    return failed
+
+
+def etm_design(records, t):
+    """
+    Design matrix of the functional model saved in the etms records of a station (polynomial, fitted jumps and
+    periodic terms) evaluated at t. The columns are in the same order used by Design
+    :param records: etms records of the station
+    :param t: time vector (fractional years)
+    :return: design matrix and list of (record, column index) of each object
+    """
+    objects = [r for r in records if r['object'] == 'polynomial'] + \
+        sorted([r for r in records if r['object'] == 'jump'], key=lambda r: r['jump_date']) + \
+        [r for r in records if r['object'] == 'periodic']
+
+    columns = []
+    index = []
+
+    for r in objects:
+        if r['object'] == 'polynomial':
+            a = [np.power(t - r['t_ref'], p) for p in range(len(r['params']) / 3)]
+
+        elif r['object'] == 'jump':
+            date = pyDate.Date(datetime=r['jump_date']).fyear
+
+            ht = (t > date).astype(float)
+            hl = [np.log10(1. + np.maximum(t - date, 0) / T) for T in (r.get('relaxation') or [])]
+
+            if r['jump_type'] == CO_SEISMIC_DECAY:
+                a = hl
+            elif r['jump_type'] == CO_SEISMIC_JUMP_DECAY:
+                a = [ht] + hl
+            else:
+                a = [ht]
+
+        else:
+            f = np.array(r['frequencies'], dtype=float)
+            a = [sin(2 * pi * fi * 365.25 * t) for fi in f] + [cos(2 * pi * fi * 365.25 * t) for fi in f]
+
+        index.append((r, np.arange(len(columns), len(columns) + len(a))))
+        columns += a
+
+    return np.array(columns).reshape((len(columns), t.shape[0])).transpose(), index
+
+
+def update_ppp_etm(cnn, NetworkCode, StationCode):
+    """
+    Update the PPP ETM parameters of a station in the etms table with the solutions added after the last adjustment,
+    without loading the time series: only the new epochs are queried and added to the normal equations saved with the
+    parameters (see ETM.normal_equations_row). The epochs already in the normal equations are verified with the saved
+    digest. The update is not possible if the old epochs or the station metadata changed, if the new epochs add jumps
+    to the functional model or if the updated solution does not pass the chi-square test or has unrealistic decays. In
+    those cases the parameters have to be estimated by PPPETM, which also builds the time series used for plots and
+    outlier detection. The parameters updated here are loaded from the database by PPPETM (the hash values match)
+    :param cnn: connection to the database
+    :param NetworkCode: network code
+    :param StationCode: station code
+    :return: True if the parameters in the etms table are up to date, False if PPPETM has to estimate them
+    """
+    where = '"NetworkCode" = \'%s\' AND "StationCode" = \'%s\'' % (NetworkCode, StationCode)
+
+    records = cnn.query_float('SELECT * FROM etms WHERE %s AND soln = \'ppp\' AND stack = \'ppp\'' % where,
+                              as_dict=True)
+
+    neq = [r for r in records if r['object'] == 'neq']
+
+    if len(neq) != 1:
+        return False
+
+    neq = neq[0]
+    meta = json.loads(neq['metadata'])
+
+    # the station metadata and the epochs in the normal equations should not have changed
+    if etm_stamp(cnn, NetworkCode, StationCode) != meta['stamp'] or \
+            ppp_digest(cnn, NetworkCode, StationCode, meta['last']) != (meta['digest'], meta['frames']):
+        logger.info('ETM -> %s.%s: station metadata or solutions changed, estimating parameters'
+                    % (NetworkCode, StationCode))
+        return False
+
+    rs = cnn.query_float('SELECT p."X", p."Y", p."Z", p."Year", p."DOY", p."ReferenceFrame", e."Year" IS NOT NULL '
+                         'FROM ppp_soln p LEFT JOIN ppp_soln_excl e ON '
+                         'p."NetworkCode" = e."NetworkCode" AND p."StationCode" = e."StationCode" AND '
+                         'p."Year" = e."Year" AND p."DOY" = e."DOY" '
+                         'WHERE p."NetworkCode" = \'%s\' AND p."StationCode" = \'%s\' AND '
+                         'p."Year" * 1000 + p."DOY" > %i ORDER BY p."Year", p."DOY"'
+                         % (NetworkCode, StationCode, meta['last']))
+
+    if not rs:
+        # no new epochs
+        return True
+
+    if any([r[5] not in meta['frames'] for r in rs]):
+        # a new reference frame adds a jump
+        return False
+
+    stn = cnn.query_float('SELECT * FROM stations WHERE %s' % where, as_dict=True)[0]
+
+    lat = np.array([float(stn['lat'])])
+    lon = np.array([float(stn['lon'])])
+    auto = np.array([[float(stn['auto_x'])], [float(stn['auto_y'])], [float(stn['auto_z'])]])
+    max_dist = stn['max_dist'] if stn['max_dist'] is not None else 20
+
+    # exclude the solutions in the exclude table and the blunders (same as PppSoln)
+    table = np.array([r[0:5] for r in rs if not r[6]], dtype=float).reshape((-1, 5)).transpose()
+
+    valid = np.sqrt(np.sum(np.square(table[0:3] - auto), axis=0)) <= max_dist
+
+    solutions = meta['solutions'] + table.shape[1]
+    mjd = list(meta['mjd'])
+    t = np.array([])
+    l = np.zeros((3, 0))
+
+    if np.any(valid):
+        table = table[:, valid]
+
+        date = pyDate.DateArray(year=table[3], doy=table[4])
+        t = date.fyear
+        mjd[1] = int(date.mjd.max())
+
+        # jumps after the last epoch or new earthquakes change the functional model
+        if (meta['pending'] is not None and t.max() > meta['pending']) or \
+                count_events(cnn, lat[0], lon[0], meta['t'][0], t.max()) != meta['events']:
+            return False
+
+        l = np.array(ct2lg(table[0] - auto[0], table[1] - auto[1], table[2] - auto[2], lat, lon))
+
+    A, index = etm_design([r for r in records if r['object'] not in ('neq', 'var_factor')], t)
+
+    k = meta['columns']
+
+    if A.shape[1] != k or any([cols.size * 3 != len(r['params']) for r, cols in index]):
+        return False
+
+    params = np.array(neq['params'], dtype=float)
+
+    N = params[0:3 * k * k].reshape((3, k, k))
+    b = params[3 * k * k:3 * k * (k + 1)].reshape((3, k))
+    lpl, pfac, factor = params[3 * k * (k + 1):].reshape((3, 3))
+
+    rows = meta['rows'] + t.size
+    dof = (rows - k)
+    X1 = chi2.ppf(1 - 0.05 / 2, dof)
+    X2 = chi2.ppf(0.05 / 2, dof)
+
+    C = np.zeros((3, k))
+    S = np.zeros((3, k))
+
+    try:
+        for i in range(3):
+            # weights of the new observations using the previous solution (as done when the parameters are loaded
+            # from the database)
+            s = np.abs(np.divide(l[i] - np.dot(A, np.linalg.solve(N[i], b[i])), factor[i]))
+
+            f = np.ones((t.size,))
+            sw = np.power(10, LIMIT - s[s > LIMIT])
+            sw[sw < np.finfo(np.float).eps] = np.finfo(np.float).eps
+            f[s > LIMIT] = sw
+
+            P = np.square(np.divide(f, pfac[i]))
+
+            N[i] += np.dot(A.transpose(), np.multiply(P[:, None], A))
+            b[i] += np.dot(A.transpose(), np.multiply(P, l[i]))
+            lpl[i] += np.dot(l[i], np.multiply(P, l[i]))
+
+            SS = np.linalg.inv(N[i])
+            C[i] = np.dot(SS, b[i])
+
+            # unit variance
+            So = np.sqrt(max(lpl[i] - 2 * np.dot(C[i], b[i]) + np.dot(C[i], np.dot(N[i], C[i])), 0) / dof)
+
+            x = np.power(So, 2) * dof
+
+            if x < X2 or x > X1:
+                logger.info('ETM -> %s.%s: updated solution did not pass the chi-square test, estimating parameters'
+                            % (NetworkCode, StationCode))
+                return False
+
+            factor[i] = pfac[i] * So
+            S[i] = So * np.sqrt(np.diag(SS))
+
+    except np.linalg.LinAlgError:
+        return False
+
+    # unrealistic decays are removed by the full adjustment (see ETM.apply_adjustment)
+    for r, cols in index:
+        if r['object'] == 'jump' and r['jump_type'] in (CO_SEISMIC_JUMP_DECAY, CO_SEISMIC_DECAY) \
+                and np.any(np.abs(C[:, cols[-len(r['relaxation']):]]) > 0.5):
+            return False
+
+    # hash of the time series that PPPETM will build (see PppSoln)
+    hash_sum = cnn.query_float('SELECT sum(hash) FROM ppp_soln p1 '
+                               'WHERE p1."NetworkCode" = \'%s\' AND p1."StationCode" = \'%s\''
+                               % (NetworkCode, StationCode))
+
+    soln_hash = ppp_soln_hash(solutions, auto[0], auto[1], auto[2], mjd[0], mjd[1], hash_sum[0][0])
+
+    meta.update({'rows': rows, 'last': int(max([r[3] * 1000 + r[4] for r in rs])), 'solutions': solutions,
+                 'mjd': mjd})
+
+    if t.size:
+        meta.update({'t': [meta['t'][0], float(max(meta['t'][1], t.max()))]})
+
+    meta['digest'], meta['frames'] = ppp_digest(cnn, NetworkCode, StationCode, meta['last'])
+
+    cnn.begin_transac()
+
+    for r, cols in index:
+        cnn.query('UPDATE etms SET params = \'%s\', sigmas = \'%s\' WHERE %s AND soln = \'ppp\' AND stack = \'ppp\' '
+                  'AND object = \'%s\' AND hash = %i'
+                  % (to_postgres(C[:, cols]), to_postgres(S[:, cols]), where, r['object'], r['hash']))
+
+    cnn.query('UPDATE etms SET params = \'%s\', hash = %i WHERE %s AND soln = \'ppp\' AND stack = \'ppp\' '
+              'AND object = \'var_factor\'' % (to_postgres(factor), soln_hash, where))
+
+    cnn.query('UPDATE etms SET params = \'%s\', metadata = \'%s\', hash = %i WHERE %s AND soln = \'ppp\' '
+              'AND stack = \'ppp\' AND object = \'neq\''
+              % (to_postgres(np.concatenate((N.flatten(), b.flatten(), lpl, pfac, factor))), json.dumps(meta),
+                 soln_hash, where))
+
+    cnn.commit_transac()
+
+    logger.info('ETM -> %s.%s: parameters updated with %i new epochs' % (NetworkCode, StationCode, t.size))
+
+    return True
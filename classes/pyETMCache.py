@@ -0,0 +1,224 @@
+"""
+Project: Parallel.GAMIT
+
+Two level cache of fitted ETM objects: an in-process LRU and an on-disk store with the pickled ETMs (fitted
+parameters, design matrices, covariances and solution arrays). An entry is valid while the stamp of the station does
+not change. The stamp is the md5 of everything that goes into the ETM hash (station record, solutions, excluded
+solutions, station information, etm_params, earthquakes and the pyETM version) and is obtained with a single
+aggregate query, so a ready ETM is returned without loading the solutions or building the ETM again.
+
+The etms table is not part of the stamp: it is written by the ETM itself when it is fitted (from the same inputs that
+go into the stamp), so including it would invalidate the entry created by that same fit. A cache hit returns the ETM
+without touching the etms table, which is intended: the rows written when the ETM was fitted are still valid.
+
+ETMs are pickled without the connection to the database (see StationInfo.__getstate__). If an ETM can't be saved
+to the on-disk store, the fitted ETM is still returned (and kept in the in-process LRU).
+
+The on-disk store is enabled with the etm_cache option in the archive section of gnss_data.cfg
+"""
+
+import os
+import ConfigParser
+import cPickle as pickle
+from collections import OrderedDict
+from zlib import crc32
+import pyETM
+
+# number of ETMs kept in memory by each process
+CACHE_SIZE = 256
+
+
+class pyETMCacheException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return str(self.value)
+
+
+class EtmCache(object):
+
+    def __init__(self, path=None, size=CACHE_SIZE):
+        """
+        :param path: directory of the on-disk store. If None, only the in-process LRU is used
+        :param size: number of ETMs kept in memory
+        """
+        self.path = path
+        self.size = size
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def stamp(cnn, NetworkCode, StationCode, soln, stack_name=None):
+        """
+        Obtain the stamp of the input data of an ETM with a single query
+        :param cnn: connection to the database
+        :param NetworkCode: network code
+        :param StationCode: station code
+        :param soln: 'ppp' or 'gamit'
+        :param stack_name: name of the stack (gamit only)
+        :return: md5 string
+        """
+        where = '"NetworkCode" = \'%s\' AND "StationCode" = \'%s\'' % (NetworkCode, StationCode)
+
+        if soln == 'ppp':
+            data = 'SELECT count(*) || \',\' || sum("X" + "Y" + "Z") || \',\' || sum(hash) || \',\' || ' \
+                   'max("Year" * 1000 + "DOY") || \',\' || string_agg(DISTINCT "ReferenceFrame", \',\') ' \
+                   'FROM ppp_soln WHERE %s), (SELECT string_agg(e::text, \',\' ORDER BY "Year", "DOY") ' \
+                   'FROM ppp_soln_excl e WHERE %s' % (where, where)
+        else:
+            data = 'SELECT count(*) || \',\' || sum("X" + "Y" + "Z") || \',\' || max("Year" * 1000 + "DOY") ' \
+                   'FROM stacks WHERE %s AND "name" = \'%s\'' % (where, stack_name)
+
+        rs = cnn.query_float('SELECT md5(concat_ws(\'|\', '
+                             '(SELECT s::text FROM stations s WHERE %s), '
+                             '(%s), '
+                             '(SELECT count(*) FROM rinex_proc WHERE %s), '
+                             '(SELECT string_agg(i::text, \',\' ORDER BY "DateStart") FROM stationinfo i WHERE %s), '
+                             '(SELECT string_agg(p::text, \',\' ORDER BY p::text) FROM etm_params p WHERE %s), '
+                             '(SELECT count(*) || \',\' || max(date) FROM earthquakes))) as stamp'
+                             % (where, data, where, where, where), as_dict=True)
+
+        return rs[0]['stamp'] + pyETM.VERSION
+
+    @staticmethod
+    def key(NetworkCode, StationCode, soln, stack_name=None, no_model=False, interseismic=None):
+
+        return '%s.%s.%s.%s.%i.%i' % (NetworkCode, StationCode, soln, stack_name, no_model,
+                                      crc32(repr(interseismic)) & 0xffffffff)
+
+    def filename(self, key):
+        return os.path.join(self.path, key.split('.')[0], key + '.etm')
+
+    def get(self, key, stamp):
+        """
+        Look for an ETM in the in-process LRU and then in the on-disk store
+        :return: ETM object or None if not found or if the stamp does not match
+        """
+        if key in self.memory:
+            entry = self.memory.pop(key)
+
+            if entry[0] == stamp:
+                # move to the end of the LRU
+                self.memory[key] = entry
+                self.hits += 1
+                return entry[1]
+
+        if self.path is not None and os.path.isfile(self.filename(key)):
+            try:
+                with open(self.filename(key), 'rb') as f:
+                    entry = pickle.load(f)
+            except Exception:
+                # corrupted or incompatible file: rebuild the ETM
+                entry = (None, None)
+
+            if entry[0] == stamp:
+                self.remember(key, entry)
+                self.hits += 1
+                return entry[1]
+
+        self.misses += 1
+        return None
+
+    def remember(self, key, entry):
+
+        self.memory[key] = entry
+
+        while len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+
+    def put(self, key, stamp, etm):
+
+        self.remember(key, (stamp, etm))
+
+        if self.path is not None:
+            filename = self.filename(key)
+
+            if not os.path.isdir(os.path.dirname(filename)):
+                try:
+                    os.makedirs(os.path.dirname(filename))
+                except OSError:
+                    # another process created the directory
+                    pass
+
+            # write to a temporary file and rename to avoid partial reads by other processes
+            tmp = '%s.%i' % (filename, os.getpid())
+
+            try:
+                with open(tmp, 'wb') as f:
+                    pickle.dump((stamp, etm), f, pickle.HIGHEST_PROTOCOL)
+
+                os.rename(tmp, filename)
+
+            except Exception:
+                # the ETM could not be saved (e.g. an object that can't be pickled): keep it only in memory
+                if os.path.isfile(tmp):
+                    os.remove(tmp)
+
+    def ppp_etm(self, cnn, NetworkCode, StationCode, no_model=False, interseismic=None, **kwargs):
+        """
+        Obtain a PPPETM from the cache or create it (and save it in the cache)
+        :param kwargs: other arguments passed to pyETM.PPPETM (e.g. store or ppp_soln)
+        """
+        key = self.key(NetworkCode, StationCode, 'ppp', 'ppp', no_model, interseismic)
+        stamp = self.stamp(cnn, NetworkCode, StationCode, 'ppp')
+
+        etm = self.get(key, stamp)
+
+        if etm is None:
+            etm = pyETM.PPPETM(cnn, NetworkCode, StationCode, False, no_model, interseismic, **kwargs)
+            self.put(key, stamp, etm)
+
+        return etm
+
+    def gamit_etm(self, cnn, NetworkCode, StationCode, stack_name, no_model=False, interseismic=None, **kwargs):
+        """
+        Obtain a GamitETM of a stack from the cache or create it (and save it in the cache)
+        :param kwargs: other arguments passed to pyETM.GamitETM (e.g. gamit_soln or store)
+        """
+        key = self.key(NetworkCode, StationCode, 'gamit', stack_name, no_model, interseismic)
+        stamp = self.stamp(cnn, NetworkCode, StationCode, 'gamit', stack_name)
+
+        etm = self.get(key, stamp)
+
+        if etm is None:
+            etm = pyETM.GamitETM(cnn, NetworkCode, StationCode, False, no_model, stack_name=stack_name,
+                                 interseismic=interseismic, **kwargs)
+            self.put(key, stamp, etm)
+
+        return etm
+
+
+# cache of this process (see get_cache)
+_cache = None
+
+
+def get_cache(configfile='gnss_data.cfg'):
+    """
+    Obtain the ETM cache of this process. The on-disk store is used if etm_cache is set in the archive section of the
+    configuration file
+    """
+    global _cache
+
+    if _cache is None:
+        path = None
+
+        if os.path.isfile(configfile):
+            config = ConfigParser.ConfigParser()
+            config.readfp(open(configfile))
+
+            if config.has_option('archive', 'etm_cache') and config.get('archive', 'etm_cache').strip():
+                path = os.path.expandvars(config.get('archive', 'etm_cache').strip())
+
+        _cache = EtmCache(path)
+
+    return _cache
+
+
+def ppp_etm(cnn, NetworkCode, StationCode, no_model=False, interseismic=None, **kwargs):
+    return get_cache().ppp_etm(cnn, NetworkCode, StationCode, no_model, interseismic, **kwargs)
+
+
+def gamit_etm(cnn, NetworkCode, StationCode, stack_name, no_model=False, interseismic=None, **kwargs):
+    return get_cache().gamit_etm(cnn, NetworkCode, StationCode, stack_name, no_model, interseismic, **kwargs)
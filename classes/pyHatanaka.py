@@ -0,0 +1,899 @@
+"""
+Project: Parallel.Archive
+
+In-process Hatanaka compression of RINEX observation files: decoder and encoder of Compact RINEX (CRINEX 1.0 for
+RINEX 2 and CRINEX 3.0 for RINEX 3) and of the LZW stream of UNIX compress (.Z). CRINEZ files (.??d.Z) can be read
+and written without running CRX2RNX, RNX2CRX, compress or uncompress (and without temporary files). The .Z streams
+are compressed and decompressed in chunks, so the files are never held in memory.
+
+open_rinex returns a file-like object: reading gives the lines of the RINEX file (the input can be RINEX, CRINEX,
+.Z or .gz) and writing takes the lines of a RINEX file and compresses them according to the extension of the file.
+"""
+
+import os
+import gzip
+import datetime
+import numpy as np
+from itertools import chain
+from cStringIO import StringIO
+
+VERSION = 'pyHatanaka 1.0'
+
+# order of the differences used by the encoder for the observations and the receiver clock offset
+DATA_ORDER = 3
+CLOCK_ORDER = 2
+
+# maximum number of bits of the LZW codes
+LZW_BITS = 16
+LZW_MAGIC = '\x1f\x9d'
+LZW_BLOCK_MODE = 0x80
+LZW_CLEAR = 256
+# number of bytes read (or compressed) at once by the streaming decoder (encoder)
+LZW_CHUNK = 1 << 20
+
+
+class pyHatanakaException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return str(self.value)
+
+
+def text_diff(old, new):
+    """
+    Text difference of CRINEX: characters equal to the old string are replaced with spaces and characters that
+    changed to a space are replaced with &. Trailing spaces are removed
+    """
+    if old == new:
+        return ''
+
+    diff = []
+    for i, c in enumerate(new):
+        if i < len(old):
+            if c == old[i]:
+                c = ' '
+            elif c == ' ':
+                c = '&'
+        diff.append(c)
+
+    # characters of the old string after the end of the new string
+    diff.extend(' ' if c == ' ' else '&' for c in old[len(new):])
+
+    return ''.join(diff).rstrip()
+
+
+def text_repair(old, diff):
+    """
+    Inverse of text_diff: rebuild the new string using the old string and the difference
+    """
+    if not diff:
+        return old
+
+    chars = list(old)
+    for i, c in enumerate(diff):
+        if i >= len(chars):
+            chars.append(' ' if c == '&' else c)
+        elif c != ' ':
+            chars[i] = ' ' if c == '&' else c
+
+    return ''.join(chars)
+
+
+def parse_value(field, decimals):
+    """
+    Convert a fixed decimals field (e.g. '  23619095.450') to an integer (23619095450)
+    """
+    field = field.strip()
+    point = field.find('.')
+
+    if point >= 0 and len(field) - point - 1 == decimals:
+        return int(field[:point] + field[point + 1:])
+    else:
+        return int(round(float(field) * 10 ** decimals))
+
+
+def format_value(value, decimals, width):
+    """
+    Inverse of parse_value: format an integer with implicit decimals right aligned to width. The values of RINEX
+    (F14.3 and F15.12) have less significant digits than a double, so the conversion to float is exact
+    """
+    return '%*.*f' % (width, decimals, value / 10. ** decimals)
+
+
+class Arc(object):
+    """
+    Differences of an observable (or the receiver clock offset) along an arc of continuous data. The order of the
+    differences increases by one each epoch up to order
+    """
+    def __init__(self, order, value):
+        self.order = order
+        self.diffs = [value]
+
+    def decode(self, diff):
+        diffs = self.diffs
+
+        if len(diffs) <= self.order:
+            diffs.append(0)
+
+        m = len(diffs) - 1
+        diffs[m] = diff
+        for i in range(m - 1, -1, -1):
+            diffs[i] += diffs[i + 1]
+
+        return diffs[0]
+
+    def encode(self, value):
+        diffs = self.diffs
+
+        if len(diffs) <= self.order:
+            diffs.append(0)
+
+        # the differences are replaced in place (old is the previous difference of order i - 1)
+        old = diffs[0]
+        diffs[0] = value
+        for i in range(1, len(diffs)):
+            old, diffs[i] = diffs[i], diffs[i - 1] - old
+
+        return diffs[-1]
+
+
+def parse_obs_types(line, obs_types, system):
+    """
+    Add the observation types of a RINEX 2 or 3 header line to obs_types
+    :return: system of the line (RINEX 3 continuation lines have a blank system)
+    """
+    label = line[60:80].strip()
+
+    if label == '# / TYPES OF OBSERV':
+        obs_types.setdefault(' ', []).extend(line[6:60].split())
+
+    elif label == 'SYS / # / OBS TYPES':
+        if line[0] != ' ':
+            system = line[0]
+        obs_types.setdefault(system, []).extend(line[7:60].split())
+
+    return system
+
+
+class LineStream(object):
+    """
+    Read-only file-like object over a generator of lines
+    """
+    def __init__(self, lines, source=None):
+        self.lines = lines
+        self.source = source
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self.lines)
+
+    def readline(self):
+        return next(self.lines, '')
+
+    def readlines(self):
+        return list(self.lines)
+
+    def read(self):
+        return ''.join(self.lines)
+
+    def close(self):
+        if self.source is not None and hasattr(self.source, 'close'):
+            self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class CrinexReader(LineStream):
+    """
+    Decoder of CRINEX 1.0 and 3.0: iterating over this object gives the lines of the RINEX file
+    """
+    def __init__(self, lines, source=None):
+        self.input = iter(lines)
+        self.rinex_version = None
+        self.obs_types = dict()
+
+        LineStream.__init__(self, self.decode(), source)
+
+    def read_line(self):
+
+        line = next(self.input, None)
+
+        if line is None:
+            raise pyHatanakaException('Unexpected end of CRINEX file')
+
+        return line.rstrip('\r\n')
+
+    def decode(self):
+
+        line = next(self.input, '')
+
+        if line[60:80].strip() != 'CRINEX VERS   / TYPE':
+            raise pyHatanakaException('Not a CRINEX file: could not find CRINEX VERS / TYPE')
+
+        # CRINEX PROG / DATE
+        self.read_line()
+
+        # the RINEX header is not compressed
+        system = ' '
+        for line in self.input:
+            if line[60:80].strip() == 'RINEX VERSION / TYPE':
+                self.rinex_version = float(line[0:9])
+
+            system = parse_obs_types(line, self.obs_types, system)
+
+            yield line
+
+            if line[60:80].strip() == 'END OF HEADER':
+                break
+
+        if self.rinex_version is None:
+            raise pyHatanakaException('Invalid CRINEX header: could not find RINEX VERSION / TYPE')
+
+        rinex2 = self.rinex_version < 3
+        # positions of the event flag, number of satellites and satellite list in the epoch record
+        flag_col, sats_col = (28, 32) if rinex2 else (31, 41)
+
+        epoch = ''
+        clock = None
+        sats = dict()
+
+        for line in self.input:
+            line = line.rstrip('\r\n')
+
+            try:
+                if line[0:1] in ('&', '>'):
+                    # initialization of the compression
+                    epoch = (' ' + line[1:]) if line[0] == '&' else line
+                    clock = None
+                    sats = dict()
+                else:
+                    epoch = text_repair(epoch, line)
+
+                flag = int(epoch[flag_col])
+                n = int(epoch[flag_col + 1:flag_col + 4])
+            except (ValueError, IndexError):
+                raise pyHatanakaException('Invalid CRINEX epoch record: ' + line)
+
+            if 1 < flag < 6:
+                # event: the special records are not compressed
+                yield epoch[0:flag_col + 4].rstrip() + '\n'
+
+                for i in range(n):
+                    yield self.read_line() + '\n'
+
+                continue
+
+            try:
+                # receiver clock offset
+                line = self.read_line()
+
+                if not line:
+                    clock = None
+                elif line[1:2] == '&':
+                    clock = Arc(int(line[0]), int(line[2:]))
+                else:
+                    clock.decode(int(line))
+
+                # satellites (the ones that are not in the previous epoch start new arcs)
+                epoch_sats = [epoch[i:i + 3] for i in range(sats_col, sats_col + 3 * n, 3)]
+
+                records = []
+                new_sats = dict()
+                for sat in epoch_sats:
+                    ntype = len(self.obs_types[' ' if rinex2 else sat[0]])
+
+                    arcs, flags = sats.get(sat, ([None] * ntype, ''))
+
+                    fields = self.read_line().split(' ', ntype)
+
+                    values = []
+                    for j in range(ntype):
+                        field = fields[j] if j < len(fields) else ''
+
+                        if not field:
+                            arcs[j] = None
+                            values.append(' ' * 14)
+                        elif field[1:2] == '&':
+                            arcs[j] = Arc(int(field[0]), int(field[2:]))
+                            values.append(format_value(arcs[j].diffs[0], 3, 14))
+                        else:
+                            values.append(format_value(arcs[j].decode(int(field)), 3, 14))
+
+                    flags = text_repair(flags, fields[ntype] if len(fields) > ntype else '').ljust(2 * ntype)
+                    new_sats[sat] = (arcs, flags)
+
+                    records.append([values[j] + flags[2 * j:2 * j + 2] for j in range(ntype)])
+
+                sats = new_sats
+
+            except (ValueError, IndexError, KeyError, AttributeError, TypeError):
+                raise pyHatanakaException('Invalid CRINEX data in epoch: ' + epoch)
+
+            if rinex2:
+                sat_list = ''.join(epoch_sats)
+
+                record = epoch[0:32] + sat_list[0:36]
+                if clock is not None:
+                    record = record.ljust(68) + format_value(clock.diffs[0], 9, 12)
+                yield record.rstrip() + '\n'
+
+                for i in range(36, len(sat_list), 36):
+                    yield ' ' * 32 + sat_list[i:i + 36] + '\n'
+
+                for obs in records:
+                    for i in range(0, len(obs), 5):
+                        yield ''.join(obs[i:i + 5]).rstrip() + '\n'
+            else:
+                record = epoch[0:35]
+                if clock is not None:
+                    record = record.ljust(41) + format_value(clock.diffs[0], 12, 15)
+                yield record.rstrip() + '\n'
+
+                for sat, obs in zip(epoch_sats, records):
+                    yield (sat + ''.join(obs)).rstrip() + '\n'
+
+
+class CrinexWriter(object):
+    """
+    Encoder of CRINEX 1.0 (RINEX 2) and 3.0 (RINEX 3): a file-like object that takes the lines of a RINEX file and
+    writes the CRINEX file to output
+    """
+    def __init__(self, output):
+        self.output = output
+        self.buffer = ''
+        self.header = []
+        self.rinex_version = None
+        self.obs_types = dict()
+        self.system = ' '
+        # lines of the epoch being read and number of lines that are still missing
+        self.block = None
+        self.missing = 0
+
+        # compression state
+        self.epoch = None
+        self.clock = None
+        self.sats = dict()
+
+    def write(self, text):
+
+        lines = (self.buffer + text).split('\n')
+        self.buffer = lines.pop()
+
+        for line in lines:
+            self.process(line.rstrip('\r'))
+
+    def writelines(self, lines):
+
+        for line in lines:
+            self.write(line)
+
+    def process(self, line):
+
+        if self.header is not None:
+            # RINEX header
+            self.header.append(line)
+
+            if line[60:80].strip() == 'RINEX VERSION / TYPE':
+                self.rinex_version = float(line[0:9])
+
+            self.system = parse_obs_types(line, self.obs_types, self.system)
+
+            if line[60:80].strip() == 'END OF HEADER':
+                if self.rinex_version is None:
+                    raise pyHatanakaException('Invalid RINEX header: could not find RINEX VERSION / TYPE')
+
+                crinex = '1.0' if self.rinex_version < 3 else '3.0'
+
+                self.emit('%-20s%-40s%-20s' % (crinex, 'COMPACT RINEX FORMAT', 'CRINEX VERS   / TYPE'))
+                self.emit('%-40s%-20s%-20s' % (VERSION, datetime.datetime.utcnow().strftime('%d-%b-%y %H:%M'),
+                                               'CRINEX PROG / DATE'))
+                for record in self.header:
+                    self.emit(record)
+
+                self.header = None
+
+        elif self.block is not None:
+            self.block.append(line)
+            self.missing -= 1
+
+            if not self.missing:
+                self.encode(self.block)
+                self.block = None
+
+        elif line.strip():
+            # epoch record
+            try:
+                if self.rinex_version < 3:
+                    flag = int(line[28:29])
+                    n = int(line[29:32])
+                    lines_per_sat = (len(self.obs_types[' ']) + 4) / 5
+                    missing = n * lines_per_sat + max(n - 1, 0) / 12 if flag <= 1 or flag == 6 else n
+                else:
+                    if line[0] != '>':
+                        raise ValueError
+                    flag = int(line[31:32])
+                    n = int(line[32:35])
+                    missing = n
+            except (ValueError, KeyError):
+                raise pyHatanakaException('Invalid RINEX epoch record: ' + line)
+
+            self.block = [line]
+            self.missing = missing
+
+            if not missing:
+                self.encode(self.block)
+                self.block = None
+
+    def emit(self, line):
+        self.output.write(line + '\n')
+
+    def encode(self, block):
+
+        line = block[0]
+        rinex2 = self.rinex_version < 3
+
+        flag = int(line[28:29] if rinex2 else line[31:32])
+
+        if 1 < flag < 6:
+            # events are written as initialization records followed by the special records
+            self.emit(('&' + line[1:] if rinex2 else line).rstrip())
+            for record in block[1:]:
+                self.emit(record)
+
+            self.epoch = None
+            return
+
+        n = int(line[29:32] if rinex2 else line[32:35])
+
+        if rinex2:
+            cont = max(n - 1, 0) / 12
+            sat_list = ''.join(record[32:68].rstrip() for record in block[0:cont + 1])
+            sats = [sat_list[i:i + 3] for i in range(0, 3 * n, 3)]
+            epoch = line[0:32] + sat_list
+            clock = line[68:80].strip()
+            decimals = 9
+
+            lines_per_sat = (len(self.obs_types[' ']) + 4) / 5
+            lines = block[cont + 1:]
+            records = [''.join(record.ljust(80) for record in lines[i * lines_per_sat:(i + 1) * lines_per_sat])
+                       for i in range(n)]
+        else:
+            sats = [record[0:3] for record in block[1:]]
+            epoch = line[0:35].ljust(41) + ''.join(sats)
+            clock = line[41:56].strip()
+            decimals = 12
+
+            records = [record[3:] for record in block[1:]]
+
+        if self.epoch is None:
+            # initialization of the compression
+            self.emit('&' + epoch[1:] if rinex2 else epoch)
+            self.clock = None
+            self.sats = dict()
+        else:
+            self.emit(text_diff(self.epoch, epoch))
+
+        self.epoch = epoch
+
+        # receiver clock offset
+        if not clock:
+            self.clock = None
+            self.emit('')
+        else:
+            value = parse_value(clock, decimals)
+
+            if self.clock is None:
+                self.clock = Arc(CLOCK_ORDER, value)
+                self.emit('%i&%i' % (CLOCK_ORDER, value))
+            else:
+                self.emit('%i' % self.clock.encode(value))
+
+        new_sats = dict()
+        for sat, record in zip(sats, records):
+            ntype = len(self.obs_types[' ' if rinex2 else sat[0]])
+            record = record.ljust(16 * ntype)
+
+            arcs, flags = self.sats.get(sat, ([None] * ntype, ''))
+
+            fields = []
+            for j in range(ntype):
+                field = record[16 * j:16 * j + 14]
+
+                if not field.strip():
+                    arcs[j] = None
+                    fields.append('')
+                elif arcs[j] is None:
+                    arcs[j] = Arc(DATA_ORDER, parse_value(field, 3))
+                    fields.append('%i&%i' % (DATA_ORDER, arcs[j].diffs[0]))
+                else:
+                    fields.append('%i' % arcs[j].encode(parse_value(field, 3)))
+
+            new_flags = ''.join(record[16 * j + 14:16 * j + 16] for j in range(ntype))
+            diff = text_diff(flags, new_flags)
+
+            new_sats[sat] = (arcs, new_flags)
+
+            if diff:
+                self.emit(' '.join(fields) + ' ' + diff)
+            else:
+                self.emit(' '.join(fields).rstrip())
+
+        self.sats = new_sats
+
+    def close(self):
+
+        if self.buffer:
+            self.process(self.buffer.rstrip('\r'))
+            self.buffer = ''
+
+        if self.header is not None or self.block is not None:
+            self.abort()
+            raise pyHatanakaException('Incomplete RINEX file: could not compress')
+
+        if hasattr(self.output, 'close'):
+            self.output.close()
+
+    def abort(self):
+        """
+        Discard the data that was not written and remove the output file (so that a truncated CRINEX is never left
+        behind when the compression fails)
+        """
+        self.buffer = ''
+        self.block = None
+
+        if hasattr(self.output, 'abort'):
+            self.output.abort()
+
+        elif hasattr(self.output, 'close'):
+            self.output.close()
+
+            filename = getattr(self.output, 'name', None)
+            if isinstance(filename, str) and os.path.isfile(filename):
+                os.remove(filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def lzw_decompress_iter(stream, chunk_size=LZW_CHUNK):
+    """
+    Decompress a UNIX compress (.Z) stream reading it in chunks, so that the file is never held in memory
+    :param stream: file-like object with the .Z stream
+    :param chunk_size: number of bytes read from the stream each time
+    :return: generator of the uncompressed data (strings)
+    """
+    header = stream.read(3)
+
+    if header[0:2] != LZW_MAGIC or len(header) < 3:
+        raise pyHatanakaException('Not a UNIX compress (.Z) stream')
+
+    maxbits = ord(header[2]) & 0x1f
+    block_mode = ord(header[2]) & LZW_BLOCK_MODE
+    maxmaxcode = 1 << maxbits
+
+    if maxbits < 9 or maxbits > 16:
+        raise pyHatanakaException('Invalid number of bits in .Z stream: %i' % maxbits)
+
+    table = [chr(i) for i in range(256)] + ([''] if block_mode else [])
+    free_ent = len(table)
+    prev = None
+
+    n_bits = 9
+    # number of codes that are left with the current number of bits (None: start of a new group of codes)
+    remaining = None
+
+    # bytes that were not decoded yet: they always start at the beginning of a group of 8 codes
+    data = ''
+    eof = False
+
+    while True:
+        if not eof and len(data) < chunk_size:
+            chunk = stream.read(chunk_size)
+            eof = not chunk
+            data += chunk
+            continue
+
+        # the codes are written in groups of 8 codes of n_bits (n_bits bytes). The group is completed (padding) when
+        # the number of bits changes or after a CLEAR code
+        if remaining is None:
+            remaining = (1 << n_bits) - free_ent + (1 if prev is None else 0) if n_bits < maxbits else -1
+
+        # only decode complete groups, unless the end of the stream was reached
+        available = (len(data) * 8) // n_bits if eof else (len(data) // n_bits) * 8
+
+        count = available if remaining < 0 else min(remaining, available)
+
+        if count <= 0:
+            break
+
+        # padding to always read three bytes for each code
+        buf = np.frombuffer(data[0:(count * n_bits + 7) // 8] + '\x00' * 3, dtype=np.uint8).astype(np.uint32)
+
+        bits = np.arange(count, dtype=np.int64) * n_bits
+        idx = bits >> 3
+        codes = ((buf[idx] | (buf[idx + 1] << 8) | (buf[idx + 2] << 16)) >> (bits & 7).astype(np.uint32)) \
+            & ((1 << n_bits) - 1)
+        codes = codes.tolist()
+
+        clear = codes.index(LZW_CLEAR) if block_mode and LZW_CLEAR in codes else -1
+        if clear >= 0:
+            codes = codes[:clear]
+
+        out = []
+        for code in codes:
+            if code < free_ent and (prev is not None or code < 256):
+                entry = table[code]
+            elif code == free_ent and prev is not None:
+                entry = prev + prev[0]
+            else:
+                raise pyHatanakaException('Corrupted .Z stream')
+
+            if prev is not None and free_ent < maxmaxcode:
+                table.append(prev + entry[0])
+                free_ent += 1
+
+            out.append(entry)
+            prev = entry
+
+        if clear >= 0:
+            # the table is reset and the next code is read with 9 bits after the end of the group
+            data = data[((clear + 8) // 8) * n_bits:]
+            del table[256:]
+            free_ent = 256
+            n_bits = 9
+            remaining = None
+        else:
+            data = data[((count + 7) // 8) * n_bits:]
+
+            if remaining > 0:
+                remaining -= count
+
+                if not remaining:
+                    n_bits += 1
+                    remaining = None
+
+        yield ''.join(out)
+
+
+def lzw_decompress(data):
+    """
+    Decompress a UNIX compress (.Z) stream
+    :param data: contents of the .Z file
+    :return: uncompressed string
+    """
+    return ''.join(lzw_decompress_iter(StringIO(data)))
+
+
+class LzwCompressor(object):
+    """
+    Incremental encoder of the UNIX compress (.Z) format (block mode, the table is not cleared when full). The codes
+    are packed in groups of 8 codes (a whole number of bytes), so the output of each call can be written right away
+    """
+    def __init__(self, maxbits=LZW_BITS):
+        self.maxbits = maxbits
+        self.maxmaxcode = 1 << maxbits
+
+        self.table = dict((chr(i), i) for i in range(256))
+        self.free_ent = LZW_CLEAR + 1
+        self.w = ''
+        # codes that were not packed yet and number of codes packed so far
+        self.codes = []
+        self.packed = 0
+        self.header = LZW_MAGIC + chr(LZW_BLOCK_MODE | maxbits)
+
+    def compress(self, data):
+        """
+        :param data: string to compress
+        :return: compressed data of the complete groups of codes
+        """
+        table = self.table
+        codes = self.codes
+        free_ent = self.free_ent
+
+        w = self.w
+        for c in data:
+            wc = w + c
+            if wc in table:
+                w = wc
+            else:
+                codes.append(table[w])
+
+                if free_ent < self.maxmaxcode:
+                    table[wc] = free_ent
+                    free_ent += 1
+                w = c
+
+        self.w = w
+        self.free_ent = free_ent
+
+        return self.pack(len(codes) - len(codes) % 8)
+
+    def flush(self):
+        """
+        :return: compressed data of the codes that are left (end of the stream)
+        """
+        if self.w:
+            self.codes.append(self.table[self.w])
+            self.w = ''
+
+        return self.pack(len(self.codes))
+
+    def pack(self, count):
+
+        # the header goes with the first block
+        header = self.header
+        self.header = ''
+
+        codes = np.array(self.codes[0:count], dtype=np.int64)
+        del self.codes[0:count]
+
+        # number of bits of each code: 9 bits for the first 256 codes, 10 bits for the next 512, etc. Since the number
+        # of codes of each width is a multiple of 8, the groups of codes are always complete when the width changes
+        widths = np.minimum(np.floor(np.log2(self.packed + np.arange(count) + 256.)).astype(np.int64) + 1,
+                            self.maxbits)
+
+        self.packed += count
+
+        bits = np.cumsum(widths) - widths
+        nbytes = (int(np.sum(widths)) + 7) // 8
+
+        idx = bits >> 3
+        values = codes << (bits & 7)
+
+        out = np.zeros(nbytes + 3)
+        for b in range(3):
+            out += np.bincount(idx + b, weights=(values >> (8 * b)) & 255, minlength=nbytes + 3)
+
+        return header + out[0:nbytes].astype(np.uint8).tostring()
+
+
+def lzw_compress(data, maxbits=LZW_BITS):
+    """
+    Compress a string using the UNIX compress (.Z) format (block mode, the table is not cleared when full)
+    :param data: string to compress
+    :param maxbits: maximum number of bits of the codes
+    :return: compressed string
+    """
+    compressor = LzwCompressor(maxbits)
+
+    return compressor.compress(data) + compressor.flush()
+
+
+def split_lines(chunks):
+    """
+    Split a stream of strings into lines (keeping the end of line)
+    """
+    rest = ''
+    for chunk in chunks:
+        lines = (rest + chunk).split('\n')
+        rest = lines.pop()
+
+        for line in lines:
+            yield line + '\n'
+
+    if rest:
+        yield rest
+
+
+class LzwWriter(object):
+    """
+    File-like object that writes a UNIX compress (.Z) file. The data is compressed as it is written (in chunks of
+    LZW_CHUNK bytes). If the writer is aborted (or an exception is raised inside a with statement) the file is removed
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'wb')
+        self.compressor = LzwCompressor()
+        self.data = []
+        self.size = 0
+
+    def write(self, text):
+        self.data.append(text)
+        self.size += len(text)
+
+        if self.size >= LZW_CHUNK:
+            self.file.write(self.compressor.compress(''.join(self.data)))
+            self.data = []
+            self.size = 0
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def close(self):
+        if not self.file.closed:
+            try:
+                self.file.write(self.compressor.compress(''.join(self.data)) + self.compressor.flush())
+            except Exception:
+                self.abort()
+                raise
+
+            self.data = []
+            self.file.close()
+
+    def abort(self):
+        """
+        Discard the data and remove the file
+        """
+        self.data = []
+
+        if not self.file.closed:
+            self.file.close()
+
+            if os.path.isfile(self.filename):
+                os.remove(self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def is_crinex(filename):
+
+    name = os.path.basename(filename).lower()
+
+    for ext in ('.z', '.gz'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+
+    return name.endswith('d') or name.endswith('.crx')
+
+
+def open_rinex(filename, mode='r'):
+    """
+    Open a RINEX observation file compressed (or not) with Hatanaka, compress (.Z) or gzip (.gz)
+    :param filename: path to the file
+    :param mode: 'r' returns a file-like object with the lines of the RINEX file (CRINEX is detected from the
+                 header). 'w' returns a file-like object that takes the lines of a RINEX file and writes them
+                 compressed according to the extension of filename (Hatanaka for .??d or .crx, compress for .Z
+                 and gzip for .gz)
+    """
+    if mode == 'r':
+        if filename.endswith('.Z'):
+            source = open(filename, 'rb')
+            lines = split_lines(lzw_decompress_iter(source))
+        else:
+            source = gzip.open(filename, 'rb') if filename.endswith('.gz') else open(filename, 'r')
+            lines = iter(source)
+
+        first = next(lines, '')
+        lines = chain([first], lines)
+
+        if first[60:80].strip() == 'CRINEX VERS   / TYPE':
+            return CrinexReader(lines, source)
+        else:
+            return LineStream(lines, source)
+
+    elif mode == 'w':
+        if filename.endswith('.Z'):
+            output = LzwWriter(filename)
+        elif filename.endswith('.gz'):
+            output = gzip.open(filename, 'wb')
+        else:
+            output = open(filename, 'w')
+
+        if is_crinex(filename):
+            return CrinexWriter(output)
+        else:
+            return output
+
+    else:
+        raise pyHatanakaException('Invalid mode ' + str(mode))
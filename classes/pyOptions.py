@@ -39,7 +39,10 @@ class ReadOptions:
                         'atx': None,
                         'height_codes': None,
                         'ppp_exe': None,
-                        'ppp_remote_local': ()}
+                        'ppp_remote_local': (),
+                        'ts_store': None,
+                        'etm_cache': None,
+                        'shared_tmp': None}
 
         config = ConfigParser.ConfigParser()
         config.readfp(open(configfile))
@@ -14,12 +14,15 @@ import os
 import pyDate
 import pyRunWithRetry
 import pyStationInfo
+import pyHatanaka
 import datetime
 import Utils
 import uuid
 import re
 import struct
 import unicodedata
+import numpy as np
+from itertools import islice
 
 TYPE_CRINEZ = 0
 TYPE_RINEX = 1
@@ -42,6 +45,22 @@ def check_year(year):
     return year
 
 
+def rinex3_to_2_obs(obs_types):
+    # translate RINEX 3 observation codes to their RINEX 2 names (e.g. C1C -> C1, C2W -> P2, L2W -> L2)
+    observables = []
+
+    for code in obs_types:
+        if code[0] == 'C' and code[2:3] in ('P', 'W', 'Y', 'M'):
+            obs = 'P' + code[1]
+        else:
+            obs = code[0:2]
+
+        if obs not in observables:
+            observables.append(obs)
+
+    return observables
+
+
 def create_unzip_script(run_file_path):
     # temporary script to uncompress o.Z files
     # requested by RS issue #13
@@ -362,15 +381,15 @@ class ReadRinex(RinexRecord):
 
             self.header = new_header
 
-            # add new header
-            rinex = new_header + self.data
+            # replace the header and stream the data of the current file (which might have been edited after the
+            # data was read)
+            with open(self.rinex_path, 'r') as fileio, open(self.rinex_path + '.t', 'w') as out:
+                self.scan_header(fileio)
 
-            try:
-                f = open(self.rinex_path, 'w')
-                f.writelines(rinex)
-                f.close()
-            except Exception:
-                raise
+                out.writelines(new_header)
+                out.writelines(fileio)
+
+            move(self.rinex_path + '.t', self.rinex_path)
 
     def read_data(self):
         try:
@@ -426,23 +445,9 @@ class ReadRinex(RinexRecord):
 
         return new_header
 
-    def __purge_comments(self, header):
-
-        new_header = []
-
-        for line in header:
-            if not line.strip().endswith('COMMENT'):
-                new_header += [line]
-
-        self.log_event('Purged all COMMENTs from RINEX header.')
-
-        return new_header
-
     def purge_comments(self):
 
-        new_header = self.__purge_comments(self.header)
-
-        self.write_rinex(new_header)
+        self.transform(purge_comments=True)
 
     def check_interval(self):
 
@@ -622,6 +627,21 @@ class ReadRinex(RinexRecord):
 
     def Uncompress(self):
 
+        try:
+            # decompress in-process reading the origin file directly
+            with pyHatanaka.open_rinex(self.origin_file) as src, open(self.rinex_path, 'w') as dst:
+                dst.writelines(src)
+            return
+
+        except Exception as e:
+            self.log_event('In-process decompression failed (%s) -> using the external tools' % str(e))
+
+            if os.path.isfile(self.rinex_path):
+                os.remove(self.rinex_path)
+
+            # the external tools work on a local copy of the origin file
+            copy(self.origin_file, self.rootdir)
+
         if self.origin_type in (TYPE_CRINEZ, TYPE_CRINEX):
 
             size = os.path.getsize(self.local_copy)
@@ -673,8 +693,9 @@ class ReadRinex(RinexRecord):
             # if all ok, move converted file to rinex_path
             os.remove(self.rinex_path)
             move(self.rinex_path + '.t', self.rinex_path)
-            # change version
+            # change version and reload the header
             self.rinex_version = 2.11
+            self.header = self.get_header()
 
             self.log_event('Origin file was RINEX 3 -> Converted to 2.11')
 
@@ -732,9 +753,10 @@ class ReadRinex(RinexRecord):
 
         self.IdentifyFile(origin_file)
 
-        copy(origin_file, self.rootdir)
-
-        if self.origin_type in (TYPE_CRINEZ, TYPE_CRINEX, TYPE_RINEZ):
+        # compressed files are read directly from the origin (no local copy needed, see Uncompress)
+        if self.origin_type is TYPE_RINEX:
+            copy(origin_file, self.rootdir)
+        else:
             self.Uncompress()
 
         # check basic infor in the rinex header to avoid problems with RinSum
@@ -743,10 +765,10 @@ class ReadRinex(RinexRecord):
         if self.rinex_version >= 3:
             self.ConvertRinex3to2()
 
-        # process the output
-        self.parse_output(self.RunRinSum())
+        # get the information of the file (epochs, interval, etc)
+        self.read_summary()
 
-        # DDG: new interval checking after running RinSum
+        # DDG: new interval checking after reading the summary
         # check the sampling interval
         self.check_interval()
 
@@ -922,21 +944,7 @@ class ReadRinex(RinexRecord):
             self.log_event('Problem parsing epochs, setting to 0')
 
         # stop here is epochs of interval is invalid
-        if self.interval == 0:
-            if self.epochs > 0:
-                raise pyRinexExceptionSingleEpoch('RINEX interval equal to zero. Single epoch or bad RINEX file. '
-                                                  'Reported epochs in file were %s' % (self.epochs))
-            else:
-                raise pyRinexExceptionSingleEpoch('RINEX interval equal to zero. Single epoch or bad RINEX file. '
-                                                  'No epoch information to report. The output from RinSum was:\n' +
-                                                  output)
-
-        elif self.interval > 120:
-            raise pyRinexExceptionBadFile('RINEX sampling interval > 120s. The output from RinSum was:\n' + output)
-
-        elif self.epochs * self.interval < 3600:
-            raise pyRinexExceptionBadFile('RINEX file with < 1 hr of observation time. '
-                                          'The output from RinSum was:\n' + output)
+        self.check_epochs('The output from RinSum was:\n' + output)
 
         try:
             yy, mm, dd, hh, MM, ss = [int(x) for x in re.findall(r'^Computed first epoch:\s*(\d+)\/(\d+)\/(\d+)'
@@ -1006,6 +1014,264 @@ class ReadRinex(RinexRecord):
         self.antType = self.antType.decode('utf-8', 'ignore').encode('utf-8')
         self.antDome = self.antDome.decode('utf-8', 'ignore').encode('utf-8')
 
+    def check_epochs(self, details):
+
+        if self.interval == 0:
+            if self.epochs > 0:
+                raise pyRinexExceptionSingleEpoch('RINEX interval equal to zero. Single epoch or bad RINEX file. '
+                                                  'Reported epochs in file were %s' % (self.epochs))
+            else:
+                raise pyRinexExceptionSingleEpoch('RINEX interval equal to zero. Single epoch or bad RINEX file. '
+                                                  'No epoch information to report. ' + details)
+
+        elif self.interval > 120:
+            raise pyRinexExceptionBadFile('RINEX sampling interval > 120s. ' + details)
+
+        elif self.epochs * self.interval < 3600:
+            raise pyRinexExceptionBadFile('RINEX file with < 1 hr of observation time. ' + details)
+
+    def read_summary(self):
+        """
+        Obtain the information of the RINEX file (epochs, interval, first and last epoch, observables and header
+        records) using the native reader. RinSum is only executed if the native reader fails to parse the file
+        """
+        try:
+            summary = self.scan_rinex()
+        except Exception as e:
+            self.log_event('Native RINEX reader failed (%s) -> using RinSum' % str(e))
+            self.parse_output(self.RunRinSum())
+        else:
+            self.parse_summary(summary)
+
+    @staticmethod
+    def scan_header(fileio):
+        """
+        Read the header of an open RINEX 2 or 3 observation file
+        :return: list with the header lines, dictionary with the header records (first occurrence of each label) and
+                 dictionary with the observation types of each system (' ' for RINEX 2)
+        """
+        lines = []
+        header = dict()
+        obs_types = dict()
+        system = ' '
+
+        for line in fileio:
+            lines.append(line)
+            label = line[60:80].strip()
+
+            if label == 'END OF HEADER':
+                break
+
+            elif label == '# / TYPES OF OBSERV':
+                # RINEX 2: observation types common to all systems (continuation lines have a blank count)
+                obs_types.setdefault(' ', []).extend(line[6:60].split())
+
+            elif label == 'SYS / # / OBS TYPES':
+                # RINEX 3: observation types of each system
+                if line[0] != ' ':
+                    system = line[0]
+                obs_types.setdefault(system, []).extend(line[7:60].split())
+
+            elif label not in header:
+                header[label] = line
+        else:
+            raise pyRinexExceptionBadFile('Invalid header: could not find END OF HEADER tag.')
+
+        if 'RINEX VERSION / TYPE' not in header:
+            raise pyRinexExceptionBadFile('Invalid header: could not find RINEX VERSION / TYPE')
+
+        return lines, header, obs_types
+
+    @staticmethod
+    def epoch_records(fileio, version, obs_types, payload=True):
+        """
+        Walk the epoch records of an open RINEX file (after reading the header), handling the event flags
+        :param fileio: open file positioned after the END OF HEADER
+        :param version: RINEX version
+        :param obs_types: observation types returned by scan_header
+        :param payload: if False, the lines after each epoch record are skipped without reading them
+        :return: generator of tuples (epoch record, flag, number of satellites or special records, epoch in seconds
+                 since 0001-01-01 or None for events, list with the lines that follow the epoch record or None)
+        """
+        days = dict()
+
+        if version < 3:
+            # lines used by the observations of each satellite (5 observations per line)
+            lines_per_sat = (len(obs_types[' ']) + 4) / 5
+        else:
+            lines_per_sat = 1
+
+        for line in fileio:
+            if version < 3:
+                flag = int(line[28:29])
+                n = int(line[29:32])
+
+                # RINEX 2 records have no marker: check the satellite list to detect a desynchronized reader
+                if line[26:28] != '  ' or flag > 6 or \
+                        ((flag <= 1 or flag == 6) and len(line[32:68].rstrip()) != 3 * min(n, 12)):
+                    raise pyRinexExceptionBadFile('Unexpected epoch record: ' + line.rstrip())
+            else:
+                if not line.startswith('>'):
+                    # not an epoch record
+                    continue
+                flag = int(line[31:32])
+                n = int(line[32:35])
+
+            epoch = None
+
+            if flag <= 1 or flag == 6:
+                # n satellites with observations. In RINEX 2 the list of satellites continues in other lines
+                # if there are more than 12 satellites
+                skip = n * lines_per_sat + (max(n - 1, 0) / 12 if version < 3 else 0)
+
+                if version < 3:
+                    date = (check_year(int(line[1:3])), int(line[4:6]), int(line[7:9]))
+                    sod = int(line[10:12]) * 3600 + int(line[13:15]) * 60 + float(line[15:26])
+                else:
+                    date = (int(line[2:6]), int(line[7:9]), int(line[10:12]))
+                    sod = int(line[13:15]) * 3600 + int(line[16:18]) * 60 + float(line[18:29])
+
+                if date not in days:
+                    days[date] = datetime.date(*date).toordinal()
+
+                epoch = days[date] * 86400. + sod
+            else:
+                # event: n special records follow the epoch record
+                skip = n
+
+            if payload:
+                lines = list(islice(fileio, skip))
+            else:
+                lines = None
+                if skip:
+                    # consume the lines without parsing them
+                    next(islice(fileio, skip, skip), None)
+
+            yield line, flag, n, epoch, lines
+
+    def scan_rinex(self):
+        """
+        Streaming reader of RINEX 2 and 3 observation files. Reads the header and walks the epoch records without
+        parsing the observations, which are skipped
+        :return: dictionary with the header records, the observation types of each system, the RINEX version and an
+                 array with the epochs (seconds since 0001-01-01)
+        """
+        with open(self.rinex_path, 'r') as fileio:
+            _, header, obs_types = self.scan_header(fileio)
+
+            version = float(header['RINEX VERSION / TYPE'][0:9])
+
+            epochs = [epoch for _, flag, _, epoch, _ in self.epoch_records(fileio, version, obs_types, False)
+                      if flag <= 1]
+
+        return {'header': header, 'obs_types': obs_types, 'version': version, 'epochs': np.array(epochs)}
+
+    def load_epochs(self, epochs):
+        """
+        Set the number of epochs, the interval and the first and last observation from an array of epochs
+        :param epochs: epochs in seconds since 0001-01-01
+        """
+        self.epochs = float(epochs.size)
+
+        # the interval is the most frequent separation between epochs (rounded to the millisecond)
+        dt = np.round(np.diff(epochs), 3)
+        dt = dt[dt > 0]
+
+        if dt.size:
+            values, counts = np.unique(dt, return_counts=True)
+            self.interval = float(values[np.argmax(counts)])
+        else:
+            self.interval = 0
+            self.log_event('Problem interval, setting to 0')
+
+        if epochs.size:
+            first, last = [datetime.datetime.fromordinal(int(t // 86400)) +
+                           datetime.timedelta(seconds=int(np.floor(t % 86400 + 1e-3)))
+                           for t in (epochs.min(), epochs.max())]
+
+            self.datetime_firstObs = first
+            self.firstObs = self.datetime_firstObs.strftime('%Y/%m/%d %H:%M:%S')
+            self.datetime_lastObs = last
+            self.lastObs = self.datetime_lastObs.strftime('%Y/%m/%d %H:%M:%S')
+
+    def parse_summary(self, summary):
+
+        header = summary['header']
+
+        try:
+            line = header['APPROX POSITION XYZ']
+            self.x, self.y, self.z = [float(line[i:i + 14]) for i in (0, 14, 28)]
+            self.lat, self.lon, self.h = ecef2lla([self.x, self.y, self.z])
+        except Exception:
+            self.x, self.y, self.z = (None, None, None)
+
+        try:
+            line = header['ANTENNA: DELTA H/E/N']
+            self.antOffset, self.antOffsetN, self.antOffsetE = [float(line[i:i + 14]) for i in (0, 14, 28)]
+        except Exception:
+            self.antOffset, self.antOffsetN, self.antOffsetE = (0, 0, 0)
+            self.log_event('Problem parsing ANTENNA OFFSETS, setting to 0')
+
+        try:
+            line = header['REC # / TYPE / VERS']
+            self.recNo, self.recType, self.recVers = [line[i:i + 20].strip() for i in (0, 20, 40)]
+        except Exception:
+            self.recNo, self.recType, self.recVers = ('', '', '')
+            self.log_event('Problem parsing REC # / TYPE / VERS, setting to EMPTY')
+
+        try:
+            self.marker_number = header['MARKER NUMBER'][0:20].strip()
+        except Exception:
+            self.marker_number = 'NOT FOUND'
+            self.log_event('No MARKER NUMBER found, setting to NOT FOUND')
+
+        try:
+            line = header['ANT # / TYPE']
+            self.antNo, AntDome = line[0:20].strip(), line[20:40].strip()
+
+            if ' ' in AntDome:
+                self.antType = AntDome.split()[0]
+                self.antDome = AntDome.split()[1]
+            else:
+                self.antType = AntDome
+                self.antDome = 'NONE'
+                self.log_event('No dome found, set to NONE')
+
+        except Exception:
+            self.antNo, self.antType, self.antDome = ('UNKNOWN', 'UNKNOWN', 'NONE')
+            self.log_event('Problem parsing ANT # / TYPE, setting to UNKNOWN NONE')
+
+        self.load_epochs(summary['epochs'])
+
+        self.check_epochs('Native reader found %i epochs in %s' % (self.epochs, self.rinex))
+
+        if self.datetime_lastObs <= self.datetime_firstObs:
+            # bad rinex! first obs > last obs
+            raise pyRinexExceptionBadFile('Last observation (' + self.lastObs + ') <= first observation (' +
+                                          self.firstObs + ')')
+
+        self.size = os.path.getsize(self.rinex_path)
+
+        # observables of GPS using the RINEX 2 names
+        if summary['version'] < 3:
+            observables = summary['obs_types'].get(' ', [])
+        else:
+            observables = rinex3_to_2_obs(summary['obs_types'].get('G', []))
+
+        self.obs_types = len(observables)
+        self.observables = observables
+
+        if not observables:
+            self.log_event('Problem parsing observation types, setting to 0')
+
+        # remove non-utf8 chars
+        self.recNo   = self.recNo.decode('utf-8', 'ignore').encode('utf-8')
+        self.recType = self.recType.decode('utf-8', 'ignore').encode('utf-8')
+        self.recVers = self.recVers.decode('utf-8', 'ignore').encode('utf-8')
+        self.antNo   = self.antNo.decode('utf-8', 'ignore').encode('utf-8')
+        self.antType = self.antType.decode('utf-8', 'ignore').encode('utf-8')
+        self.antDome = self.antDome.decode('utf-8', 'ignore').encode('utf-8')
+
     def get_firstobs(self):
 
         if self.rinex_version < 3:
@@ -1076,15 +1342,22 @@ class ReadRinex(RinexRecord):
             # allow multiday files (will not change the answer), just get a coordinate for this file
             rnx = ReadRinex(self.NetworkCode, self.StationCode, self.rinex_path, allow_multiday=True)
 
+            decimate = None
+            systems = None
+
             if rnx.interval < 15:
-                rnx.decimate(30)
+                decimate = 30
                 self.log_event('Decimating to 30 seconds to run auto_coord')
 
             # remove the other systems that sh_rx2apr does not use
             if rnx.system is 'M':
-                rnx.remove_systems()
+                systems = ('R', 'E', 'S')
                 self.log_event('Removing systems S, R and E to run auto_coord')
 
+            if decimate or systems:
+                # apply both edits in a single pass
+                rnx.transform(decimate=decimate, remove_systems=systems)
+
         except pyRinexException as e:
             # print str(e)
             # ooops, something went wrong, try with local file (without removing systems or decimating)
@@ -1152,9 +1425,264 @@ class ReadRinex(RinexRecord):
 
         raise pyRinexExceptionNoAutoCoord(str(out) + '\nLIMIT FOR CHI**2 was %i' % chi_limit)
 
+    def transform(self, start=None, end=None, decimate=None, remove_systems=None, purge_comments=False, copyto=None):
+        """
+        Apply a set of edits to the RINEX file in a single streaming pass (read and write), instead of running
+        teqc or RinEdit once for each edit. The edits can be combined freely
+        :param start: datetime of the first epoch to keep (None: no limit)
+        :param end: datetime of the last epoch to keep (None: no limit)
+        :param decimate: new sampling interval in seconds (epochs not at a multiple of the interval are removed)
+        :param remove_systems: systems to remove (e.g. ('R', 'E', 'S'))
+        :param purge_comments: remove the COMMENT records (header and events)
+        :param copyto: write the result to copyto instead of replacing the current RINEX file. When copyto is passed,
+                       the information of the current object is not modified. If copyto is a CRINEZ / CRINEX file
+                       and the in-process compression fails, the file is compressed using rnx2crz / rnx2crx
+        :return: path of the output file
+        """
+        systems = tuple(remove_systems) if remove_systems else ()
+
+        # epoch limits in seconds since 0001-01-01 (same as the epochs of epoch_records)
+        limits = [None if d is None else d.toordinal() * 86400. + d.hour * 3600 + d.minute * 60 + d.second
+                  for d in (start, end)]
+
+        output = copyto if copyto is not None else self.rinex_path + '.t'
+
+        try:
+            new_header, epochs = self.edit_records(output, limits, decimate, systems, purge_comments)
+
+        except pyRinexException:
+            raise
+
+        except Exception as e:
+            if copyto is None or not (output.endswith('.Z') or pyHatanaka.is_crinex(output)):
+                # not compressed by pyHatanaka: nothing to fall back to
+                raise
+
+            self.log_event('In-process compression of %s failed (%s) -> using the external tools'
+                           % (os.path.basename(output), str(e)))
+
+            # write the plain RINEX with the edits and compress it using rnx2crz / rnx2crx
+            tmpdir = os.path.join(self.rootdir, str(uuid.uuid4()))
+            os.makedirs(tmpdir)
+            try:
+                plain = os.path.join(tmpdir, self.rinex)
+                new_header, epochs = self.edit_records(plain, limits, decimate, systems, purge_comments)
+
+                if epochs:
+                    self.compress_with_tools(plain, output)
+            finally:
+                rmtree(tmpdir, ignore_errors=True)
+
+        if not epochs:
+            if os.path.isfile(output):
+                os.remove(output)
+            raise pyRinexException('No epochs left in %s after applying the edits' % self.rinex)
+
+        edits = [desc for desc, apply in (('window %s - %s' % (str(start), str(end)), start or end),
+                                          ('decimated to %is' % (decimate or 0), decimate),
+                                          ('removed systems %s' % ','.join(systems), systems),
+                                          ('purged comments', purge_comments)) if apply]
+
+        if copyto is None:
+            move(output, self.rinex_path)
+
+            self.header = new_header
+            self.load_epochs(np.array(epochs))
+            if decimate:
+                self.interval = float(decimate)
+
+        self.log_event('RINEX edited in a single pass: %s (applied to %s)' % ('; '.join(edits), output
+                                                                            if copyto is not None else self.rinex))
+
+        return output if copyto is not None else self.rinex_path
+
+    def edit_records(self, output, limits, decimate, systems, purge_comments):
+        """
+        Write the RINEX file with the edits of transform to output (compressed according to its extension)
+        :return: new header and epochs that were kept
+        """
+        epochs = []
+
+        # the output is compressed according to its extension (e.g. copyto can be a CRINEZ file)
+        with open(self.rinex_path, 'r') as fileio, pyHatanaka.open_rinex(output, 'w') as out:
+
+            lines, header, obs_types = self.scan_header(fileio)
+
+            version = float(header['RINEX VERSION / TYPE'][0:9])
+
+            new_header = []
+            first_obs = None
+            system = ' '
+
+            for line in lines:
+                label = line[60:80].strip()
+
+                if label.startswith('SYS /') and line[0] != ' ':
+                    # system of the record (continuation lines have a blank system)
+                    system = line[0]
+
+                if label in ('TIME OF LAST OBS', '# OF SATELLITES', 'PRN / # OF OBS') or \
+                        (label == 'COMMENT' and purge_comments) or \
+                        (label == 'INTERVAL' and decimate) or \
+                        (label.startswith('SYS /') and system in systems) or \
+                        (label.startswith('GLONASS') and 'R' in systems):
+                    # the records that are not valid after the edits are removed (the interval is added again)
+                    continue
+
+                elif label == 'END OF HEADER':
+                    if decimate:
+                        new_header += [self.format_record(self.required_records, 'INTERVAL', decimate) + '\n']
+
+                elif label == 'TIME OF FIRST OBS':
+                    # rewritten with the first epoch that is kept (see write_first_obs)
+                    first_obs, _ = self.read_fields(line, label, self.required_records[label]['format_tuple'])
+
+                new_header += [line]
+
+            # the header is written with the first epoch that is kept (to fill the TIME OF FIRST OBS). Until then,
+            # the records of the events are held back
+            held = []
+
+            for line, flag, n, epoch, payload in self.epoch_records(fileio, version, obs_types):
+
+                if epoch is not None:
+                    if (limits[0] is not None and epoch < limits[0] - 1e-3) or \
+                            (limits[1] is not None and epoch > limits[1] + 1e-3):
+                        continue
+
+                    if decimate:
+                        sod = epoch % 86400
+                        if abs(sod - round(sod / decimate) * decimate) > 1e-3:
+                            continue
+
+                    if systems:
+                        line, payload = self.filter_systems(line, payload, version, obs_types, systems)
+
+                        if line is None:
+                            # no satellites left in this epoch
+                            continue
+
+                    if flag <= 1:
+                        epochs.append(epoch)
+
+                        if held is not None:
+                            self.write_first_obs(new_header, first_obs, epoch)
+                            out.writelines(new_header)
+                            out.writelines(held)
+                            held = None
+
+                elif purge_comments:
+                    # special records of an event
+                    payload = [record for record in payload if record[60:80].strip() != 'COMMENT']
+
+                    if not payload and n:
+                        # event with only comments
+                        continue
+
+                    if version < 3:
+                        line = line[0:29] + '%3i' % len(payload) + line[32:]
+                    else:
+                        line = line[0:32] + '%3i' % len(payload) + line[35:]
+
+                if held is not None:
+                    held += [line] + payload
+                else:
+                    out.write(line)
+                    out.writelines(payload)
+
+            if held is not None:
+                # no epochs: write what is left to close the file (it is removed by the caller)
+                out.writelines(new_header + held)
+
+        return new_header, epochs
+
+    def compress_with_tools(self, filename, output):
+        """
+        Compress a RINEX file using rnx2crz, rnx2crx or compress (according to the extension of output). Used when the
+        in-process compression of pyHatanaka fails
+        :param filename: RINEX file to compress
+        :param output: path of the compressed file
+        """
+        to_type = self.identify_type(output)
+
+        program = {TYPE_CRINEZ: 'rnx2crz -f', TYPE_CRINEX: 'rnx2crx -f', TYPE_RINEZ: 'compress -f'}.get(to_type)
+
+        if program is None:
+            raise pyRinexException('Invalid compressed filename format: ' + output)
+
+        cmd = pyRunWithRetry.RunCommand(program + ' ' + filename, 45)
+        try:
+            _, err = cmd.run_shell()
+        except pyRunWithRetry.RunCommandWithRetryExeception as e:
+            # catch the timeout except and pass it as a pyRinexException
+            raise pyRinexException(str(e))
+
+        compressed = self.to_format(filename, to_type)
+
+        if not os.path.isfile(compressed) or os.path.getsize(compressed) == 0:
+            raise pyRinexException('Error in compress_with_tools: compressed version of ' + filename +
+                                   ' has zero size! ' + str(err))
+
+        move(compressed, output)
+
+    def write_first_obs(self, header, first_obs, epoch):
+        """
+        Replace the TIME OF FIRST OBS record of header (list of lines) with epoch (seconds since 0001-01-01)
+        """
+        if first_obs is None:
+            return
+
+        t = epoch % 86400
+        date = datetime.date.fromordinal(int(epoch // 86400))
+        first_obs[0:6] = [date.year, date.month, date.day, int(t / 3600), int(t % 3600 / 60), t % 60]
+
+        for i, line in enumerate(header):
+            if line[60:80].strip() == 'TIME OF FIRST OBS':
+                header[i] = self.format_record(self.required_records, 'TIME OF FIRST OBS', first_obs) + '\n'
+                break
+
+    @staticmethod
+    def filter_systems(line, payload, version, obs_types, systems):
+        """
+        Remove the satellites of the given systems from an epoch
+        :return: new epoch record and list of lines or (None, None) if no satellites are left
+        """
+        if version >= 3:
+            payload = [obs for obs in payload if obs[0] not in systems]
+
+            if not payload:
+                return None, None
+
+            return line[0:32] + '%3i' % len(payload) + line[35:], payload
+
+        n = int(line[29:32])
+        # satellite list in the epoch record and continuation lines (12 satellites per line)
+        cont = max(n - 1, 0) / 12
+        sats = ''.join(record[32:68].rstrip() for record in [line] + payload[0:cont])
+        sats = [sats[i:i + 3] for i in range(0, 3 * n, 3)]
+
+        lines_per_sat = (len(obs_types[' ']) + 4) / 5
+        keep = [i for i, sat in enumerate(sats) if sat[0] not in systems]
+
+        if not keep:
+            return None, None
+
+        sats = [sats[i] for i in keep]
+        # receiver clock offset (optional) after the satellite list
+        clock = line[68:].rstrip('\r\n')
+
+        records = [line[0:29] + '%3i' % len(sats) + ''.join(sats[0:12]).ljust(36) + clock]
+        records += [' ' * 32 + ''.join(sats[i:i + 12]) for i in range(12, len(sats), 12)]
+
+        observations = payload[cont:]
+        observations = [observations[i * lines_per_sat:(i + 1) * lines_per_sat] for i in keep]
+
+        return records[0].rstrip() + '\n', [record + '\n' for record in records[1:]] + \
+            [obs for sat in observations for obs in sat]
+
     def window_data(self, start=None, end=None, copyto=None):
         """
-        Window the RINEX data using TEQC
+        Window the RINEX data
         :param start: a start datetime or self.firstObs if None
         :param end: a end datetime or self.lastObs if None
         :return:
@@ -1167,91 +1695,21 @@ class ReadRinex(RinexRecord):
             end = self.datetime_lastObs
             self.log_event('Setting end = last obs in window_data')
 
-        cmd = pyRunWithRetry.RunCommand('teqc -n_GLONASS 64 -n_GPS 64 -n_SBAS 64 -n_Galileo 64 '
-                                        '-st %i%02i%02i%02i%02i%02i -e %i%02i%02i%02i%02i%02i +obs %s.t %s'
-                                        % (start.year, start.month, start.day, start.hour, start.minute, start.second,
-                                           end.year, end.month, end.day, end.hour, end.minute, end.second,
-                                           self.rinex_path, self.rinex_path), 5)
-
-        out, err = cmd.run_shell()
-
-        if 'teqc: failure to read' not in str(err):
-            # delete the original file and replace with .t
-            if copyto is None:
-                os.remove(self.rinex_path)
-                move(self.rinex_path + '.t', self.rinex_path)
-                self.datetime_firstObs = start
-                self.datetime_lastObs = end
-                self.firstObs = self.datetime_firstObs.strftime('%Y/%m/%d %H:%M:%S')
-                self.lastObs = self.datetime_lastObs.strftime('%Y/%m/%d %H:%M:%S')
-            else:
-                move(self.rinex_path + '.t', copyto)
-        else:
-            raise pyRinexException(err)
+        self.transform(start=start, end=end, copyto=copyto)
 
         return
 
     def decimate(self, decimate_rate, copyto=None):
         # if copy to is passed, then the decimation is done on the copy of the file, not on the current rinex.
         # otherwise, decimation is done in current rinex
-        if copyto is not None:
-            copyfile(self.rinex_path, copyto)
-        else:
-            copyto = self.rinex_path
-            self.interval = decimate_rate
-
-        if self.rinex_version < 3:
-            cmd = pyRunWithRetry.RunCommand('teqc -n_GLONASS 64 -n_GPS 64 -n_SBAS 64 -n_Galileo 64 -O.dec %i '
-                                            '+obs %s.t %s' % (decimate_rate, copyto, copyto), 5)
-            # leave errors un-trapped on purpose (will raise an error to the parent)
-        else:
-            cmd = pyRunWithRetry.RunCommand('RinEdit --IF %s --OF %s.t --TN %i --TB %i,%i,%i,%i,%i,%i'
-                                            % (os.path.basename(copyto), os.path.basename(copyto), decimate_rate,
-                                               self.date.year, self.date.month, self.date.day, 0, 0, 0),
-                                            15, self.rootdir)
-        out, err = cmd.run_shell()
-
-        if 'teqc: failure to read' not in str(err):
-            # delete the original file and replace with .t
-            os.remove(copyto)
-            move(copyto + '.t', copyto)
-        else:
-            raise pyRinexException(err)
-
-        self.log_event('RINEX decimated to %is (applied to %s)' % (decimate_rate, str(copyto)))
+        self.transform(decimate=decimate_rate, copyto=copyto)
 
         return
 
     def remove_systems(self, systems=('R', 'E', 'S'), copyto=None):
         # if copy to is passed, then the system removal is done on the copy of the file, not on the current rinex.
         # other wise, system removal is done to current rinex
-        if copyto is not None:
-            copyfile(self.rinex_path, copyto)
-        else:
-            copyto = self.rinex_path
-
-        if self.rinex_version < 3:
-            rsys = '-' + ' -'.join(systems)
-            cmd = pyRunWithRetry.RunCommand('teqc -n_GLONASS 64 -n_GPS 64 -n_SBAS 64 -n_Galileo 64 %s +obs %s.t %s' % (rsys, copyto, copyto), 5)
-        else:
-            rsys = ' --DS '.join(systems)
-            cmd = pyRunWithRetry.RunCommand('RinEdit --IF %s --OF %s.t --DS %s' % (os.path.basename(copyto), os.path.basename(copyto), rsys), 15, self.rootdir)
-
-        # leave errors un-trapped on purpose (will raise an error to the parent)
-        out, err = cmd.run_shell()
-
-        if not 'teqc: failure to read' in str(err):
-            # delete the original file and replace with .t
-            os.remove(copyto)
-            move(copyto + '.t', copyto)
-            # if working on local copy, reload the rinex information
-            if copyto == self.rinex_path:
-                # reload information from this file
-                self.parse_output(self.RunRinSum())
-        else:
-            raise pyRinexException(err)
-
-        self.log_event('Removed systems %s (applied to %s)' % (','.join(systems), str(copyto)))
+        self.transform(remove_systems=systems, copyto=copyto)
 
         return
 
@@ -1426,15 +1884,7 @@ class ReadRinex(RinexRecord):
                 filename = self.compress_local_copyto(path)
 
             elif destiny_type is TYPE_CRINEX:
-                cmd = pyRunWithRetry.RunCommand('rnx2crx -f ' + self.rinex_path, 45)
-                try:
-                    _, err = cmd.run_shell()
-
-                    if os.path.getsize(os.path.join(self.rootdir, self.to_format(self.rinex, TYPE_CRINEX))) == 0:
-                        raise pyRinexException('Error in move_origin_file: compressed version of ' + self.rinex_path + ' has zero size!')
-                except pyRunWithRetry.RunCommandWithRetryExeception as e:
-                    # catch the timeout except and pass it as a pyRinexException
-                    raise pyRinexException(str(e))
+                self.compress_local_copy(TYPE_CRINEX)
 
             elif destiny_type is TYPE_RINEZ:
                 raise pyRinexException('pyRinex will not natively generate a RINEZ file.')
@@ -1461,26 +1911,47 @@ class ReadRinex(RinexRecord):
         # this function compresses and moves the local copy of the rinex
         # meant to be used when a multiday rinex file is encountered and we need to move it to the repository
 
-        # compress the rinex into crinez. Make the filename
-        crinez = self.to_format(self.rinex, TYPE_CRINEZ)
+        # compress the rinex into crinez. We make the crinez again (don't use the existing from the database) to
+        # apply any corrections made during the __init__ stage
+        crinez = self.compress_local_copy(TYPE_CRINEZ)
+
+        filename = Utils.copyfile(crinez, os.path.join(path, os.path.basename(crinez)))
+
+        self.log_event('Created CRINEZ from local copy and copied to %s' % path)
+
+        return filename
+
+    def compress_local_copy(self, to_type=TYPE_CRINEZ):
+        """
+        Compress the local copy of the rinex to CRINEZ or CRINEX (in rootdir). The Hatanaka and LZW compression are
+        done in-process by pyHatanaka. If that fails, rnx2crz / rnx2crx are used
+        :param to_type: TYPE_CRINEZ or TYPE_CRINEX
+        :return: path to the compressed file
+        """
+        compressed = os.path.join(self.rootdir, self.to_format(self.rinex, to_type))
 
-        # we make the crinez again (don't use the existing from the database) to apply any corrections
-        # made during the __init__ stage. Notice the -f in rnx2crz
-        cmd = pyRunWithRetry.RunCommand('rnx2crz -f ' + self.rinex_path, 45)
         try:
-            _, err = cmd.run_shell()
+            with open(self.rinex_path, 'r') as src, pyHatanaka.open_rinex(compressed, 'w') as dst:
+                dst.writelines(src)
 
-            if os.path.getsize(os.path.join(self.rootdir, crinez)) == 0:
-                raise pyRinexException('Error in compress_local_copyto: compressed version of ' + self.rinex_path + ' has zero size!')
-        except pyRunWithRetry.RunCommandWithRetryExeception as e:
-            # catch the timeout except and pass it as a pyRinexException
-            raise pyRinexException(str(e))
+        except Exception as e:
+            program = 'rnx2crz' if to_type is TYPE_CRINEZ else 'rnx2crx'
 
-        filename = Utils.copyfile(os.path.join(self.rootdir, crinez), os.path.join(path, crinez))
+            self.log_event('In-process compression failed (%s) -> using %s' % (str(e), program))
 
-        self.log_event('Created CRINEZ from local copy and copied to %s' % path)
+            # Notice the -f in rnx2crz
+            cmd = pyRunWithRetry.RunCommand(program + ' -f ' + self.rinex_path, 45)
+            try:
+                _, err = cmd.run_shell()
+            except pyRunWithRetry.RunCommandWithRetryExeception as e:
+                # catch the timeout except and pass it as a pyRinexException
+                raise pyRinexException(str(e))
 
-        return filename
+        if not os.path.isfile(compressed) or os.path.getsize(compressed) == 0:
+            raise pyRinexException('Error in compress_local_copy: compressed version of ' + self.rinex_path +
+                                   ' has zero size!')
+
+        return compressed
 
     def rename(self, new_name=None, NetworkCode=None, StationCode=None):
 
@@ -160,7 +160,8 @@ class StationInfo(object):
     New parameter: h_tolerance makes the station info more tolerant to gaps. This is because station info in the old
     days had a break in the middle and the average epoch was falling right in between the gap
     """
-    def __init__(self, cnn, NetworkCode=None, StationCode=None, date=None, allow_empty=False, h_tolerance=0):
+    def __init__(self, cnn, NetworkCode=None, StationCode=None, date=None, allow_empty=False, h_tolerance=0,
+                 records=None):
 
         self.record_count = 0
         self.NetworkCode = NetworkCode
@@ -179,7 +180,7 @@ class StationInfo(object):
 
             self.cnn = cnn
 
-            if self.load_stationinfo_records():
+            if self.load_stationinfo_records(records):
                 # find the record that matches the given date
                 if date is not None:
                     self.date = date
@@ -203,14 +204,24 @@ class StationInfo(object):
                                                      NetworkCode + '.' + StationCode + ' ' +
                                                      date.yyyymmdd() + ' (' + date.yyyyddd() + ')')
 
-    def load_stationinfo_records(self):
+    def __getstate__(self):
+        # the connection to the database can't be pickled (e.g. ETMs saved by pyETMCache)
+        state = self.__dict__.copy()
+        state.pop('cnn', None)
+
+        return state
+
+    def load_stationinfo_records(self, records=None):
         # function to load the station info records in the database
         # returns true if records found
         # returns false if none found, unless allow_empty = False in which case it raises an error.
-        stninfo = self.cnn.query('SELECT * FROM stationinfo WHERE "NetworkCode" = \'' + self.NetworkCode +
-                                 '\' AND "StationCode" = \'' + self.StationCode + '\' ORDER BY "DateStart"')
+        # records: station info records (dictionaries sorted by DateStart) already fetched from the db (optional)
+        if records is None:
+            records = self.cnn.query('SELECT * FROM stationinfo WHERE "NetworkCode" = \'' + self.NetworkCode +
+                                     '\' AND "StationCode" = \'' + self.StationCode +
+                                     '\' ORDER BY "DateStart"').dictresult()
 
-        if stninfo.ntuples() == 0:
+        if len(records) == 0:
             if not self.allow_empty:
                 # allow no station info if explicitly requested by the user.
                 # Purpose: insert a station info for a new station!
@@ -219,10 +230,10 @@ class StationInfo(object):
             self.record_count = 0
             return False
         else:
-            for record in stninfo.dictresult():
+            for record in records:
                 self.records.append(StationInfoRecord(self.NetworkCode, self.StationCode, record))
 
-            self.record_count = stninfo.ntuples()
+            self.record_count = len(records)
             return True
 
     def parse_station_info(self, stninfo_file_list):
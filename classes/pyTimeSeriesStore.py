@@ -0,0 +1,367 @@
+"""
+Project: Parallel.Archive
+
+Local columnar store of the time series in ppp_soln, gamit_soln and stacks. Each source (ppp, a GAMIT project or a
+stack) is saved as one numpy file per column, sorted by station and date, that is read using memory mapping. The
+time series of a station is a slice of each column (no copies). The store is synchronized incrementally from the
+database: only the stations with a different md5 digest of their solutions are reloaded.
+
+Directory structure: path/source/name/version/column.npy where CURRENT (in path/source/name) holds the name of the
+active version. Readers always open the active version, so the store can be shared by all the nodes of a cluster
+while it is being synchronized. The previous version is always kept and older versions are only removed after
+VERSION_GRACE_PERIOD, so readers (or other nodes writing a new version) are not left with deleted files.
+"""
+
+import os
+import json
+import shutil
+import ConfigParser
+import numpy as np
+import pyDate
+from time import time
+
+# table and filter field of each source
+SOURCES = {'ppp':   ('ppp_soln', None),
+           'gamit': ('gamit_soln', 'Project'),
+           'stack': ('stacks', 'name')}
+
+COLUMNS = ('x', 'y', 'z', 'year', 'doy', 'mjd', 'fyear')
+
+# seconds that an old version of the store is kept before it can be removed
+VERSION_GRACE_PERIOD = 3600
+
+VERTICES_DTYPE = [('stn', 'S8'), ('x', 'float64'), ('y', 'float64'), ('z', 'float64'), ('yr', 'i4'), ('dd', 'i4'),
+                  ('fy', 'float64')]
+
+
+class pyTimeSeriesStoreException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return str(self.value)
+
+
+def open_store(cnn, source, name=None, configfile='gnss_data.cfg', sync=True, stations=None):
+    """
+    Open the time series store of a source using the ts_store path in the archive section of the configuration file
+    :param cnn: connection to the database (used to synchronize the store)
+    :param source: ppp, gamit or stack
+    :param name: project or stack name (not used for ppp)
+    :param configfile: configuration file
+    :param sync: synchronize the store with the database before returning it
+    :param stations: list of station dictionaries (NetworkCode, StationCode) to synchronize (default: all)
+    :return: TimeSeriesStore object or None if the store is not configured
+    """
+    config = ConfigParser.ConfigParser()
+    config.readfp(open(configfile))
+
+    if not config.has_option('archive', 'ts_store') or not config.get('archive', 'ts_store').strip():
+        return None
+
+    store = TimeSeriesStore(os.path.expandvars(config.get('archive', 'ts_store').strip()), source, name)
+
+    if sync:
+        store.sync(cnn, None if stations is None else [stn['NetworkCode'] + '.' + stn['StationCode']
+                                                       for stn in stations])
+
+    return store
+
+
+class TimeSeriesStore(object):
+
+    def __init__(self, path, source, name=None):
+
+        if source not in SOURCES.keys():
+            raise pyTimeSeriesStoreException('Invalid source ' + str(source))
+
+        self.source = source
+        self.name = 'ppp' if source == 'ppp' else name.lower()
+        self.table, self.field = SOURCES[source]
+        self.path = os.path.join(path, source, self.name)
+
+        self.columns = dict()
+        self.stations = np.array([], dtype='S8')
+        self.offsets = np.zeros(1, dtype=int)
+        self.digests = []
+        self.index = dict()
+        self.version = None
+
+        self.load()
+
+    def load(self):
+        """
+        (re)load the active version of the store
+        """
+        current = os.path.join(self.path, 'CURRENT')
+
+        if not os.path.isfile(current):
+            return
+
+        with open(current) as f:
+            version = f.read().strip()
+
+        vpath = os.path.join(self.path, version)
+
+        with open(os.path.join(vpath, 'meta.json')) as f:
+            meta = json.load(f)
+
+        self.stations = np.array(meta['stations'], dtype='S8')
+        self.offsets = np.array(meta['offsets'], dtype=int)
+        # stores created before the digests were introduced are reloaded completely by the next sync
+        self.digests = meta.get('digests', [''] * len(meta['stations']))
+
+        for column in self.column_names():
+            # numpy can't memory map an empty file
+            self.columns[column] = np.load(os.path.join(vpath, column + '.npy'),
+                                           mmap_mode='r' if self.offsets[-1] else None)
+
+        self.index = dict((stn, i) for i, stn in enumerate(self.stations.tolist()))
+        self.version = version
+
+    def column_names(self):
+        return COLUMNS + ('hash',) if self.source == 'ppp' else COLUMNS
+
+    def where(self, stations=None):
+
+        where = ['"%s" = \'%s\'' % (self.field, self.name)] if self.field else []
+
+        if stations is not None:
+            where.append('"NetworkCode" || \'.\' || "StationCode" IN (\'%s\')' % '\',\''.join(stations))
+
+        return ('WHERE ' + ' AND '.join(where)) if where else ''
+
+    def sync(self, cnn, stations=None):
+        """
+        Synchronize the store with the database. The md5 digest of the solutions of each station (all the columns
+        served by the store: coordinates, dates and, for ppp, the hash) is compared against the digest of the store:
+        only the stations that differ are loaded
+        :param cnn: connection to the database
+        :param stations: list of stations (net.stn) to synchronize. If None, all the stations are synchronized
+        :return: number of stations that were loaded from the database
+        """
+        # the digest covers every column of the store (a reprocessed PPP solution can change only its hash)
+        digest_fields = '"X", "Y", "Z", "Year", "DOY"' + (', "hash"' if self.source == 'ppp' else '')
+
+        summary = []
+        # break the list of stations in chunks to keep the queries at a reasonable size
+        for chunk in ([None] if stations is None else [stations[i:i + 500] for i in range(0, len(stations), 500)]):
+            summary += cnn.query_float('SELECT "NetworkCode" || \'.\' || "StationCode" as stn, '
+                                       'md5(string_agg(concat_ws(\',\', %s), \';\' '
+                                       'ORDER BY "Year", "DOY")) FROM %s %s GROUP BY "NetworkCode", "StationCode" '
+                                       'ORDER BY "NetworkCode", "StationCode"'
+                                       % (digest_fields, self.table, self.where(chunk)))
+
+        digests = dict((s[0], s[1]) for s in summary)
+
+        changed = []
+        for stn, digest in digests.items():
+            i = self.index.get(stn)
+            if i is None or self.digests[i] != digest:
+                changed.append(stn)
+
+        # stations of the store that were not synchronized are kept
+        if stations is not None:
+            requested = set(stations)
+            for stn in self.index.keys():
+                if stn not in requested:
+                    digests[stn] = self.digests[self.index[stn]]
+
+        final = sorted(digests.keys())
+
+        if not changed and final == self.stations.tolist():
+            return 0
+
+        # load the solutions of the stations that changed
+        fields = '"NetworkCode" || \'.\' || "StationCode", "X", "Y", "Z", "Year", "DOY"' + \
+                 (', "hash"' if self.source == 'ppp' else '')
+
+        rows = []
+        changed = sorted(changed)
+        if stations is None and len(changed) == len(summary):
+            chunks = [None]
+        else:
+            chunks = [changed[i:i + 500] for i in range(0, len(changed), 500)]
+
+        for chunk in chunks:
+            rows += cnn.query_float('SELECT %s FROM %s %s ORDER BY "NetworkCode", "StationCode", "Year", "DOY"'
+                                    % (fields, self.table, self.where(chunk)))
+
+        new = self.to_columns(rows)
+
+        # station offsets in the new data (rows are grouped by station)
+        new_stn = np.array([r[0] for r in rows], dtype='S8')
+        new_start = np.where(np.append(True, new_stn[1:] != new_stn[:-1]))[0] if rows else np.array([], dtype=int)
+        new_end = np.append(new_start[1:], len(rows))
+        new_index = dict((stn, (s, e)) for stn, s, e in zip(new_stn[new_start].tolist(), new_start, new_end))
+
+        # merge the unchanged stations of the store with the loaded ones
+        pieces = dict((column, []) for column in self.column_names())
+        offsets = [0]
+        changed = set(changed)
+
+        for stn in final:
+            if stn in changed:
+                s, e = new_index.get(stn, (0, 0))
+                source = new
+            else:
+                i = self.index[stn]
+                s, e = self.offsets[i], self.offsets[i + 1]
+                source = self.columns
+
+            for column in self.column_names():
+                pieces[column].append(source[column][s:e])
+
+            offsets.append(offsets[-1] + e - s)
+
+        columns = dict((column, np.concatenate(pieces[column]) if pieces[column] else new[column][0:0])
+                       for column in self.column_names())
+
+        self.save(final, offsets, [digests[stn] for stn in final], columns)
+        self.load()
+
+        return len(changed)
+
+    def to_columns(self, rows):
+
+        columns = dict()
+
+        if rows:
+            a = np.array([r[1:] for r in rows], dtype=float)
+        else:
+            a = np.zeros((0, 6 if self.source == 'ppp' else 5))
+
+        columns['x'] = a[:, 0]
+        columns['y'] = a[:, 1]
+        columns['z'] = a[:, 2]
+        columns['year'] = a[:, 3].astype('i4')
+        columns['doy'] = a[:, 4].astype('i4')
+
+        dates = pyDate.DateArray(year=columns['year'], doy=columns['doy'])
+        columns['mjd'] = dates.mjd.astype('i4')
+        columns['fyear'] = dates.fyear
+
+        if self.source == 'ppp':
+            columns['hash'] = a[:, 5].astype('i8')
+
+        return columns
+
+    def save(self, stations, offsets, digests, columns):
+        """
+        write a new version of the store and make it the active one
+        """
+        version = 'v%i.%i' % (int(time() * 1000), os.getpid())
+        vpath = os.path.join(self.path, version)
+
+        os.makedirs(vpath)
+
+        for column, values in columns.items():
+            np.save(os.path.join(vpath, column + '.npy'), np.ascontiguousarray(values))
+
+        with open(os.path.join(vpath, 'meta.json'), 'w') as f:
+            json.dump({'stations': stations, 'offsets': [int(o) for o in offsets], 'digests': digests}, f)
+
+        # atomic switch to the new version
+        current = os.path.join(self.path, 'CURRENT')
+        with open(current + '.' + version, 'w') as f:
+            f.write(version)
+
+        os.rename(current + '.' + version, current)
+
+        self.purge_versions(version)
+
+    def purge_versions(self, version):
+        """
+        Remove the old versions of the store. The active version and the one before it are kept. The other versions
+        are only removed after VERSION_GRACE_PERIOD (measured from their last modification), so that a reader that
+        read CURRENT before the switch (or another node that is still writing a version) is not affected
+        """
+        # versions are named v<milliseconds>.<pid>: sort them by creation time
+        versions = sorted([item for item in os.listdir(self.path)
+                           if item.startswith('v') and os.path.isdir(os.path.join(self.path, item))],
+                          key=lambda v: int(v[1:].split('.')[0]))
+
+        previous = [v for v in versions if v != version][-1:]
+
+        for item in versions:
+            if item == version or item in previous:
+                continue
+
+            vpath = os.path.join(self.path, item)
+
+            try:
+                if time() - os.path.getmtime(vpath) > VERSION_GRACE_PERIOD:
+                    shutil.rmtree(vpath, ignore_errors=True)
+            except OSError:
+                # removed by another node
+                pass
+
+    def has_station(self, NetworkCode, StationCode):
+        return NetworkCode + '.' + StationCode in self.index
+
+    def get_station(self, NetworkCode, StationCode):
+        """
+        Obtain the time series of a station
+        :return: dictionary with the columns of the station (read only views of the memory mapped files) or None if
+                 the station is not in the store
+        """
+        i = self.index.get(NetworkCode + '.' + StationCode)
+
+        if i is None:
+            return None
+
+        s, e = self.offsets[i], self.offsets[i + 1]
+
+        return dict((column, values[s:e]) for column, values in self.columns.items())
+
+    def date_mask(self, end_date=None, start_date=None):
+
+        mask = np.ones(self.offsets[-1], dtype=bool)
+
+        if end_date is not None:
+            mask &= self.columns['year'] * 1000 + self.columns['doy'] <= end_date.year * 1000 + end_date.doy
+
+        if start_date is not None:
+            mask &= self.columns['year'] * 1000 + self.columns['doy'] >= start_date.year * 1000 + start_date.doy
+
+        return mask
+
+    def get_vertices(self, end_date=None, start_date=None):
+        """
+        Obtain the vertices of all the stations (between start_date and end_date) as a structured array with the same
+        format used by pyStack (stn, x, y, z, yr, dd, fy) sorted by station
+        """
+        mask = self.date_mask(end_date, start_date)
+
+        vertices = np.zeros(np.sum(mask), dtype=VERTICES_DTYPE)
+
+        vertices['stn'] = np.repeat(self.stations, np.diff(self.offsets))[mask]
+        vertices['x'] = self.columns['x'][mask]
+        vertices['y'] = self.columns['y'][mask]
+        vertices['z'] = self.columns['z'][mask]
+        vertices['yr'] = self.columns['year'][mask]
+        vertices['dd'] = self.columns['doy'][mask]
+        vertices['fy'] = self.columns['fyear'][mask]
+
+        return vertices
+
+    def get_dates(self, end_date=None):
+        """
+        :return: sorted list of (year, doy) tuples with solutions up to end_date
+        """
+        mask = self.date_mask(end_date)
+
+        yd = np.unique(self.columns['year'][mask] * 1000 + self.columns['doy'][mask])
+
+        return [(int(d / 1000), int(d % 1000)) for d in yd]
+
+    def get_stations(self, end_date=None):
+        """
+        :return: list of station dictionaries (NetworkCode, StationCode) with solutions up to end_date
+        """
+        mask = self.date_mask(end_date)
+
+        count = np.add.reduceat(mask.astype(int), self.offsets[:-1]) if self.stations.size else np.array([])
+
+        return [{'NetworkCode': stn.split('.')[0], 'StationCode': stn.split('.')[1]}
+                for stn, c in zip(self.stations.tolist(), count) if c > 0]
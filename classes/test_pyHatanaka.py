@@ -0,0 +1,138 @@
+"""
+Project: Parallel.Archive
+
+Round trip tests of pyHatanaka using small reference samples of RINEX 2.11 / CRINEX 1.0 and RINEX 3.04 / CRINEX 3.0
+(python -m unittest test_pyHatanaka from the classes folder)
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+import pyHatanaka
+
+
+def header(data, label):
+    return '%-60s%-20s\n' % (data, label)
+
+
+RINEX2 = [header('     2.11           OBSERVATION DATA    G (GPS)', 'RINEX VERSION / TYPE'),
+          header('TEST', 'MARKER NAME'),
+          header('     4    L1    L2    C1    P2', '# / TYPES OF OBSERV'),
+          header('    30.000', 'INTERVAL'),
+          header('', 'END OF HEADER'),
+          ' 21  1  1  0  0  0.0000000  0  2G01G02                               0.000123456\n',
+          ' 110000000.123 7  85714285.456 6  20932000.100    20932001.200\n',
+          ' 120000000.000    93506493.500    22834000.000    22834002.000\n',
+          ' 21  1  1  0  0 30.0000000  0  2G01G02                               0.000124456\n',
+          ' 110000525.123 7  85714694.556 6  20932100.000    20932101.150\n',
+          ' 119999700.000    93506259.740    22833943.000    22833945.000\n',
+          ' 21  1  1  0  1  0.0000000  0  2G01G03                               0.000125466\n',
+          ' 110001050.62317  85715103.956 6  20932199.950    20932201.100\n',
+          ' 100000000.001 5                  19000000.000    19000000.500\n']
+
+CRINEX1 = [header('1.0                 COMPACT RINEX FORMAT', 'CRINEX VERS   / TYPE'),
+           header('RNX2CRX ver.4.0.7                       01-Jan-21 00:00', 'CRINEX PROG / DATE')] + RINEX2[0:5] + \
+          ['&21  1  1  0  0  0.0000000  0  2G01G02\n',
+           '2&123456\n',
+           '3&110000000123 3&85714285456 3&20932000100 3&20932001200  7 6\n',
+           '3&120000000000 3&93506493500 3&22834000000 3&22834002000\n',
+           '                3\n',
+           '1000\n',
+           '525000 409100 99900 99950\n',
+           '-300000 -233760 -57000 -57000\n',
+           '              1 &                    3\n',
+           '10\n',
+           '500 300 50 0 1\n',
+           '3&100000000001  3&19000000000 3&19000000500  5\n']
+
+RINEX3 = [header('     3.04           OBSERVATION DATA    M', 'RINEX VERSION / TYPE'),
+          header('TEST', 'MARKER NAME'),
+          header('G    3 C1C L1C S1C', 'SYS / # / OBS TYPES'),
+          header('E    2 C1X L1X', 'SYS / # / OBS TYPES'),
+          header('', 'END OF HEADER'),
+          '> 2021 01 01 00 00  0.0000000  0  2\n',
+          'G05  21000000.000   110355000.250 8        45.000\n',
+          'E11  23000000.500   120864000.750 7\n',
+          '> 2021 01 01 00 00 30.0000000  0  2       0.000000123456\n',
+          'G05  21000090.000   110355472.950 8        46.000\n',
+          'E11  23000120.500   120864630.750 7\n']
+
+CRINEX3 = [header('3.0                 COMPACT RINEX FORMAT', 'CRINEX VERS   / TYPE'),
+           header('RNX2CRX ver.4.0.7                       01-Jan-21 00:00', 'CRINEX PROG / DATE')] + RINEX3[0:5] + \
+          ['> 2021 01 01 00 00  0.0000000  0  2      G05E11\n',
+           '\n',
+           '3&21000000000 3&110355000250 3&45000    8\n',
+           '3&23000000500 3&120864000750    7\n',
+           '                   3\n',
+           '2&123456\n',
+           '90000 472700 1000\n',
+           '120000 630000\n']
+
+
+class TestHatanaka(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def encode(self, rinex):
+        output = StringIO()
+        writer = pyHatanaka.CrinexWriter(output)
+        # all the lines are complete: nothing is left in the buffer of the writer (closing would discard the output)
+        writer.writelines(rinex)
+
+        return output.getvalue().splitlines(True)
+
+    def test_decode(self):
+        for crinex, rinex in ((CRINEX1, RINEX2), (CRINEX3, RINEX3)):
+            self.assertEqual(list(pyHatanaka.CrinexReader(crinex)), rinex)
+
+    def test_encode(self):
+        for crinex, rinex in ((CRINEX1, RINEX2), (CRINEX3, RINEX3)):
+            encoded = self.encode(rinex)
+
+            # the CRINEX PROG / DATE record is different
+            self.assertEqual(encoded[0:1] + encoded[2:], crinex[0:1] + crinex[2:])
+
+    def test_crinez_file(self):
+        for name, rinex in (('test0010.21d.Z', RINEX2), ('TEST00XXX_R_20210010000_01D_30S_MO.crx.gz', RINEX3)):
+            filename = os.path.join(self.path, name)
+
+            with pyHatanaka.open_rinex(filename, 'w') as out:
+                out.writelines(rinex)
+
+            with pyHatanaka.open_rinex(filename) as src:
+                self.assertEqual(list(src), rinex)
+
+    def test_lzw_chunks(self):
+        data = ''.join(RINEX2 + RINEX3) * 200
+        compressed = pyHatanaka.lzw_compress(data)
+
+        for chunk_size in (16, 1000, pyHatanaka.LZW_CHUNK):
+            self.assertEqual(''.join(pyHatanaka.lzw_decompress_iter(StringIO(compressed), chunk_size)), data)
+
+    def test_abort(self):
+        filename = os.path.join(self.path, 'test0010.21d.Z')
+
+        # incomplete epoch: the file can't be compressed and no truncated file is left behind
+        with self.assertRaises(pyHatanaka.pyHatanakaException):
+            with pyHatanaka.open_rinex(filename, 'w') as out:
+                out.writelines(RINEX2[0:7])
+
+        self.assertFalse(os.path.exists(filename))
+
+        with self.assertRaises(ValueError):
+            with pyHatanaka.open_rinex(filename, 'w') as out:
+                out.writelines(RINEX2)
+                raise ValueError('error while writing')
+
+        self.assertFalse(os.path.exists(filename))
+
+
+if __name__ == '__main__':
+    unittest.main()
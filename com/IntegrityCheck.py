@@ -490,17 +490,12 @@ def GetGaps(cnn, NetworkCode, StationCode, start_date, end_date):
     possible_doys = []
 
     if len(rnxtbl) > 0:
-        start_date = pyDate.Date(year=rnxtbl[0]['ObservationYear'], doy=rnxtbl[0]['ObservationDOY'])
-        end_date = pyDate.Date(year=rnxtbl[-1]['ObservationYear'], doy=rnxtbl[-1]['ObservationDOY'])
+        actual_doys = pyDate.DateArray(year=[rnx['ObservationYear'] for rnx in rnxtbl],
+                                       doy=[rnx['ObservationDOY'] for rnx in rnxtbl])
 
-        possible_doys = [pyDate.Date(mjd=mjd) for mjd in range(start_date.mjd, end_date.mjd+1)]
+        possible_doys = pyDate.DateArray(mjd=numpy.arange(actual_doys.mjd[0], actual_doys.mjd[-1] + 1))
 
-        actual_doys = [pyDate.Date(year=rnx['ObservationYear'], doy=rnx['ObservationDOY']) for rnx in rnxtbl]
-        gaps = []
-        for doy in possible_doys:
-
-            if doy not in actual_doys:
-                gaps += [doy]
+        gaps = possible_doys[numpy.logical_not(numpy.in1d(possible_doys.mjd, actual_doys.mjd))]
 
     return gaps, possible_doys
 
@@ -687,10 +682,10 @@ def VisualizeGaps(cnn, stnlist, start_date, end_date):
                             possible_doys[-1].year, possible_doys[-1].doy))
 
         # make a group per year
-        for year in sorted(set([d.year for d in possible_doys])):
+        for year in sorted(set(possible_doys.year.tolist())):
 
-            missing_dates = [m.doy for m in missing_doys if m.year == year]
-            p_doys = [m.doy for m in possible_doys if m.year == year]
+            missing_dates = missing_doys.doy[missing_doys.year == year].tolist()
+            p_doys = possible_doys.doy[possible_doys.year == year].tolist()
 
             sys.stdout.write('\n%i:\n    %03i>' % (year, p_doys[0]))
 
@@ -8,6 +8,8 @@ Type python pyPlotETM.py -h for usage help
 """
 import pyETM
 import pyOptions
+import pyTimeSeriesStore
+import pyETMCache
 import argparse
 import dbConnection
 import os
@@ -141,24 +143,26 @@ def main():
                 os.mkdir('production')
             args.directory = 'production'
 
+        # local time series store (if configured), synchronized only for the requested stations
+        if args.gamit is None and args.filename is None:
+            store = pyTimeSeriesStore.open_store(cnn, 'ppp', stations=stnlist)
+        elif args.filename is None:
+            store = pyTimeSeriesStore.open_store(cnn, 'stack', args.gamit[0], stations=stnlist)
+        else:
+            store = None
+
         for stn in stnlist:
             try:
 
                 if args.gamit is None and args.filename is None:
-                    etm = pyETM.PPPETM(cnn, stn['NetworkCode'], stn['StationCode'], False, args.no_model)
+                    etm = pyETMCache.ppp_etm(cnn, stn['NetworkCode'], stn['StationCode'], args.no_model,
+                                             store=store)
                 elif args.filename is not None:
                     etm = from_file(args, cnn, stn)
                 else:
-                    polyhedrons = cnn.query_float('SELECT "X", "Y", "Z", "Year", "DOY" FROM stacks '
-                                                  'WHERE "name" = \'%s\' AND "NetworkCode" = \'%s\' AND '
-                                                  '"StationCode" = \'%s\' '
-                                                  'ORDER BY "Year", "DOY", "NetworkCode", "StationCode"'
-                                                  % (args.gamit[0], stn['NetworkCode'], stn['StationCode']))
-
-                    soln = pyETM.GamitSoln(cnn, polyhedrons, stn['NetworkCode'], stn['StationCode'], args.gamit[0])
-
-                    etm = pyETM.GamitETM(cnn, stn['NetworkCode'], stn['StationCode'], False,
-                                         args.no_model, gamit_soln=soln)
+                    # the polyhedrons are read from the store (if available) or from the stacks table
+                    etm = pyETMCache.gamit_etm(cnn, stn['NetworkCode'], stn['StationCode'], args.gamit[0],
+                                               args.no_model, store=store)
 
                     # print ' > %5.2f %5.2f %5.2f %i %i' % \
                     #      (etm.factor[0]*1000, etm.factor[1]*1000, etm.factor[2]*1000, etm.soln.t.shape[0],
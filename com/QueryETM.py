@@ -7,6 +7,7 @@ User interface to plot and save JSON files of ETM objects.
 Type python pyPlotETM.py -h for usage help
 """
 import pyETM
+import pyETMCache
 import pyOptions
 import argparse
 import dbConnection
@@ -98,19 +99,11 @@ def main():
             try:
 
                 if args.gamit is None and args.filename is None:
-                    etm = pyETM.PPPETM(cnn, stn['NetworkCode'], stn['StationCode'], False)
+                    etm = pyETMCache.ppp_etm(cnn, stn['NetworkCode'], stn['StationCode'])
                 elif args.filename is not None:
                     etm = from_file(args, cnn, stn)
                 else:
-                    polyhedrons = cnn.query_float('SELECT "X", "Y", "Z", "Year", "DOY" FROM stacks '
-                                                  'WHERE "name" = \'%s\' AND "NetworkCode" = \'%s\' AND '
-                                                  '"StationCode" = \'%s\' '
-                                                  'ORDER BY "Year", "DOY", "NetworkCode", "StationCode"'
-                                                  % (args.gamit[0], stn['NetworkCode'], stn['StationCode']))
-
-                    soln = pyETM.GamitSoln(cnn, polyhedrons, stn['NetworkCode'], stn['StationCode'], args.gamit[0])
-
-                    etm = pyETM.GamitETM(cnn, stn['NetworkCode'], stn['StationCode'], False, gamit_soln=soln)
+                    etm = pyETMCache.gamit_etm(cnn, stn['NetworkCode'], stn['StationCode'], args.gamit[0])
 
                 if args.query is not None:
                     model = True if args.query[0] == 'model' else False
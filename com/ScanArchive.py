@@ -52,7 +52,9 @@ optional arguments:
                         or yyyy/mm/dd. Append keyword 'hash' to the end to
                         check the PPP hash values against the station
                         information records. If hash doesn't match,
-                        recalculate the PPP solutions.
+                        recalculate the PPP solutions. Append keyword 'etm'
+                        to update the PPP ETMs of the stations with new
+                        solutions.
   -rehash [argument [argument ...]], --rehash [argument [argument ...]]
                         Check PPP hash against station information hash.
                         Rehash PPP solutions to match the station information
@@ -77,6 +79,7 @@ import pySp3
 import pyBrdc
 import pyClk
 import pyPPP
+import pyETM
 from tqdm import tqdm
 import argparse
 import numpy
@@ -951,6 +954,25 @@ def process_ppp(cnn, Config, pyArchive, archive_path, JobServer, master_list, sd
     # print a summary of the events generated by the run
     print_scan_archive_summary(cnn)
 
+    return sorted(set([(record['NetworkCode'], record['StationCode']) for record in tblrinex]))
+
+
+def update_ppp_etms(cnn, stations):
+    """
+    Update the PPP ETMs of a list of stations. The parameters are updated with the new epochs only (see
+    pyETM.update_ppp_etm) and the ETM is fitted again when that is not possible
+    :param stations: list of (NetworkCode, StationCode) tuples
+    """
+    print " >> Updating the PPP ETMs of %i stations..." % len(stations)
+
+    for NetworkCode, StationCode in tqdm(stations, ncols=80, disable=None):
+        try:
+            if not pyETM.update_ppp_etm(cnn, NetworkCode, StationCode):
+                pyETM.PPPETM(cnn, NetworkCode, StationCode)
+
+        except pyETM.pyETMException as e:
+            tqdm.write(' -- %s.%s: %s' % (NetworkCode, StationCode, str(e)))
+
 
 def print_scan_archive_summary(cnn):
 
@@ -1361,6 +1383,7 @@ def main():
                              "[date_end] to limit the range of the processing. Allowed formats are yyyy_doy, wwww-d, "
                              "fyear or yyyy/mm/dd. Append keyword 'hash' to the end to check the PPP hash values "
                              "against the station information records. If hash doesn't match, recalculate the PPP "
+                             "solutions. Append keyword 'etm' to update the PPP ETMs of the stations with new "
                              "solutions.")
 
     parser.add_argument('-rehash', '--rehash', nargs='*', metavar='argument',
@@ -1434,7 +1457,8 @@ def main():
         # check other possible arguments
         dates = []
         do_hash = True if 'hash' in args.ppp else False
-        date_args = [date for date in args.ppp if date != 'hash']
+        do_etm = True if 'etm' in args.ppp else False
+        date_args = [date for date in args.ppp if date not in ('hash', 'etm')]
 
         try:
             dates = process_date(date_args)
@@ -1444,8 +1468,11 @@ def main():
         if do_hash:
             hash_check(cnn, stnlist, dates[0], dates[1], rehash=False, h_tolerant=args.stninfo_tolerant[0])
 
-        process_ppp(cnn, Config, pyArchive, Config.archive_path, JobServer, stnlist, dates[0], dates[1],
-                    args.stninfo_tolerant[0])
+        stations = process_ppp(cnn, Config, pyArchive, Config.archive_path, JobServer, stnlist, dates[0], dates[1],
+                               args.stninfo_tolerant[0])
+
+        if do_etm:
+            update_ppp_etms(cnn, stations)
 
     #########################################
 
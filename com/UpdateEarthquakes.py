@@ -10,6 +10,7 @@ from libcomcat import comcat
 from datetime import datetime,timedelta
 from collections import OrderedDict
 import re
+import pyETM
 
 TIMEFMT2 = '%Y-%m-%d %H:%M:%S.%f'
 
@@ -48,6 +49,9 @@ class AddEarthquakes():
 
         stime = quakes.dictresult()[0].get('mdate')
 
+        # last event before the update (to find the events added by this run)
+        last = stime
+
         if stime is None:
             # no events in the table, add all
             rinex = cnn.query('SELECT min("ObservationSTime") as mdate FROM rinex')
@@ -87,6 +91,18 @@ class AddEarthquakes():
             except Exception as e:
                 continue
 
+        # use the spatial index of the new events to report the stations that they affect
+        index = pyETM.EarthquakeIndex(cnn, since=last)
+
+        if index.count:
+            stations = cnn.query_float('SELECT "NetworkCode", "StationCode", lat, lon FROM stations '
+                                       'WHERE lat IS NOT NULL AND "NetworkCode" NOT LIKE \'?%%\'', as_dict=True)
+
+            affected = [stn['NetworkCode'] + '.' + stn['StationCode'] for stn in stations
+                        if index.get_events(float(stn['lat']), float(stn['lon'])).shape[0]]
+
+            print('%i new events affect %i stations: %s\n' % (index.count, len(affected), ' '.join(affected)))
+
 
 def main():
     import dbConnection
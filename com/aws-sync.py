@@ -13,6 +13,7 @@ import argparse
 import pyOptions
 import pyArchiveStruct
 import pyETM
+import pyETMCache
 import pyRinex
 import pyStationInfo
 import os
@@ -92,8 +93,8 @@ def rinex_task(NetworkCode, StationCode, date, ObservationFYear, metafile):
     filename = StationAlias + date.ddd() + '0.' + date.yyyy()[2:4] + 'd.Z'
 
     try:
-        # create the ETM object
-        etm = pyETM.PPPETM(cnn, NetworkCode, StationCode)
+        # create the ETM object (or get it from the ETM cache if the PPP solutions did not change)
+        etm = pyETMCache.ppp_etm(cnn, NetworkCode, StationCode)
 
         # get APRs and sigmas (only in NEU)
         Apr, sigmas, Window, source = etm.get_xyz_s(date.year, date.doy)
@@ -401,7 +402,7 @@ def pull_rinex(cnn, date, Config, JobServer):
                   'Receiver Type         Vers                  SwVer  Receiver SN           Antenna Type     Dome   '
                   'Antenna SN          \n')
 
-    modules = ('dbConnection', 'pyETM', 'pyDate', 'pyRinex', 'pyStationInfo', 'pyOptions', 'pyArchiveStruct', 'os',
+    modules = ('dbConnection', 'pyETM', 'pyETMCache', 'pyDate', 'pyRinex', 'pyStationInfo', 'pyOptions', 'pyArchiveStruct', 'os',
                'numpy', 'traceback', 'platform', 'Utils', 'shutil')
 
     depfuncs = (window_rinex, sigmas_neu2xyz)
@@ -130,22 +130,20 @@ class GamitTask(object):
                                     if Rnx.date == self.date:
                                         Rnx.rename(rinex['destiny'])
 
-                                        if rinex['jump'] is not None:
-                                            self.window_rinex(Rnx, rinex['jump'])
-                                        # before creating local copy, decimate file
-                                        Rnx.decimate(30)
-                                        Rnx.purge_comments()
-                                        Rnx.compress_local_copyto(self.pwd_rinex)
+                                        # window (if affected by an earthquake), decimate, purge comments and write
+                                        # the CRINEZ to the rinex folder in a single pass
+                                        Rnx.transform(decimate=30, purge_comments=True,
+                                                      copyto=os.path.join(self.pwd_rinex, Rnx.crinez),
+                                                      **self.window_rinex(rinex['jump']))
                                         break
                             else:
                                 Rinex.rename(rinex['destiny'])
 
-                                if rinex['jump'] is not None:
-                                    self.window_rinex(Rinex, rinex['jump'])
-                                # before creating local copy, decimate file
-                                Rinex.decimate(30)
-                                Rinex.purge_comments()
-                                Rinex.compress_local_copyto(self.pwd_rinex)
+                                # window (if affected by an earthquake), decimate, purge comments and write
+                                # the CRINEZ to the rinex folder in a single pass
+                                Rinex.transform(decimate=30, purge_comments=True,
+                                                copyto=os.path.join(self.pwd_rinex, Rinex.crinez),
+                                                **self.window_rinex(rinex['jump']))
 
                     except (OSError, IOError):
                         monitor.write(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') +
@@ -241,14 +239,17 @@ class GamitTask(object):
             # return useful information to the main node
             return result
 
-    def window_rinex(self, Rinex, window):
+    @staticmethod
+    def window_rinex(window):
 
-        # windows the data:
+        # limits of the window of the data (passed to pyRinex.transform):
         # check which side of the earthquake yields more data: window before or after the earthquake
-        if (window.datetime().hour + window.datetime().minute/60.0) < 12:
-            Rinex.window_data(start=window.datetime())
+        if window is None:
+            return dict()
+        elif (window.datetime().hour + window.datetime().minute/60.0) < 12:
+            return dict(start=window.datetime())
         else:
-            Rinex.window_data(end=window.datetime())
+            return dict(end=window.datetime())
 
     def parse_monitor(self, success):
 
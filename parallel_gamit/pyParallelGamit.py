@@ -29,6 +29,7 @@ from Utils import parseIntSet
 from Utils import indent
 from pyStation import Station
 from pyStation import StationCollection
+from pyStation import load_station_data
 from pyETM import pyETMException
 import pyArchiveStruct
 import logging
@@ -197,23 +198,20 @@ def station_list(stations, dates):
     stations = process_stnlist(cnn, stations)
     stn_obj = StationCollection()
 
-    # use the connection to the db to get the stations
+    # use the connection to the db to get the stations (all of them at once, using set-based queries)
+    stn_data = load_station_data(cnn, stations, dates)
+
     for Stn in tqdm(sorted(stations), ncols=80, disable=None):
 
         NetworkCode = Stn['NetworkCode']
         StationCode = Stn['StationCode']
 
-        rs = cnn.query(
-            'SELECT * FROM rinex_proc WHERE "NetworkCode" = \'%s\' AND "StationCode" = \'%s\' AND '
-            '("ObservationYear", "ObservationDOY") BETWEEN (%s) AND (%s)'
-            % (NetworkCode, StationCode,
-               dates[0].yyyy() + ', ' + dates[0].ddd(),
-               dates[1].yyyy() + ', ' + dates[1].ddd()))
+        data = stn_data[NetworkCode + '.' + StationCode]
 
-        if rs.ntuples() > 0:
+        if len(data['rinex']) > 0:
             tqdm.write(' -- %s.%s -> adding...' % (NetworkCode, StationCode))
             try:
-                stn_obj.append(Station(cnn, NetworkCode, StationCode, dates))
+                stn_obj.append(Station(cnn, NetworkCode, StationCode, dates, data=data))
             except pyETMException:
                 tqdm.write('    %s.%s -> station exists, but there was a problem initializing ETM.'
                            % (NetworkCode, StationCode))
@@ -479,9 +477,12 @@ def ParseZTD(project, dates, Sessions, GamitConfig, JobServer):
         #     ' -- %s Averaging zenith delays from stations in multiple sessions and inserting into database...'
         #     % print_datetime())
 
+        ztd = []
         for stn in stations:
             # JobServer.submit(date_vec, atmzen, stn, alias, project)
-            parse_ztd(date_vec, atmzen, stn, alias, project)
+            ztd += parse_ztd(date_vec, atmzen, stn, alias, project)
+
+        insert_ztd(ztd)
         # JobServer.wait()
 
     # JobServer.close_cluster()
@@ -598,40 +599,29 @@ def globk_callback(job):
     if result is not None:
         polyhedron, variance, project, date = result
         # insert polyherdon in gamit_soln table
+        rows = []
         for key, value in polyhedron.iteritems():
             if '.' in key:
-                try:
-                    if not len(cnn.query_float('SELECT * FROM gamit_soln WHERE '
-                                               '"NetworkCode" = \'' + key.split('.')[0] + '\' AND '
-                                               '"StationCode" = \'' + key.split('.')[1] + '\' AND '
-                                               '"Project" = \'' + project + '\' AND '
-                                               '"Year" = ' + str(date.year) + ' AND '
-                                               '"DOY" = ' + str(date.doy))):
-                        cnn.insert('gamit_soln',
-                                   NetworkCode=key.split('.')[0],
-                                   StationCode=key.split('.')[1],
-                                   Project=project,
-                                   Year=date.year,
-                                   DOY=date.doy,
-                                   FYear=date.fyear,
-                                   X=value.X,
-                                   Y=value.Y,
-                                   Z=value.Z,
-                                   sigmax=value.sigX * sqrt(variance),
-                                   sigmay=value.sigY * sqrt(variance),
-                                   sigmaz=value.sigZ * sqrt(variance),
-                                   sigmaxy=value.sigXY * sqrt(variance),
-                                   sigmaxz=value.sigXZ * sqrt(variance),
-                                   sigmayz=value.sigYZ * sqrt(variance),
-                                   VarianceFactor=variance)
-                except dbConnection.dbErrInsert as e:
-                    # tqdm.write('    --> Error inserting ' + key + ' -> ' + str(e))
-                    pass
+                rows.append((key.split('.')[0], key.split('.')[1], project, date.year, date.doy, date.fyear,
+                             value.X, value.Y, value.Z,
+                             value.sigX * sqrt(variance), value.sigY * sqrt(variance), value.sigZ * sqrt(variance),
+                             value.sigXY * sqrt(variance), value.sigXZ * sqrt(variance),
+                             value.sigYZ * sqrt(variance), variance))
             else:
                 tqdm.write(' -- %s Error while combining with GLOBK -> Invalid key found in session %s -> %s. '
                            'Polyhedron in database may be incomplete.'
                            % (print_datetime(), date.yyyyddd(), key))
 
+        # solutions already in the database are left untouched
+        try:
+            cnn.bulk_insert('gamit_soln', rows,
+                            ['NetworkCode', 'StationCode', 'Project', 'Year', 'DOY', 'FYear', 'X', 'Y', 'Z',
+                             'sigmax', 'sigmay', 'sigmaz', 'sigmaxy', 'sigmaxz', 'sigmayz', 'VarianceFactor'],
+                            keys=['NetworkCode', 'StationCode', 'Project', 'Year', 'DOY'], upsert=False)
+        except Exception as e:
+            tqdm.write(' -- %s Error while inserting the GLOBK solutions of %s: %s'
+                       % (print_datetime(), date.yyyyddd(), str(e)))
+
     else:
         tqdm.write(' -- %s Fatal error on node %s message from node follows -> \n%s'
                    % (print_datetime(), job.ip_addr, job.exception))
@@ -645,22 +635,7 @@ def parse_ztd_callback(job):
 
     if result is not None:
         result, stn = result
-        for ztd in result:
-            # now do the insert
-            try:
-                cnn.insert('gamit_ztd',
-                           NetworkCode=ztd[0],
-                           StationCode=ztd[1],
-                           Date=ztd[2],
-                           Project=ztd[3],
-                           model=ztd[4],
-                           sigma=ztd[5],
-                           ZTD=ztd[6],
-                           Year=ztd[7],
-                           DOY=ztd[8])
-
-            except Exception as e:
-                tqdm.write(' -- Error inserting parsed zenith delay: %s' % str(e))
+        insert_ztd(result)
 
         # tqdm.write(' -- %s %s -> ZTD successfully parsed and inserted to database'
         #            % (print_datetime(), stn))
@@ -708,24 +683,21 @@ def parse_ztd(date_vec, atmzen, stn, alias, project):
                 except KeyError:
                     tqdm.write(' -- Key error: could not translate station alias %s' % stn)
 
-    # return ztd, stn
-    zz = ztd
-    for ztd in zz:
-        # now do the insert
-        try:
-            cnn.insert('gamit_ztd',
-                       NetworkCode=ztd[0],
-                       StationCode=ztd[1],
-                       Date=ztd[2],
-                       Project=ztd[3],
-                       model=ztd[4],
-                       sigma=ztd[5],
-                       ZTD=ztd[6],
-                       Year=ztd[7],
-                       DOY=ztd[8])
+    return ztd
 
-        except Exception as e:
-            tqdm.write(' -- Error inserting parsed zenith delay: %s' % str(e))
+
+def insert_ztd(ztd):
+    """
+    insert the parsed zenith delays in gamit_ztd using a single bulk insert
+    :param ztd: list of zenith delays (output of parse_ztd)
+    """
+    try:
+        cnn.bulk_insert('gamit_ztd', [tuple(z) for z in ztd],
+                        ['NetworkCode', 'StationCode', 'Date', 'Project', 'model', 'sigma', 'ZTD', 'Year', 'DOY'],
+                        keys=['NetworkCode', 'StationCode', 'Project', 'Date'], upsert=False)
+
+    except Exception as e:
+        tqdm.write(' -- Error inserting parsed zenith delays: %s' % str(e))
 
 
 def ExecuteGamit(JobServer, GamitConfig, stations, check_stations, ignore_missing, dates,
@@ -7,8 +7,10 @@ Class that holds the station metadata needed to process in GAMIT
 """
 import pyStationInfo
 import pyETM
+import pyETMCache
 import pyBunch
 import pyDate
+import Utils
 import random
 import string
 import os
@@ -33,13 +35,17 @@ class pyStationCollectionException(pyStationException):
 
 class Station(object):
 
-    def __init__(self, cnn, NetworkCode, StationCode, dates, StationAlias=None):
-
+    def __init__(self, cnn, NetworkCode, StationCode, dates, StationAlias=None, data=None):
+        """
+        :param data: dictionary with the records of this station already fetched by load_station_data (optional)
+        """
         self.NetworkCode  = NetworkCode
         self.StationCode  = StationCode
         self.netstn = self.NetworkCode + '.' + self.StationCode
         if StationAlias is None:
-            if 'public.stationalias' in cnn.get_tables():
+            if data is not None:
+                self.StationAlias = data['alias']
+            elif 'public.stationalias' in cnn.get_tables():
                 rs = cnn.query_float('SELECT * FROM stationalias WHERE "NetworkCode" = \'%s\' '
                                      'AND "StationCode" = \'%s\''
                                      % (NetworkCode, StationCode), as_dict=True)
@@ -62,9 +68,14 @@ class Station(object):
         self.Y            = None
         self.Z            = None
         self.otl_H        = None
+        # a priori coordinates of the dates with RINEX files (see get_apr)
+        self.apr          = None
 
-        rs = cnn.query_float('SELECT * FROM stations WHERE "NetworkCode" = \'%s\' AND "StationCode" = \'%s\''
-                             % (NetworkCode, StationCode), as_dict=True)
+        if data is not None:
+            rs = [data['record']] if data['record'] is not None else []
+        else:
+            rs = cnn.query_float('SELECT * FROM stations WHERE "NetworkCode" = \'%s\' AND "StationCode" = \'%s\''
+                                 % (NetworkCode, StationCode), as_dict=True)
 
         if len(rs) != 0:
             self.record = pyBunch.Bunch().fromDict(rs[0])
@@ -78,33 +89,45 @@ class Station(object):
             self.Z = self.record.auto_z
 
             # get the available dates for the station (RINEX files with conditions to be processed)
-            rs = cnn.query(
-                'SELECT "ObservationYear" as y, "ObservationDOY" as d FROM rinex_proc '
-                'WHERE "NetworkCode" = \'%s\' AND "StationCode" = \'%s\' AND '
-                '("ObservationYear", "ObservationDOY") BETWEEN (%s) AND (%s) AND '
-                '"Completion" >= %.3f AND "Interval" <= %i'
-                % (NetworkCode, StationCode, dates[0].yyyy() + ', ' + dates[0].ddd(),
-                   dates[1].yyyy() + ', ' + dates[1].ddd(), COMPLETION, INTERVAL))
+            if data is not None:
+                rs = [r for r in data['rinex'] if r['c'] >= COMPLETION and r['i'] <= INTERVAL]
+            else:
+                rs = cnn.query(
+                    'SELECT "ObservationYear" as y, "ObservationDOY" as d FROM rinex_proc '
+                    'WHERE "NetworkCode" = \'%s\' AND "StationCode" = \'%s\' AND '
+                    '("ObservationYear", "ObservationDOY") BETWEEN (%s) AND (%s) AND '
+                    '"Completion" >= %.3f AND "Interval" <= %i'
+                    % (NetworkCode, StationCode, dates[0].yyyy() + ', ' + dates[0].ddd(),
+                       dates[1].yyyy() + ', ' + dates[1].ddd(), COMPLETION, INTERVAL)).dictresult()
 
-            self.good_rinex = [pyDate.Date(year=r['y'], doy=r['d']) for r in rs.dictresult()]
+            self.good_rinex = [pyDate.Date(year=r['y'], doy=r['d']) for r in rs]
 
             # create a list of the missing days
-            good_rinex = [d.mjd for d in self.good_rinex]
+            good_rinex = set([d.mjd for d in self.good_rinex])
 
             self.missing_rinex = [pyDate.Date(mjd=d) for d in range(dates[0].mjd, dates[1].mjd+1)
                                   if d not in good_rinex]
 
-            self.etm = pyETM.PPPETM(cnn, NetworkCode, StationCode)  # type: pyETM.PPPETM
-            self.StationInfo = pyStationInfo.StationInfo(cnn, NetworkCode, StationCode)
+            if data is not None:
+                self.etm = pyETMCache.ppp_etm(cnn, NetworkCode, StationCode,
+                                              ppp_soln=data['ppp_soln'])  # type: pyETM.PPPETM
+                self.StationInfo = pyStationInfo.StationInfo(cnn, NetworkCode, StationCode,
+                                                             records=data['stationinfo'])
+            else:
+                self.etm = pyETMCache.ppp_etm(cnn, NetworkCode, StationCode)  # type: pyETM.PPPETM
+                self.StationInfo = pyStationInfo.StationInfo(cnn, NetworkCode, StationCode)
 
             # DDG: report RINEX files with Completion < 0.5
-            rs = cnn.query_float(
-                'SELECT "ObservationYear" as y, "ObservationDOY" as d FROM rinex_proc '
-                'WHERE "NetworkCode" = \'%s\' AND "StationCode" = \'%s\' AND '
-                '("ObservationYear", "ObservationDOY") BETWEEN (%s) AND (%s) AND '
-                '"Completion" < %.3f AND "Interval" <= %i'
-                % (NetworkCode, StationCode, dates[0].yyyy() + ', ' + dates[0].ddd(),
-                   dates[1].yyyy() + ', ' + dates[1].ddd(), COMPLETION, INTERVAL))
+            if data is not None:
+                rs = [r for r in data['rinex'] if r['c'] < COMPLETION and r['i'] <= INTERVAL]
+            else:
+                rs = cnn.query_float(
+                    'SELECT "ObservationYear" as y, "ObservationDOY" as d FROM rinex_proc '
+                    'WHERE "NetworkCode" = \'%s\' AND "StationCode" = \'%s\' AND '
+                    '("ObservationYear", "ObservationDOY") BETWEEN (%s) AND (%s) AND '
+                    '"Completion" < %.3f AND "Interval" <= %i'
+                    % (NetworkCode, StationCode, dates[0].yyyy() + ', ' + dates[0].ddd(),
+                       dates[1].yyyy() + ', ' + dates[1].ddd(), COMPLETION, INTERVAL))
 
             if len(rs):
                 tqdm.write('    WARNING: The requested date interval has %i days with < 50%% of observations. '
@@ -112,6 +135,34 @@ class Station(object):
         else:
             raise ValueError('Specified station %s.%s could not be found' % (NetworkCode, StationCode))
 
+    def get_apr(self, date, sigma_h, sigma_v):
+        """
+        Obtain the a priori coordinate and sigmas for a date. The first time, the APRs of all the dates with RINEX
+        files are computed in one pass using get_xyz_s_batch
+        :param date: date of the APR
+        :param sigma_h: horizontal sigma floor
+        :param sigma_v: vertical sigma floor
+        :return: same as pyETM.ETM.get_xyz_s
+        """
+        if self.apr is None or self.apr['sigmas'] != (sigma_h, sigma_v):
+            if self.good_rinex:
+                xyz, sig, window, source = self.etm.get_xyz_s_batch(self.good_rinex, sigma_h=sigma_h,
+                                                                    sigma_v=sigma_v)
+            else:
+                xyz, sig, window, source = np.zeros((3, 0)), np.zeros((3, 0)), [], []
+
+            self.apr = {'sigmas': (sigma_h, sigma_v), 'xyz': xyz, 'sig': sig, 'window': window, 'source': source,
+                        'index': dict((d.mjd, i) for i, d in enumerate(self.good_rinex))}
+
+        i = self.apr['index'].get(date.mjd)
+
+        if i is None:
+            # not a date with RINEX files
+            return self.etm.get_xyz_s(date.year, date.doy, sigma_h=sigma_h, sigma_v=sigma_v)
+        else:
+            return self.apr['xyz'][:, i:i + 1], self.apr['sig'][:, i:i + 1], self.apr['window'][i], \
+                   self.apr['source'][i]
+
     def check_gamit_soln(self, cnn, project, date):
         """
         Function to check if a gamit solution exists for this station, project and date
@@ -156,6 +207,49 @@ class Station(object):
         return self
 
 
+def load_station_data(cnn, stations, dates):
+    """
+    Bulk load the records needed to create the Station objects of a list of stations using a few set-based queries
+    (stationalias, stations, rinex_proc, stationinfo and the PPP solutions through pyETM.load_ppp_soln)
+    :param cnn: database connection
+    :param stations: list of station dictionaries (NetworkCode, StationCode)
+    :param dates: start and end date of the processing
+    :return: dictionary (key net.stn) with the records of each station. Pass each item to Station using data=
+    """
+    data = dict()
+    for stn in stations:
+        data[stn['NetworkCode'] + '.' + stn['StationCode']] = {'alias': stn['StationCode'], 'record': None,
+                                                               'rinex': [], 'stationinfo': [], 'ppp_soln': None}
+
+    where = Utils.station_filter(stations)
+
+    if 'public.stationalias' in cnn.get_tables():
+        for r in cnn.query_float('SELECT * FROM stationalias WHERE %s' % where, as_dict=True):
+            data[r['NetworkCode'] + '.' + r['StationCode']]['alias'] = r['StationAlias']
+
+    for r in cnn.query_float('SELECT * FROM stations WHERE %s' % where, as_dict=True):
+        data[r['NetworkCode'] + '.' + r['StationCode']]['record'] = r
+
+    # all the RINEX files in the date window, the filters for completion and interval are applied by Station
+    rs = cnn.query('SELECT "NetworkCode", "StationCode", "ObservationYear" as y, "ObservationDOY" as d, '
+                   '"Completion" as c, "Interval" as i FROM rinex_proc '
+                   'WHERE %s AND ("ObservationYear", "ObservationDOY") BETWEEN (%s) AND (%s) '
+                   'ORDER BY "NetworkCode", "StationCode", "ObservationYear", "ObservationDOY"'
+                   % (where, dates[0].yyyy() + ', ' + dates[0].ddd(), dates[1].yyyy() + ', ' + dates[1].ddd()))
+
+    for r in rs.dictresult():
+        data[r['NetworkCode'] + '.' + r['StationCode']]['rinex'].append(r)
+
+    for r in cnn.query('SELECT * FROM stationinfo WHERE %s ORDER BY "NetworkCode", "StationCode", "DateStart"'
+                       % where).dictresult():
+        data[r['NetworkCode'] + '.' + r['StationCode']]['stationinfo'].append(r)
+
+    for key, soln in pyETM.load_ppp_soln(cnn, stations).items():
+        data[key]['ppp_soln'] = soln
+
+    return data
+
+
 class StationInstance(object):
 
     def __init__(self, cnn, archive, station, date, GamitConfig):
@@ -188,9 +282,9 @@ class StationInstance(object):
 
         # get the APR and sigmas for this date (let get_xyz_s determine which side of the jump returns, if any)
         self.Apr, self.Sigmas, \
-            self.Window, self.source = station.etm.get_xyz_s(self.date.year, self.date.doy,
-                                                             sigma_h=float(GamitConfig.gamitopt['sigma_floor_h']),
-                                                             sigma_v=float(GamitConfig.gamitopt['sigma_floor_v']))
+            self.Window, self.source = station.get_apr(self.date,
+                                                       sigma_h=float(GamitConfig.gamitopt['sigma_floor_h']),
+                                                       sigma_v=float(GamitConfig.gamitopt['sigma_floor_v']))
 
         # rinex file
         self.ArchiveFile = archive.build_rinex_path(self.NetworkCode, self.StationCode,
@@ -13,6 +13,7 @@ import numpy
 from pyDate import Date
 from tqdm import tqdm
 import pyStack
+import pyTimeSeriesStore
 import os
 import re
 from Utils import process_date
@@ -21,7 +22,26 @@ import numpy as np
 import json
 
 pi = 3.141592653589793
-etm_vertices = []
+etm_vertices = dict()
+etm_rows = []
+alignments = []
+
+# metadata of the stations used by pyETM.GamitSoln (loaded once, see calculate_etms)
+gamit_metadata = dict()
+
+# time series and ETM vertices of the last fit of each station (see calculate_etms)
+etm_cache = dict()
+
+# number of stations sent to each job by calculate_etms
+ETM_BATCH_SIZE = 50
+# number of days sent to each job by align_stack
+ALIGN_BATCH_SIZE = 30
+# maximum coordinate change (in meters) of a time series to reuse the ETM of the previous iteration
+ETM_TOLERANCE = 1e-4
+# the iterations stop when the Helmert transformations of all the days are below this value (in meters)
+HELMERT_TOLERANCE = 1e-4
+# mean Earth radius (in meters): used to express the rotations as displacements
+EARTH_RADIUS = 6371000.
 
 
 def plot_etm(cnn, stack, station, directory):
@@ -43,92 +63,387 @@ def plot_etm(cnn, stack, station, directory):
         tqdm.write(str(e))
 
 
-def station_etm(station, stn_ts, stack_name, iteration=0):
+def station_etm(stations, stn_ts, stack_name, iteration=0, metadata=None, series_file=None):
+    """
+    Compute the ETMs of a group of stations. The least squares adjustments of all the stations are performed at once
+    using pyETM.run_batch_adjustment (normal equations solver). The ETMs are built from the metadata sent with the job
+    (see pyETM.load_etm_metadata) and the parameters are saved by the caller, so the database is only accessed on
+    iteration 0 to obtain the PPP ETMs of the target frame
+    :param stations: list of station dictionaries (NetworkCode, StationCode)
+    :param stn_ts: list with the time series of each station or, if series_file is provided, list with the (start,
+                   end) rows of each station in series_file
+    :param stack_name: name of the stack
+    :param iteration: current iteration number
+    :param metadata: list with the GamitSoln and ETM metadata of each station (see pyETM.load_gamit_soln_data and
+                     pyETM.load_etm_metadata)
+    :param series_file: numpy file with the time series of the stack (read using memory mapping)
+    :return: list of (net.stn, ETM vertices) for each station of the group and the etms rows of the parameters
+    """
+    # the PPP ETMs (target frame of iteration 0) are loaded or fitted and saved using the database
+    cnn = dbConnection.Cnn("gnss_data.cfg") if iteration == 0 else None
 
-    cnn = dbConnection.Cnn("gnss_data.cfg")
+    if series_file is not None:
+        series = numpy.load(series_file, mmap_mode='r')
+        stn_ts = [series[s:e] if e > s else numpy.array([]) for s, e in stn_ts]
 
-    vertices = None
+    if metadata is None:
+        metadata = [None] * len(stations)
 
-    try:
-        # save the time series
-        ts = pyETM.GamitSoln(cnn, stn_ts, station['NetworkCode'], station['StationCode'], stack_name)
+    vertices = []
+    etms = []
 
-        # create the ETM object
-        etm = pyETM.GamitETM(cnn, station['NetworkCode'], station['StationCode'], False, False, ts)
+    for station, ts, data in zip(stations, stn_ts, metadata):
+        try:
+            # save the time series
+            ts = pyETM.GamitSoln(cnn, ts, station['NetworkCode'], station['StationCode'], stack_name, data)
 
-        if etm.A is not None:
-            if iteration == 0:
-                # if iteration is == 0, then the target frame has to be the PPP ETMs
-                vertices = etm.get_etm_soln_list(use_ppp_model=True, cnn=cnn)
-            else:
-                # on next iters, the target frame is the inner geometry of the stack
-                vertices = etm.get_etm_soln_list()
+            # create the ETM object
+            etms.append(pyETM.GamitETM(cnn, station['NetworkCode'], station['StationCode'], False, False, ts,
+                                       defer_adjustment=True, solver=pyETM.LSQ_NEQ, metadata=data))
+
+        except pyETM.pyETMException:
+            pass
 
-    except pyETM.pyETMException:
+    # the caller removes the etms records of the stations before computing them: always estimate the parameters
+    pyETM.run_batch_adjustment(None, etms, pyETM.LSQ_NEQ)
 
-        vertices = None
+    # the parameters of all the stations are saved by the caller
+    rows = []
+    for etm in etms:
+        rows += etm.parameter_rows()
 
-    return vertices if vertices else None
+    for etm in etms:
+        try:
+            if etm.A is not None:
+                if iteration == 0:
+                    # if iteration is == 0, then the target frame has to be the PPP ETMs
+                    vertices.append((etm.NetworkCode + '.' + etm.StationCode,
+                                     etm.get_etm_soln_list(use_ppp_model=True, cnn=cnn)))
+                else:
+                    # on next iters, the target frame is the inner geometry of the stack
+                    vertices.append((etm.NetworkCode + '.' + etm.StationCode, etm.get_etm_soln_list()))
+
+        except pyETM.pyETMException:
+            pass
+
+    return vertices, rows
 
 
 def callback_handler(job):
 
     global etm_vertices
+    global etm_rows
 
     if job.exception:
         tqdm.write(' -- Fatal error on node %s message from node follows -> \n%s' % (job.ip_addr, job.exception))
     else:
         if job.result is not None:
-            etm_vertices += job.result
+            etm_vertices.update(job.result[0])
+            etm_rows += job.result[1]
+
+
+def publish_series(series, path, name):
+    """
+    Write the time series of the stack to a numpy file in a directory shared by all the nodes, so that the jobs only
+    carry the rows of each station and the nodes read the coordinates using memory mapping
+    :param series: array with the time series of all the stations [x, y, z, yr, doy, fyear]
+    :param path: shared directory
+    :param name: name of the stack
+    :return: name of the file
+    """
+    filename = os.path.join(path, '%s_series.%i.npy' % (name, os.getpid()))
+
+    # write to a temporary file and rename to avoid partial reads
+    tmp = filename + '.tmp.npy'
+
+    try:
+        numpy.save(tmp, series)
+
+        os.rename(tmp, filename)
+    except Exception:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        raise
+
+    return filename
+
+
+def align_polyhedrons(days, set_aligned):
+    """
+    Align a group of polyhedrons to their target polyhedrons. Only the vertices are sent to the node, the coordinates
+    are updated by the caller using the returned Helmert transformations
+    :param days: list of (index, date, vertices, target vertices)
+    :param set_aligned: mark the polyhedrons as aligned
+    :return: list of (index, helmert, wrms, stations used, iterations) for each polyhedron of the group
+    """
+    # copy the vertices: when running without parallelization these are views of the stack
+    polyhedrons = [pyStack.Polyhedron(vertices.copy(), 'stack', date, sliced=True) for _, date, vertices, _ in days]
+    targets = [pyStack.Polyhedron(target_vertices, 'etm', date, sliced=True) for _, date, _, target_vertices in days]
+
+    # the Helmert transformations of all the days of the group are estimated at once
+    pyStack.align_batch(polyhedrons, targets, set_aligned)
+
+    return [(day[0], poly.helmert, poly.wrms, poly.stations_used, poly.iterations)
+            for day, poly in zip(days, polyhedrons)]
 
 
-def calculate_etms(cnn, stack, JobServer, iterations, create_target=True):
+def align_callback(job):
+
+    global alignments
+
+    if job.exception:
+        tqdm.write(' -- Fatal error on node %s message from node follows -> \n%s' % (job.ip_addr, job.exception))
+    else:
+        alignments += job.result
+
+
+def align_stack(stack, target, JobServer, set_aligned):
     """
-    Parallel calculation of ETMs to save some time
+    Parallel alignment of the unaligned polyhedrons of the stack to their targets. The Helmert transformations are
+    estimated in the nodes and then applied to the polyhedrons of the stack
+    :param stack: object with the list of polyhedrons
+    :param target: list of target polyhedrons (output of calculate_etms)
+    :param JobServer: parallel.python object
+    :param set_aligned: mark the polyhedrons as aligned
+    :return: None
+    """
+    global alignments
+
+    days = []
+    for j in range(len(stack)):
+        if not stack[j].aligned:
+            # do not move this if up one level: to speed up the target polyhedron loading process, the target is
+            # set to an empty list when the polyhedron is already aligned
+            if stack[j].date != target[j].date:
+                # raise an error if dates don't agree!
+                raise StandardError('Error processing %s: dates don\'t agree (target date %s)'
+                                    % (stack[j].date.yyyyddd(), target[j].date.yyyyddd()))
+
+            days.append((j, stack[j].date, stack[j].vertices, target[j].vertices))
+
+    # the progress bar reports the number of groups of days (jobs) processed
+    qbar = tqdm(total=int(np.ceil(len(days) / float(ALIGN_BATCH_SIZE))), desc=' -- Aligning polyhedrons', ncols=160,
+                disable=None)
+
+    alignments = []
+
+    JobServer.create_cluster(align_polyhedrons, progress_bar=qbar, callback=align_callback,
+                             modules=('pyStack', 'numpy'))
+
+    for i in range(0, len(days), ALIGN_BATCH_SIZE):
+        JobServer.submit(days[i:i + ALIGN_BATCH_SIZE], set_aligned)
+
+    JobServer.wait()
+
+    qbar.close()
+
+    JobServer.close_cluster()
+
+    # days of the jobs that failed in the nodes: align them locally (if this fails, the error is raised as in the
+    # serial version) so that no unaligned polyhedrons are saved as part of the stack
+    done = set(a[0] for a in alignments)
+    missing = [day for day in days if day[0] not in done]
+
+    if missing:
+        tqdm.write(' -- %i polyhedrons could not be aligned in the nodes: aligning them locally' % len(missing))
+        alignments += align_polyhedrons(missing, set_aligned)
+
+    for j, helmert, wrms, stations_used, iterations in sorted(alignments, key=lambda a: a[0]):
+        # apply the transformation estimated by the node
+        stack[j].align(helmert=helmert, set_aligned=set_aligned)
+
+        stack[j].helmert = helmert
+        stack[j].wrms = wrms
+        stack[j].stations_used = stations_used
+        stack[j].iterations = iterations
+
+        # write info to the screen
+        tqdm.write(' -- %s (%3i) %2i it: wrms: %4.1f T %5.1f %5.1f %5.1f '
+                   'R (%5.1f %5.1f %5.1f)*1e-9' %
+                   (stack[j].date.yyyyddd(), stack[j].stations_used, stack[j].iterations,
+                    stack[j].wrms * 1000, stack[j].helmert[-3] * 1000, stack[j].helmert[-2] * 1000,
+                    stack[j].helmert[-1] * 1000, stack[j].helmert[-6], stack[j].helmert[-5],
+                    stack[j].helmert[-4]))
+
+    alignments = []
+
+
+def same_series(ts, previous):
+    """
+    Check if a time series has the same epochs as the time series used in the previous fit of the ETM and if the
+    coordinates changed less than ETM_TOLERANCE
+    :param ts: current time series [x, y, z, yr, doy, fyear]
+    :param previous: time series of the previous fit
+    :return: True if the ETM of the previous fit can be reused
+    """
+    if ts.shape != previous.shape:
+        return False
+
+    if not ts.size:
+        return True
+
+    return np.array_equal(ts[:, 3:5], previous[:, 3:5]) and np.max(np.abs(ts[:, 0:3] - previous[:, 0:3])) < \
+        ETM_TOLERANCE
+
+
+def helmert_converged(stack):
+    """
+    Check if the Helmert transformations estimated in the last alignment of the stack are below HELMERT_TOLERANCE
+    (translations and rotations expressed as displacements at the surface of the Earth)
+    :param stack: object with the list of polyhedrons
+    :return: True if the transformations converged
+    """
+    # polyhedrons without a transformation (helmert is None or, after Polyhedron.info, an empty array) are ignored
+    helmert = [poly.helmert.flatten() for poly in stack
+               if not poly.aligned and poly.helmert is not None and poly.helmert.size]
+
+    if not helmert:
+        return False
+
+    helmert = np.vstack(helmert)
+
+    rotations = np.max(np.abs(helmert[:, 0:3])) * 1e-9 * EARTH_RADIUS
+    translations = np.max(np.abs(helmert[:, 3:6]))
+
+    tqdm.write(' -- Maximum Helmert transformation: T %.2f R %.2f [mm]' % (translations * 1000, rotations * 1000))
+
+    return max(rotations, translations) < HELMERT_TOLERANCE
+
+
+def calculate_etms(cnn, stack, JobServer, iterations, create_target=True, shared_path=None):
+    """
+    Parallel calculation of ETMs to save some time. The ETMs of the stations with time series that did not change
+    (see same_series) since their last fit are not recomputed: their parameters remain in the etms table and their
+    vertices are reused
     :param cnn: connection to the db
     :param stack: object with the list of polyhedrons
     :param JobServer: parallel.python object
     :param iterations: current iteration number
     :param create_target: indicate if function should create and return target polyhedrons
+    :param shared_path: directory shared by all the nodes. If provided, the time series are sent to the nodes using
+                        a memory mapped file (see publish_series) instead of being serialized in each job
     :return: the target polyhedron list that will be used for alignment (if create_target = True)
     """
     global etm_vertices
+    global etm_rows
+
+    # on iteration 0 the vertices come from the PPP ETMs
+    model = 'ppp' if iterations == 0 else 'stack'
+
+    # time series of all the stations (sorted by station) extracted from the polyhedron data
+    stack_series, index = stack.index.get_series()
+
+    # find the stations that changed since their last fit
+    series = dict()
+    rows = dict()
+    changed = []
+    for station in stack.stations:
+        stn = station['NetworkCode'] + '.' + station['StationCode']
 
-    qbar = tqdm(total=len(stack.stations), desc=' >> Calculating ETMs', ncols=160, disable=None)
+        rows[stn] = index.get(stn, (0, 0))
+        series[stn] = stack_series[rows[stn][0]:rows[stn][1]] if rows[stn][1] > rows[stn][0] else np.array([])
 
-    modules = ('pyETM', 'pyDate', 'dbConnection', 'traceback')
+        if stn not in etm_cache or etm_cache[stn][1] != model or not same_series(series[stn], etm_cache[stn][0]):
+            changed.append(station)
+
+    if len(changed) < len(stack.stations):
+        tqdm.write(' -- %i stations with unchanged time series: reusing their ETMs'
+                   % (len(stack.stations) - len(changed)))
+
+    # the progress bar reports the number of station groups (jobs) processed
+    qbar = tqdm(total=int(np.ceil(len(changed) / float(ETM_BATCH_SIZE))), desc=' >> Calculating ETMs',
+                ncols=160, disable=None)
+
+    modules = ('pyETM', 'pyDate', 'dbConnection', 'traceback', 'numpy')
 
     JobServer.create_cluster(station_etm, progress_bar=qbar, callback=callback_handler, modules=modules)
 
-    # delete all the solutions from the ETMs table
-    cnn.query('DELETE FROM etms WHERE "soln" = \'gamit\' AND "stack" = \'%s\'' % stack.name)
-    # reset the etm_vertices list
-    etm_vertices = []
+    if not etm_cache:
+        # delete all the solutions from the ETMs table
+        cnn.query('DELETE FROM etms WHERE "soln" = \'gamit\' AND "stack" = \'%s\'' % stack.name)
+    else:
+        # only delete the solutions of the stations that will be recomputed
+        for i in range(0, len(changed), 500):
+            cnn.query('DELETE FROM etms WHERE "soln" = \'gamit\' AND "stack" = \'%s\' AND '
+                      '"NetworkCode" || \'.\' || "StationCode" IN (\'%s\')'
+                      % (stack.name, '\', \''.join([stn['NetworkCode'] + '.' + stn['StationCode']
+                                                    for stn in changed[i:i + 500]])))
+
+    # reset the etm_vertices dictionary
+    etm_vertices = dict()
+    etm_rows = []
+
+    # metadata of the stations (station record, missing solutions, etm_params, station information and earthquakes)
+    # loaded in one go and sent with the jobs so that the nodes do not need to query the database
+    missing = [stn for stn in changed if stn['NetworkCode'] + '.' + stn['StationCode'] not in gamit_metadata]
+    for i in range(0, len(missing), 500):
+        data = pyETM.load_gamit_soln_data(cnn, missing[i:i + 500], stack.name)
+        gamit_metadata.update(pyETM.load_etm_metadata(cnn, missing[i:i + 500], data))
+
+    series_file = publish_series(stack_series, shared_path, stack.name) if shared_path and changed else None
 
-    for station in stack.stations:
+    try:
+        for i in range(0, len(changed), ETM_BATCH_SIZE):
 
-        # extract the time series from the polyhedron data
-        stn_ts = stack.get_station(station['NetworkCode'], station['StationCode'])
+            stations = changed[i:i + ETM_BATCH_SIZE]
 
-        JobServer.submit(station, stn_ts, stack.name, iterations)
+            keys = [station['NetworkCode'] + '.' + station['StationCode'] for station in stations]
 
-    JobServer.wait()
+            if series_file is not None:
+                # only send the rows of each station in the shared file
+                stn_ts = [rows[key] for key in keys]
+            else:
+                stn_ts = [series[key] for key in keys]
 
-    qbar.close()
+            JobServer.submit(stations, stn_ts, stack.name, iterations, [gamit_metadata.get(key) for key in keys],
+                             series_file)
 
-    JobServer.close_cluster()
+        JobServer.wait()
+
+        qbar.close()
+
+        JobServer.close_cluster()
+    finally:
+        # do not leave the time series of the stack in the shared directory
+        if series_file is not None and os.path.isfile(series_file):
+            os.remove(series_file)
+
+    # save the parameters of all the stations at once
+    cnn.bulk_insert('etms', etm_rows)
+    etm_rows = []
 
-    vertices = numpy.array(etm_vertices, dtype=[('stn', 'S8'), ('x', 'float64'), ('y', 'float64'),
+    # update the cache with the new fits
+    for station in changed:
+        stn = station['NetworkCode'] + '.' + station['StationCode']
+
+        if stn in etm_vertices:
+            # copy: do not keep a reference to the time series of the whole stack
+            etm_cache[stn] = (series[stn].copy(), model, etm_vertices[stn])
+        else:
+            # the ETM could not be computed
+            etm_cache.pop(stn, None)
+
+    etm_vertices = dict()
+
+    vertices = []
+    for station in stack.stations:
+        stn = station['NetworkCode'] + '.' + station['StationCode']
+        if stn in etm_cache:
+            vertices += etm_cache[stn][2]
+
+    vertices = numpy.array(vertices, dtype=[('stn', 'S8'), ('x', 'float64'), ('y', 'float64'),
                                                 ('z', 'float64'), ('yr', 'i4'), ('dd', 'i4'),
                                                 ('fy', 'float64')])
 
     if create_target:
+        days = pyStack.split_vertices(vertices)
+
         target = []
         for i in tqdm(range(len(stack.dates)), ncols=160, desc=' >> Initializing the target polyhedrons', disable=None):
             dd = stack.dates[i]
             if not stack[i].aligned:
                 # not aligned, put in a target polyhedron
-                target.append(pyStack.Polyhedron(vertices, 'etm', dd))
+                target.append(pyStack.Polyhedron(pyStack.get_day(days, vertices, dd), 'etm', dd, sliced=True))
             else:
                 # already aligned, no need for a target polyhedron
                 target.append([])
@@ -254,6 +569,9 @@ def main():
                         help='Limit the polyhedrons to the specified date. Can be in wwww-d, yyyy_ddd, yyyy/mm/dd '
                              'or fyear format')
     parser.add_argument('-np', '--noparallel', action='store_true', help="Execute command without parallelization.")
+    parser.add_argument('-nocp', '--no_checkpoint', action='store_true', default=False,
+                        help="Remove the checkpoint of a previous (interrupted) run of this stack, if any, and start "
+                             "from the beginning. By default, the stack resumes from the checkpoint")
 
     args = parser.parse_args()
 
@@ -263,6 +581,9 @@ def main():
 
     JobServer = pyJobServer.JobServer(Config, run_parallel=not args.noparallel)  # type: pyJobServer.JobServer
 
+    # directory shared by the nodes used to send the time series to calculate_etms
+    shared_path = os.path.expandvars(Config.options['shared_tmp'].strip()) if Config.options['shared_tmp'] else None
+
     if args.max_iters:
         max_iters = int(args.max_iters[0])
     else:
@@ -302,51 +623,58 @@ def main():
     else:
         constrains = None
 
+    # use the local time series store to load the GAMIT solutions (if configured)
+    store = pyTimeSeriesStore.open_store(cnn, 'gamit', args.project[0]) if args.redo_stack else None
+
+    # checkpoint file to resume the stacking process if it is interrupted
+    checkpoint = args.stack_name[0] + '_checkpoint.npz'
+
+    if args.no_checkpoint and os.path.isfile(checkpoint):
+        print ' >> Removing checkpoint %s' % checkpoint
+        os.remove(checkpoint)
+
     # create the stack object
-    stack = pyStack.Stack(cnn, args.project[0], args.stack_name[0], args.redo_stack, end_date=dates[1])
+    stack = pyStack.Stack(cnn, args.project[0], args.stack_name[0], args.redo_stack, end_date=dates[1], store=store,
+                          checkpoint=checkpoint)
+
+    if stack.iteration >= 0:
+        print ' >> Use -nocp to discard the checkpoint and start the stack from the beginning'
+
+    # first iteration to run. If days were added since the checkpoint, run (at least) the last iteration to align them
+    start = stack.iteration + 1
+    if any(not poly.aligned for poly in stack):
+        start = min(start, max_iters - 1)
 
     # stack.align_spaces(frame_params)
     # stack.to_json('alignment.json')
     # exit()
 
-    for i in range(max_iters):
+    i = start
+    while i < max_iters:
         # create the target polyhedrons based on iteration number (i == 0: PPP)
 
-        target = calculate_etms(cnn, stack, JobServer, i)
+        target = calculate_etms(cnn, stack, JobServer, i, shared_path=shared_path)
 
-        qbar = tqdm(total=len(stack), ncols=160,
-                    desc=' >> Aligning polyhedrons (%i of %i)' % (i+1, max_iters), disable=None)
+        tqdm.write(' >> Aligning polyhedrons (%i of %i)' % (i + 1, max_iters))
 
-        # work on each polyhedron of the stack
-        for j in range(len(stack)):
+        # do not set the polyhedrons as aligned unless we are in the max iteration step
+        align_stack(stack, target, JobServer, True if i == max_iters - 1 else False)
 
-            qbar.update()
+        stack.transformations.append([poly.info() for poly in stack])
 
-            if not stack[j].aligned:
-                # do not move this if up one level: to speed up the target polyhedron loading process, the target is
-                # set to an empty list when the polyhedron is already aligned
-                if stack[j].date != target[j].date:
-                    # raise an error if dates don't agree!
-                    raise StandardError('Error processing %s: dates don\'t agree (target date %s)'
-                                        % (stack[j].date.yyyyddd(), target[j].date.yyyyddd()))
-                else:
-                    # should only attempt to align a polyhedron that is unaligned
-                    # do not set the polyhedron as aligned unless we are in the max iteration step
-                    stack[j].align(target[j], True if i == max_iters - 1 else False)
-                    # write info to the screen
-                    qbar.write(' -- %s (%3i) %2i it: wrms: %4.1f T %5.1f %5.1f %5.1f '
-                               'R (%5.1f %5.1f %5.1f)*1e-9' %
-                               (stack[j].date.yyyyddd(), stack[j].stations_used, stack[j].iterations,
-                                stack[j].wrms * 1000, stack[j].helmert[-3] * 1000, stack[j].helmert[-2] * 1000,
-                                stack[j].helmert[-1] * 1000, stack[j].helmert[-6], stack[j].helmert[-5],
-                                stack[j].helmert[-4]))
+        if 0 < i < max_iters - 2 and helmert_converged(stack):
+            # the transformations converged: go directly to the last iteration (which marks the polyhedrons as
+            # aligned). Iteration 0 is aligned to the PPP ETMs, so at least one iteration against the stack is needed
+            tqdm.write(' >> Helmert transformations converged: skipping to the last iteration')
+            i = max_iters - 2
 
-        stack.transformations.append([poly.info() for poly in stack])
-        qbar.close()
+        stack.save_checkpoint(checkpoint, i)
+
+        i += 1
 
     if args.redo_stack:
         # before removing common modes (or inheriting periodic terms), calculate ETMs with final aligned solutions
-        calculate_etms(cnn, stack, JobServer, iterations=None, create_target=False)
+        calculate_etms(cnn, stack, JobServer, iterations=None, create_target=False, shared_path=shared_path)
         # only apply common mode removal if redoing the stack
         if args.external_constrains:
             stack.remove_common_modes(constrains)
@@ -357,13 +685,20 @@ def main():
         stack.align_spaces(constrains)
 
     # calculate the etms again, after removing or inheriting parameters
-    calculate_etms(cnn, stack, JobServer, iterations=None, create_target=False)
+    calculate_etms(cnn, stack, JobServer, iterations=None, create_target=False, shared_path=shared_path)
 
     # save the json with the information about the alignment
     stack.to_json(args.stack_name[0] + '_alignment.json')
     # save polyhedrons to the database
     stack.save()
 
+    # the stack is complete: the checkpoint is no longer needed
+    if os.path.isfile(checkpoint):
+        os.remove(checkpoint)
+
+    # update the local copy of the stack (used by the ETM plotting and query tools)
+    pyTimeSeriesStore.open_store(cnn, 'stack', args.stack_name[0])
+
     if args.plot_stack_etms:
         qbar = tqdm(total=len(stack.stations), ncols=160, disable=None)
         for stn in stack.stations:
@@ -8,10 +8,17 @@ import dbConnection
 import argparse
 import pyETM
 import pyDate
+import pyOptions
+import pyJobServer
+import pyTimeSeriesStore
+import pyStack
 import os
 import numpy as np
 from Utils import process_date
-from pyStack import Polyhedron
+from pyStack import split_vertices
+from pyStack import get_day
+from pyStack import day_fingerprints
+from pyStack import same_day
 from datetime import datetime
 from tqdm import tqdm
 from pyDate import Date
@@ -19,6 +26,18 @@ import json
 
 LIMIT = 2.5
 
+# number of day pairs sent to each job (the vertices of each group of days are loaded from the db or store at once)
+DRA_BATCH_SIZE = 30
+
+VERTICES_DTYPE = [('stn', 'S8'), ('x', 'float64'), ('y', 'float64'), ('z', 'float64'), ('yr', 'i4'), ('dd', 'i4'),
+                  ('fy', 'float64')]
+
+# daily repetitivity residuals: aligned day minus previous day, for the stations present in both days
+RESIDUALS_DTYPE = [('stn', 'S8'), ('dx', 'float64'), ('dy', 'float64'), ('dz', 'float64'), ('yr', 'i4'),
+                   ('dd', 'i4'), ('fy', 'float64')]
+
+pairs = []
+
 
 def sql_select(project, fields, date2):
 
@@ -29,36 +48,87 @@ def sql_select(project, fields, date2):
     return sql
 
 
-class DRA(list):
+def align_pairs(days, dtype):
+    """
+    Align each polyhedron to the polyhedron of the previous day and compute the residuals of the common stations
+    :param days: list of (index, date, vertices, vertices of the previous day)
+    :param dtype: dtype of the residuals (RESIDUALS_DTYPE, passed with the job: the nodes do not have the globals of
+                  this module)
+    :return: list of (index, helmert, wrms, stations used, iterations, residuals) for each day of the group
+    """
+    # this function runs in the nodes, which only have the modules of the job imported by name (see
+    # pyJobServer.setup): import the alias here
+    import numpy as np
+
+    result = []
+
+    # copy the vertices: when running without parallelization these are views of the loaded days
+    polyhedrons = [pyStack.Polyhedron(vertices.copy(), 'dra', date, sliced=True) for _, date, vertices, _ in days]
+    targets = [pyStack.Polyhedron(target_vertices, 'dra', date, sliced=True) for _, date, _, target_vertices in days]
+
+    # the Helmert transformations of all the days of the group are estimated at once
+    pyStack.align_batch(polyhedrons, targets, scale=False)
+
+    for (j, date, _, _), poly, target in zip(days, polyhedrons, targets):
+        # both polyhedrons are sorted by station
+        fl = np.isin(poly.vertices['stn'], target.vertices['stn'])
+        ft = np.isin(target.vertices['stn'], poly.vertices['stn'])
+
+        residuals = np.zeros(np.sum(fl), dtype=dtype)
+
+        residuals['stn'] = poly.vertices['stn'][fl]
+        residuals['yr'] = poly.vertices['yr'][fl]
+        residuals['dd'] = poly.vertices['dd'][fl]
+        residuals['fy'] = poly.vertices['fy'][fl]
+
+        for c in ('x', 'y', 'z'):
+            residuals['d' + c] = poly.vertices[c][fl] - target.vertices[c][ft]
+
+        result.append((j, poly.helmert, poly.wrms, poly.stations_used, poly.iterations, residuals))
+
+    return result
+
+
+def align_callback(job):
+
+    global pairs
+
+    if job.exception:
+        tqdm.write(' -- Fatal error on node %s message from node follows -> \n%s' % (job.ip_addr, job.exception))
+    else:
+        pairs += job.result
 
-    def __init__(self, cnn, project, end_date):
 
-        super(DRA, self).__init__()
+class DRA(object):
 
+    def __init__(self, cnn, project, end_date, store=None, output=None):
+        """
+        Daily repetitivity analysis of a GAMIT project: each day is aligned to the previous day. The solutions are
+        streamed from the database (or the time series store) in groups of days, so the project is never loaded at
+        once, and the alignments are run in parallel
+        :param cnn: connection to the database
+        :param project: GAMIT project
+        :param end_date: last date of the analysis
+        :param store: time series store of the project (optional)
+        :param output: npz file with the results of a previous run. Only the new days and the days with changes in
+                       their GAMIT solutions (or in the solutions of the previous day) are processed
+        """
         self.project = project
         self.cnn = cnn
+        self.store = store
         self.transformations = []
 
         if end_date is None:
             end_date = Date(datetime=datetime.now())
 
-        print ' >> Loading GAMIT solutions for project %s...' % project
-
-        gamit_vertices = self.cnn.query_float(
-            'SELECT "NetworkCode" || \'.\' || "StationCode", "X", "Y", "Z", "Year", "DOY", "FYear" '
-            'FROM gamit_soln WHERE "Project" = \'%s\' AND ("Year", "DOY") <= (%i, %i)'
-            'ORDER BY "NetworkCode", "StationCode"' % (project, end_date.year, end_date.doy))
-
-        self.gamit_vertices = np.array(gamit_vertices, dtype=[('stn', 'S8'), ('x', 'float64'), ('y', 'float64'),
-                                                              ('z', 'float64'), ('yr', 'i4'), ('dd', 'i4'),
-                                                              ('fy', 'float64')])
+        self.end_date = end_date
 
-        dates = self.cnn.query_float('SELECT "Year", "DOY" FROM gamit_soln WHERE "Project" = \'%s\' '
-                                     'AND ("Year", "DOY") <= (%i, %i) '
-                                     'GROUP BY "Year", "DOY" ORDER BY "Year", "DOY"'
-                                     % (project, end_date.year, end_date.doy))
+        # fingerprint of each day of the project (same rule as the stacker, see pyStack.day_fingerprints): used to
+        # find new or changed days
+        fingerprints = day_fingerprints(self.cnn, 'gamit_soln', '"Project" = \'%s\'' % project, end_date)
 
-        self.dates = [Date(year=int(d[0]), doy=int(d[1])) for d in dates]
+        self.days = [[d[0], d[1], v[0], v[1]] for d, v in sorted(fingerprints.items())]
+        self.dates = [Date(year=d[0], doy=d[1]) for d in self.days]
 
         self.stations = self.cnn.query_float('SELECT "NetworkCode", "StationCode" FROM gamit_soln '
                                              'WHERE "Project" = \'%s\' AND ("Year", "DOY") <= (%i, %i) '
@@ -66,44 +136,162 @@ class DRA(list):
                                              'ORDER BY "NetworkCode", "StationCode"'
                                              % (project, end_date.year, end_date.doy), as_dict=True)
 
-        for d in tqdm(self.dates, ncols=160, desc=' >> Initializing the stack polyhedrons'):
-            self.append(Polyhedron(self.gamit_vertices, project, d))
+        # results of each day (index of self.dates): Polyhedron.info() dictionary
+        self.results = dict()
+        self.residuals = np.zeros(0, dtype=RESIDUALS_DTYPE)
+        self.index = dict()
+
+        if output is not None and os.path.isfile(output):
+            self.load(output)
+
+    def load(self, filename):
+        """
+        Load the results of a previous run. The result of a day is kept if the day and its previous day have the same
+        GAMIT solutions (same fingerprint, see pyStack.same_day)
+        :param filename: npz file created by save
+        :return: nothing
+        """
+        data = np.load(filename)
+        meta = json.loads(str(data['meta']))
+
+        if meta['project'] != self.project:
+            print ' >> Ignoring %s: it belongs to project %s' % (filename, meta['project'])
+            return
+
+        current = dict((tuple(d[0:2]), j) for j, d in enumerate(self.days))
+
+        keep = set()
+        for prev, day, info in zip(meta['days'][:-1], meta['days'][1:], meta['transformations']):
+            j = current.get(tuple(day[0:2]))
+
+            if info is not None and j is not None and j > 0 and self.days[j - 1][0:2] == prev[0:2] and \
+                    same_day(self.days[j][2:], day[2:]) and same_day(self.days[j - 1][2:], prev[2:]):
+                self.results[j] = info
+                keep.add(day[0] * 1000 + day[1])
+
+        residuals = data['residuals']
+        self.residuals = residuals[np.isin(residuals['yr'] * 1000 + residuals['dd'], list(keep))]
+
+        print ' >> Loaded %i days from %s (%i days to process)' \
+              % (len(self.results), filename, max(len(self.days) - 1 - len(self.results), 0))
+
+    def save(self, filename):
+        """
+        Save the results (transformations and residuals) to a npz file
+        :param filename: npz file
+        :return: nothing
+        """
+        meta = {'project': self.project, 'days': self.days,
+                'transformations': [self.results.get(j) for j in range(1, len(self.days))]}
+
+        # write to a temporary file and rename to avoid leaving a partial file
+        tmp = filename + '.tmp.npz'
+
+        np.savez(tmp, meta=np.array(json.dumps(meta)), residuals=self.residuals)
+
+        os.rename(tmp, filename)
+
+    def load_vertices(self, start_date, end_date):
+        """
+        Load the GAMIT solutions between two dates from the time series store or the database
+        """
+        if self.store is not None:
+            return self.store.get_vertices(end_date, start_date)
+        else:
+            vertices = self.cnn.query_float(
+                'SELECT "NetworkCode" || \'.\' || "StationCode", "X", "Y", "Z", "Year", "DOY", "FYear" '
+                'FROM gamit_soln WHERE "Project" = \'%s\' AND ("Year", "DOY") BETWEEN (%i, %i) AND (%i, %i) '
+                'ORDER BY "NetworkCode", "StationCode"'
+                % (self.project, start_date.year, start_date.doy, end_date.year, end_date.doy))
+
+            return np.array(vertices, dtype=VERTICES_DTYPE)
+
+    def stack_dra(self, JobServer):
+        """
+        Align each day to the previous day. The days are loaded in groups of DRA_BATCH_SIZE days and each group is
+        submitted as a job
+        :param JobServer: parallel.python object
+        :return: nothing
+        """
+        global pairs
+
+        todo = [j for j in range(1, len(self.dates)) if j not in self.results]
+
+        # group consecutive days that need to be processed
+        groups = []
+        for j in todo:
+            if groups and groups[-1][-1] == j - 1 and len(groups[-1]) < DRA_BATCH_SIZE:
+                groups[-1].append(j)
+            else:
+                groups.append([j])
+
+        qbar = tqdm(total=len(groups), desc=' >> Daily repetitivity analysis progress', ncols=160, disable=None)
+
+        pairs = []
+
+        JobServer.create_cluster(align_pairs, progress_bar=qbar, callback=align_callback,
+                                 modules=('pyStack', 'numpy'))
+
+        for group in groups:
+            # load the days of the group and their previous days
+            vertices = self.load_vertices(self.dates[group[0] - 1], self.dates[group[-1]])
+
+            days = split_vertices(vertices)
+
+            JobServer.submit([(j, self.dates[j], get_day(days, vertices, self.dates[j]),
+                               get_day(days, vertices, self.dates[j - 1])) for j in group], RESIDUALS_DTYPE)
 
-    def stack_dra(self):
+        JobServer.wait()
 
-        for j in tqdm(range(len(self) - 1), desc=' >> Daily repetitivity analysis progress', ncols=160):
+        qbar.close()
+
+        JobServer.close_cluster()
+
+        residuals = [self.residuals]
+
+        for j, helmert, wrms, stations_used, iterations, res in sorted(pairs, key=lambda a: a[0]):
+            self.results[j] = {'date': str(self.dates[j]), 'wrms': float(wrms), 'stations_used': int(stations_used),
+                               'iterations': int(iterations), 'helmert': helmert.tolist()}
+
+            residuals.append(res)
 
-            # should only attempt to align a polyhedron that is unaligned
-            # do not set the polyhedron as aligned unless we are in the max iteration step
-            self[j + 1].align(self[j], scale=False)
             # write info to the screen
             tqdm.write(' -- %s (%3i) %2i it wrms: %4.1f T %6.1f %6.1f %6.1f '
                        'R (%6.1f %6.1f %6.1f)*1e-9' %
-                       (self[j + 1].date.yyyyddd(), self[j + 1].stations_used, self[j + 1].iterations,
-                        self[j + 1].wrms * 1000, self[j + 1].helmert[3] * 1000, self[j + 1].helmert[4] * 1000,
-                        self[j + 1].helmert[5] * 1000, self[j + 1].helmert[0], self[j + 1].helmert[1],
-                        self[j + 1].helmert[2]))
+                       (self.dates[j].yyyyddd(), stations_used, iterations, wrms * 1000, helmert[3] * 1000,
+                        helmert[4] * 1000, helmert[5] * 1000, helmert[0], helmert[1], helmert[2]))
+
+        pairs = []
+
+        self.residuals = np.concatenate(residuals)
+
+        self.transformations = [[self.results[j] for j in range(1, len(self.dates)) if j in self.results]]
+
+        # station index of the residuals
+        order = np.lexsort((self.residuals['dd'], self.residuals['yr'], self.residuals['stn']))
+        self.residuals = self.residuals[order]
 
-        self.transformations.append([poly.info() for poly in self[1:]])
+        stn = self.residuals['stn']
+        start = np.where(np.append(True, stn[1:] != stn[:-1]))[0] if stn.size else np.array([], dtype=int)
+        end = np.append(start[1:], stn.size)
+
+        self.index = dict((s, (i, e)) for s, i, e in zip(stn[start].tolist(), start, end))
 
     def get_station(self, NetworkCode, StationCode):
         """
-        Obtains the time series for a given station
+        Obtains the daily repetitivity time series for a given station
         :param NetworkCode:
         :param StationCode:
-        :return: a numpy array with the time series [x, y, z, yr, doy, fyear]
+        :return: a numpy array with the time series [dx, dy, dz, yr, doy, fyear]
         """
+        s, e = self.index.get(NetworkCode + '.' + StationCode, (0, 0))
 
-        stnstr = NetworkCode + '.' + StationCode
-
-        ts = []
+        if e == s:
+            return np.array([])
 
-        for poly in self:
-            p = poly.vertices[poly.vertices['stn'] == stnstr]
-            if p.size:
-                ts.append([p['x'][0], p['y'][0], p['z'][0], p['yr'][0], p['dd'][0], p['fy'][0]])
+        r = self.residuals[s:e]
 
-        return np.array(ts)
+        return np.column_stack((r['dx'], r['dy'], r['dz'], r['yr'], r['dd'], r['fy']))
 
     def to_json(self, json_file):
         json_dump = dict()
@@ -121,10 +309,16 @@ def main():
                         help="Specify the project name used to process the GAMIT solutions in Parallel.GAMIT.")
     parser.add_argument('-d', '--date_filter', nargs='+', metavar='date',
                         help='Date range filter Can be specified in yyyy/mm/dd yyyy_doy  wwww-d format')
+    parser.add_argument('-redo', '--redo_dra', action='store_true',
+                        help="Ignore the results of previous runs and process all the days of the project.")
+    parser.add_argument('-np', '--noparallel', action='store_true', help="Execute command without parallelization.")
 
     args = parser.parse_args()
 
     cnn = dbConnection.Cnn("gnss_data.cfg")
+    Config = pyOptions.ReadOptions("gnss_data.cfg")  # type: pyOptions.ReadOptions
+
+    JobServer = pyJobServer.JobServer(Config, run_parallel=not args.noparallel)  # type: pyJobServer.JobServer
 
     project = args.project[0]
 
@@ -142,22 +336,30 @@ def main():
     ########################################
     # load polyhedrons
 
-    dra = DRA(cnn, args.project[0], dates[1])
+    # use the local time series store, if configured
+    store = pyTimeSeriesStore.open_store(cnn, 'gamit', project)
+
+    output = project + '_dra.npz'
 
-    dra.stack_dra()
+    if args.redo_dra and os.path.isfile(output):
+        os.remove(output)
+
+    dra = DRA(cnn, args.project[0], dates[1], store, output)
+
+    dra.stack_dra(JobServer)
+
+    dra.save(output)
 
     for stn in tqdm(dra.stations):
         NetworkCode = stn['NetworkCode']
         StationCode = stn['StationCode']
 
-        # load from the db
-        ts = dra.get_station(NetworkCode, StationCode)
+        # daily repetitivity residuals of the station
+        dts = dra.get_station(NetworkCode, StationCode)
 
-        if ts.size:
+        if dts.size:
             try:
-                if ts.shape[0] > 2:
-                    dts = np.append(np.diff(ts[:, 0:3], axis=0), ts[1:, -3:], axis=1)
-
+                if dts.shape[0] > 1:
                     dra_ts = pyETM.GamitSoln(cnn, dts, NetworkCode, StationCode, project)
 
                     etm = pyETM.DailyRep(cnn, NetworkCode, StationCode, False, False, dra_ts)
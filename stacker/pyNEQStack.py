@@ -17,7 +17,11 @@ import traceback
 from pprint import pprint
 import os
 import numpy as np
+import json
 from scipy.stats import chi2
+from scipy import sparse
+from scipy.sparse.linalg import LinearOperator
+from scipy.sparse.linalg import cg
 from Utils import process_date
 from Utils import ct2lg
 from Utils import ecef2lla
@@ -25,6 +29,14 @@ from Utils import rotct2lg
 
 LIMIT = 2.5
 
+# parameters of the daily Helmert transformations (three rotations and three translations, as in pyStack.Polyhedron)
+HELMERT_PARAMS = 6
+# weight of the minimal constraints that define the datum (relative to the weight of the observations)
+DATUM_WEIGHT = 1e3
+# tolerance and maximum number of iterations of the conjugate gradient solver
+CG_TOLERANCE = 1e-10
+CG_MAXITER = 5000
+
 
 def adjust_lsq(A, L, P=None):
 
@@ -150,52 +162,380 @@ def rotate_sigmas(ecef, lat, lon):
     return dneu
 
 
-def dra(cnn, project, dates):
+def load_etms(cnn, project, dates):
+    """
+    Create the ETMs (design matrix only, no adjustment) of the stations of the project using their GAMIT solutions
+    :param cnn: connection to the database
+    :param project: GAMIT project
+    :param dates: date range
+    :return: list of GamitETM objects
+    """
+    vertices = cnn.query_float('SELECT "NetworkCode" || \'.\' || "StationCode", "X", "Y", "Z", "Year", "DOY" '
+                               'FROM gamit_soln WHERE "Project" = \'%s\' AND "FYear" BETWEEN %.4f AND %.4f '
+                               'ORDER BY "NetworkCode", "StationCode", "Year", "DOY"'
+                               % (project, dates[0].fyear, dates[1].fyear))
+
+    stn = np.array([v[0] for v in vertices])
+    ts = np.array([v[1:] for v in vertices], dtype=float)
+
+    # the solutions are sorted by station
+    start = np.where(np.append(True, stn[1:] != stn[:-1]))[0] if stn.size else np.array([], dtype=int)
+    end = np.append(start[1:], stn.size)
+
+    etms = []
+
+    for s, e in tqdm(zip(start, end), ncols=160, desc=' >> Creating the station ETMs', disable=None):
+        net, ssn = stn[s].split('.')
+
+        try:
+            soln = pyETM.GamitSoln(cnn, ts[s:e], net, ssn, project)
+
+            etm = pyETM.GamitETM(cnn, net, ssn, False, False, soln, defer_adjustment=True)
+
+        except pyETM.pyETMException as e:
+            tqdm.write(' -- ' + str(e))
+            continue
+
+        if etm.A is None:
+            tqdm.write(' -- %s.%s: not enough solutions to estimate an ETM' % (net, ssn))
+        else:
+            etms.append(etm)
+
+    return etms
+
+
+def datum_keys(etm):
+    """
+    :return: list of (key, column) with the columns of the ETM shared by all the stations (polynomial and periodic
+             terms). A common transformation of these terms is absorbed by the daily Helmert transformations, so they
+             are used to define the datum of the joint adjustment
+    """
+    keys = [(('pol', i), i) for i in range(etm.Linear.param_count)]
+
+    freq = etm.Periodic.p.frequencies.tolist()
+    for i, col in enumerate(etm.Periodic.column_index.tolist()):
+        keys.append((('sin' if i < len(freq) else 'cos', '%.6f' % freq[i % len(freq)]), col))
+
+    return keys
+
+
+def build_system(etms, epochs):
+    """
+    Build the sparse design matrices of the joint adjustment. For each station and component the observation equation
+    is l = A p + G h, where A is the ETM design matrix of the station, p its parameters, G the Helmert design matrix
+    and h the transformation of the day. The parameters of each station are ordered [p_x, p_y, p_z]
+    :param etms: list of ETMs
+    :param epochs: list of dates of the daily transformations
+    :return: dictionary with the design matrices (Ap: station parameters, Ah: Helmert parameters, C: datum
+             constraints), the observation vector l, the observation mask and the columns and rows of each station
+    """
+    day = dict((d.year * 1000 + d.doy, i) for i, d in enumerate(epochs))
+    hp = HELMERT_PARAMS
+
+    rp, cp, vp = [], [], []
+    rh, ch, vh = [], [], []
+    l = []
+    obs = []
+    columns = []
+    station_rows = []
+    datum = dict()
+
+    row = 0
+    col = 0
+
+    for etm in etms:
+        A = etm.A(constrains=True)
+        n = etm.soln.x.size
+        rows, params = A.shape
+
+        ri, ci = np.nonzero(A)
+
+        dd = np.array([day[y * 1000 + d] for y, d in zip(etm.soln.date.year, etm.soln.date.doy)]) * hp
+        x, y, z = etm.soln.x, etm.soln.y, etm.soln.z
+        i = np.arange(n)
+
+        for c, (obs_c, apr_c) in enumerate(((x, etm.soln.auto_x), (y, etm.soln.auto_y), (z, etm.soln.auto_z))):
+            r0 = row + c * rows
+
+            rp.append(r0 + ri)
+            cp.append(col + c * params + ci)
+            vp.append(A[ri, ci])
+
+            l.append(np.append(obs_c - apr_c, np.zeros(rows - n)))
+            obs.append(np.append(np.ones(n, dtype=bool), np.zeros(rows - n, dtype=bool)))
+
+        # Helmert design matrix: rotations (scaled by 1e-9) and translations
+        r0 = row + i
+        rh += [r0, r0, r0]
+        ch += [dd + 1, dd + 2, dd + 3]
+        vh += [-z * 1e-9, y * 1e-9, np.ones(n)]
+
+        r0 = row + rows + i
+        rh += [r0, r0, r0]
+        ch += [dd + 0, dd + 2, dd + 4]
+        vh += [z * 1e-9, -x * 1e-9, np.ones(n)]
+
+        r0 = row + 2 * rows + i
+        rh += [r0, r0, r0]
+        ch += [dd + 0, dd + 1, dd + 5]
+        vh += [-y * 1e-9, x * 1e-9, np.ones(n)]
+
+        # datum constraints (no net rotation and translation of the common terms wrt the a priori coordinates)
+        ax, ay, az = etm.soln.auto_x[0], etm.soln.auto_y[0], etm.soln.auto_z[0]
+        G = np.array([[0, -az * 1e-9, ay * 1e-9, 1, 0, 0],
+                      [az * 1e-9, 0, -ax * 1e-9, 0, 1, 0],
+                      [-ay * 1e-9, ax * 1e-9, 0, 0, 0, 1]])
+
+        for key, k in datum_keys(etm):
+            datum.setdefault(key, []).append((col + np.arange(3) * params + k, G))
+
+        columns.append((col, params))
+        station_rows.append((row, row + 3 * rows))
+
+        row += 3 * rows
+        col += 3 * params
+
+    rc, cc, vc = [], [], []
+    for k, key in enumerate(sorted(datum.keys())):
+        for cols, G in datum[key]:
+            for r in range(hp):
+                rc.append(np.repeat(k * hp + r, 3))
+                cc.append(cols)
+                vc.append(G[:, r])
+
+    Ap = sparse.csr_matrix((np.concatenate(vp), (np.concatenate(rp), np.concatenate(cp))), shape=(row, col))
+    Ah = sparse.csr_matrix((np.concatenate(vh), (np.concatenate(rh), np.concatenate(ch))),
+                           shape=(row, len(epochs) * hp))
+    C = sparse.csr_matrix((np.concatenate(vc), (np.concatenate(rc), np.concatenate(cc))),
+                          shape=(len(datum) * hp, col))
+
+    return {'Ap': Ap, 'Ah': Ah, 'C': C, 'l': np.concatenate(l), 'obs': np.concatenate(obs), 'columns': columns,
+            'rows': station_rows}
+
+
+def helmert_inverse(Ah, P, days):
+    """
+    Invert the (block diagonal) normal matrix of the daily Helmert parameters
+    :return: sparse block diagonal matrix with the inverse of each 6 x 6 block
+    """
+    hp = HELMERT_PARAMS
+
+    # each observation belongs to a single day: the matrix is block diagonal
+    Nhh = (Ah.T.dot(sparse.diags(P)).dot(Ah)).tobsr(blocksize=(hp, hp))
+    Nhh.sum_duplicates()
+
+    blocks = np.zeros((days, hp, hp))
+    for d in range(days):
+        for k in range(Nhh.indptr[d], Nhh.indptr[d + 1]):
+            if Nhh.indices[k] == d:
+                blocks[d] = Nhh.data[k]
+
+    # days with less than three stations can't estimate the rotations: use the pseudo-inverse
+    inverse = np.linalg.pinv(blocks)
+
+    return sparse.bsr_matrix((inverse, np.arange(days), np.arange(days + 1)), shape=(days * hp, days * hp)).tocsr()
+
+
+def station_preconditioner(system, P, Nhh_inv, wc):
+    """
+    Block Jacobi preconditioner: inverse of the block of each station of the reduced normal matrix
+    """
+    Ap = system['Ap']
+    Ah = system['Ah']
+    C = system['C']
+
+    blocks = []
+
+    for (col, params), (row0, row1) in zip(system['columns'], system['rows']):
+        cols = slice(col, col + 3 * params)
+
+        # the rows of each station are contiguous: slice them instead of searching the columns of the whole matrix
+        rows = slice(row0, row1)
+
+        As = Ap[rows, cols]
+        Hs = Ah[rows]
+        Ps = sparse.diags(P[rows])
+
+        N = As.T.dot(Ps).dot(As).toarray()
+
+        T = As.T.dot(Ps).dot(Hs)
+        N -= T.dot(Nhh_inv).dot(T.T).toarray()
+
+        Cs = C[:, cols]
+        N += wc * Cs.T.dot(Cs).toarray()
+
+        blocks.append(np.linalg.pinv(N))
+
+    return sparse.block_diag(blocks, format='csr')
+
+
+def solve_system(system, P, x0=None):
+    """
+    Solve the joint adjustment by reducing the daily Helmert parameters and applying the conjugate gradient method to
+    the reduced normal equations of the station parameters
+    :param system: output of build_system
+    :param P: weight of each observation
+    :param x0: initial value of the station parameters
+    :return: station parameters, Helmert parameters, CG exit code
+    """
+    Ap = system['Ap']
+    Ah = system['Ah']
+    C = system['C']
+    l = system['l']
+
+    days = Ah.shape[1] / HELMERT_PARAMS
+
+    Nhh_inv = helmert_inverse(Ah, P, days)
+
+    # weight of the datum constraints
+    wc = DATUM_WEIGHT * np.mean(P[system['obs']])
+
+    def reduce_helmert(u):
+        # u: weighted vector in observation space. Remove the portion absorbed by the Helmert parameters
+        return u - P * Ah.dot(Nhh_inv.dot(Ah.T.dot(u)))
+
+    def matvec(x):
+        x = np.ravel(x)
+        return Ap.T.dot(reduce_helmert(P * Ap.dot(x))) + wc * C.T.dot(C.dot(x))
+
+    n = Ap.shape[1]
+
+    N = LinearOperator((n, n), matvec=matvec, dtype=float)
+    M = station_preconditioner(system, P, Nhh_inv, wc)
 
-    rs = cnn.query('SELECT "NetworkCode", "StationCode" FROM gamit_soln '
-                   'WHERE "Project" = \'%s\' AND "FYear" BETWEEN %.4f AND %.4f GROUP BY "NetworkCode", "StationCode" '
-                   'ORDER BY "NetworkCode", "StationCode"' % (project, dates[0].fyear, dates[1].fyear))
+    b = Ap.T.dot(reduce_helmert(P * l))
 
-    stnlist = rs.dictresult()
+    x, info = cg(N, b, x0=x0, tol=CG_TOLERANCE, maxiter=CG_MAXITER, M=M)
 
+    # back substitution of the Helmert parameters
+    h = Nhh_inv.dot(Ah.T.dot(P * (l - Ap.dot(x))))
+
+    return x, h, info
+
+
+def dra(cnn, project, dates):
+    """
+    Joint adjustment of the daily Helmert transformations and the ETM parameters of all the stations of a project
+    :param cnn: connection to the database
+    :param project: GAMIT project
+    :param dates: date range
+    :return: dictionary with the epochs, the Helmert transformations (applied as in Polyhedron.align), the wrms and
+             number of stations of each day, the ETM parameters (XYZ) of each station and the aligned vertices
+    """
     # get the epochs
     ep = cnn.query('SELECT "Year", "DOY" FROM gamit_soln '
-                   'WHERE "Project" = \'%s\' AND "FYear" BETWEEN %.4f AND %.4f'
+                   'WHERE "Project" = \'%s\' AND "FYear" BETWEEN %.4f AND %.4f '
                    'GROUP BY "Year", "DOY" ORDER BY "Year", "DOY"' % (project, dates[0].fyear, dates[1].fyear))
 
     ep = ep.dictresult()
 
     epochs = [Date(year=item['Year'], doy=item['DOY']) for item in ep]
 
-    A = np.array([])
-    Ax = []
-    Ay = []
-    Az = []
+    etms = load_etms(cnn, project, dates)
 
-    for station in stnlist:
+    print ' >> Building the normal equations of %i stations and %i days...' % (len(etms), len(epochs))
 
-        print 'stacking %s.%s' % (station['NetworkCode'], station['StationCode'])
+    system = build_system(etms, epochs)
 
-        try:
-            etm = pyETM.GamitETM(cnn, station['NetworkCode'], station['StationCode'], project=project)
-        except Exception as e:
-            print " Exception: " + str(e)
-            continue
+    obs = system['obs']
+    l = system['l']
 
-        x = etm.soln.x
-        y = etm.soln.y
-        z = etm.soln.z
+    # degrees of freedom: observations - station parameters - Helmert parameters + datum constraints
+    dof = np.sum(obs) - system['Ap'].shape[1] - system['Ah'].shape[1] + system['C'].shape[0]
+    X1 = chi2.ppf(1 - 0.05 / 2, dof)
+    X2 = chi2.ppf(0.05 / 2, dof)
+
+    P = np.ones(l.shape[0])
+    factor = 1.
+    x = None
+    h = None
+    v = np.array([])
+    cst_pass = False
+    iteration = 0
 
-        Ax.append(np.array([np.zeros(x.shape), -z, y, np.ones(x.shape), np.zeros(x.shape), np.zeros(x.shape)]).transpose())
-        Ay.append(np.array([z, np.zeros(x.shape), -x, np.zeros(x.shape), np.ones(x.shape), np.zeros(x.shape)]).transpose())
-        Az.append(np.array([-y, x, np.zeros(x.shape), np.zeros(x.shape), np.zeros(x.shape), np.ones(x.shape)]).transpose())
+    while not cst_pass and iteration <= 10:
 
-        x = np.column_stack((Ax, etm.A, np.zeros(etm.A.shape), np.zeros(etm.A.shape)))
-        y = np.column_stack((Ay, np.zeros(etm.A.shape), etm.A, np.zeros(etm.A.shape)))
-        z = np.column_stack((Az, np.zeros(etm.A.shape), np.zeros(etm.A.shape), etm.A))
+        x, h, info = solve_system(system, P, x)
 
-        A = np.row_stack((x, y, z))
+        if info > 0:
+            tqdm.write(' -- Conjugate gradient did not converge after %i iterations' % info)
 
+        v = l - system['Ap'].dot(x) - system['Ah'].dot(h)
+
+        # unit variance (observations only)
+        So = np.sqrt(np.dot(v[obs], np.multiply(P[obs], v[obs])) / dof)
+
+        factor = factor * So
+
+        s = np.abs(np.divide(v, factor))
+
+        tqdm.write(' -- Iteration %i wrms: %.1f mm' % (iteration, factor * 1000))
+
+        if So ** 2 * dof < X2 or So ** 2 * dof > X1:
+            # reweigh by Mike's method of equal weight until 2 sigma
+            f = np.ones(v.shape[0])
+
+            sw = np.power(10, LIMIT - s[s > LIMIT])
+            sw[sw < np.finfo(np.float).eps] = np.finfo(np.float).eps
+
+            f[s > LIMIT] = sw
+            # do not down-weight the constraints of the ETMs
+            f[~obs] = 1
+
+            P = np.square(np.divide(f, factor))
+        else:
+            cst_pass = True
+
+        iteration += 1
+
+    hp = HELMERT_PARAMS
+    # transformation to apply to each polyhedron (same convention as Polyhedron.align)
+    helmert = -h.reshape((len(epochs), hp))
+
+    # aligned vertices and statistics of each day
+    day = dict((d.year * 1000 + d.doy, i) for i, d in enumerate(epochs))
+    vertices = []
+    vpv = np.zeros(len(epochs))
+    weights = np.zeros(len(epochs))
+    stations = np.zeros(len(epochs), dtype=int)
+    params = dict()
+
+    row = 0
+    for etm, (col, pc) in zip(etms, system['columns']):
+        rows = etm.A(constrains=True).shape[0]
+        n = etm.soln.x.size
+
+        xyz = np.array([etm.soln.x, etm.soln.y, etm.soln.z])
+        # correction applied by the Helmert transformations
+        dxyz = np.array([-system['Ah'][row + c * rows:row + c * rows + n].dot(h) for c in range(3)])
+        res = np.array([v[row + c * rows:row + c * rows + n] for c in range(3)])
+        w = np.array([P[row + c * rows:row + c * rows + n] for c in range(3)])
+
+        # weighted residuals of each day
+        dd = np.array([day[y * 1000 + d] for y, d in zip(etm.soln.date.year, etm.soln.date.doy)])
+        vpv += np.bincount(dd, weights=np.sum(np.multiply(w, np.square(res)), axis=0), minlength=len(epochs))
+        weights += np.bincount(dd, weights=np.sum(w, axis=0), minlength=len(epochs))
+        stations += np.bincount(dd, minlength=len(epochs))
+
+        stn = etm.NetworkCode + '.' + etm.StationCode
+
+        for k, (y, d, fy) in enumerate(zip(etm.soln.date.year, etm.soln.date.doy, etm.soln.date.fyear)):
+            vertices.append((stn, xyz[0, k] + dxyz[0, k], xyz[1, k] + dxyz[1, k], xyz[2, k] + dxyz[2, k],
+                             int(y), int(d), float(fy)))
+
+        params[stn] = x[col:col + 3 * pc].reshape((3, pc))
+
+        row += 3 * rows
+
+    vertices = np.array(vertices, dtype=[('stn', 'S8'), ('x', 'float64'), ('y', 'float64'), ('z', 'float64'),
+                                         ('yr', 'i4'), ('dd', 'i4'), ('fy', 'float64')])
+
+    # weighted rms of the residuals of each day (days without stations are left as zero)
+    wrms = np.zeros(len(epochs))
+    wrms[weights > 0] = np.sqrt(vpv[weights > 0] / weights[weights > 0])
+
+    return {'epochs': epochs, 'helmert': helmert, 'wrms': wrms, 'stations': stations, 'params': params,
+            'vertices': vertices, 'factor': factor, 'iterations': iteration}
 
 
 def main():
@@ -206,6 +546,8 @@ def main():
                         help="Specify the project name used to process the GAMIT solutions in Parallel.GAMIT.")
     parser.add_argument('-d', '--date_filter', nargs='+', metavar='date',
                         help='Date range filter Can be specified in yyyy/mm/dd yyyy_doy  wwww-d format')
+    parser.add_argument('-stack', '--stack_name', type=str, nargs=1, metavar='{stack name}',
+                        help="Save the aligned solutions in the stacks table using the provided stack name.")
 
     args = parser.parse_args()
 
@@ -228,7 +570,27 @@ def main():
     ########################################
     # load polyhedrons
 
-    project = dra(cnn, args.project[0], dates)
+    result = dra(cnn, args.project[0], dates)
+
+    # save the transformations, the wrms and the ETM parameters
+    with open(os.path.join(args.project[0], args.project[0] + '_neq.json'), 'w') as f:
+        json.dump({'wrms': result['factor'] * 1000, 'iterations': result['iterations'],
+                   'transformations': [{'year': d.year, 'doy': d.doy, 'fyear': d.fyear, 'params': h.tolist(),
+                                        'wrms': w * 1000, 'stations_used': int(n)}
+                                       for d, h, w, n in zip(result['epochs'], result['helmert'], result['wrms'],
+                                                             result['stations'])],
+                   'stations': dict((stn, p.tolist()) for stn, p in result['params'].items())}, f, indent=4)
+
+    if args.stack_name:
+        columns = ['Project', 'NetworkCode', 'StationCode', 'X', 'Y', 'Z', 'FYear', 'Year', 'DOY',
+                   'sigmax', 'sigmay', 'sigmaz', 'name']
+
+        rows = [(args.project[0], stn.split('.')[0], stn.split('.')[1], x, y, z, fy, yr, dd, 0., 0., 0.,
+                 args.stack_name[0]) for stn, x, y, z, yr, dd, fy in result['vertices'].tolist()]
+
+        print ' >> Saving %i aligned solutions to stack %s' % (len(rows), args.stack_name[0])
+
+        cnn.bulk_insert('stacks', rows, columns, keys=['name', 'NetworkCode', 'StationCode', 'Year', 'DOY'])
 
 
 if __name__ == '__main__':
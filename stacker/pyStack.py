@@ -2,13 +2,49 @@
 import numpy as np
 import dbConnection
 from pyDate import Date
+from pyDate import DateArray
 from tqdm import tqdm
 from Utils import lg2ct
 from Utils import ct2lg
+from Utils import rotlg2ct
 from pyETM import pi
 import pyETM
 from datetime import datetime
 import json
+import os
+
+# tolerance (in meters) to compare the sum of the distances of the vertices of a day to their centroid (see
+# day_fingerprints)
+FINGERPRINT_TOLERANCE = 1e-5
+
+
+def same_day(fingerprint, other):
+    """
+    Compare the fingerprints (number of vertices, sum of the distances to the centroid) of two days
+    """
+    return fingerprint is not None and other is not None and fingerprint[0] == other[0] and \
+        np.abs(fingerprint[1] - other[1]) < FINGERPRINT_TOLERANCE
+
+
+def day_fingerprints(cnn, table, where, end_date):
+    """
+    Fingerprint of each day of table: number of vertices and sum of the distances of the vertices to their centroid. The
+    distances do not change when a polyhedron is aligned (rotation and translation), so the days of the stack can
+    be compared against the GAMIT solutions that they were created from
+    :param cnn: connection to the database
+    :param table: gamit_soln or stacks
+    :param where: condition to select the project or stack
+    :param end_date: last date to include
+    :return: dictionary {(year, doy): (count, sum of the distances)}
+    """
+    rs = cnn.query_float(
+        'SELECT "Year", "DOY", count(*), sum(sqrt(power(v."X" - c.x, 2) + power(v."Y" - c.y, 2) + '
+        'power(v."Z" - c.z, 2))) FROM %s v JOIN (SELECT "Year", "DOY", avg("X") AS x, avg("Y") AS y, '
+        'avg("Z") AS z FROM %s WHERE %s GROUP BY "Year", "DOY") c USING ("Year", "DOY") '
+        'WHERE %s AND ("Year", "DOY") <= (%i, %i) GROUP BY "Year", "DOY"'
+        % (table, table, where, where, end_date.year, end_date.doy))
+
+    return dict(((int(d[0]), int(d[1])), (int(d[2]), float(d[3]))) for d in rs)
 
 
 def adjust_lsq(A, L, P=None):
@@ -84,6 +120,149 @@ def adjust_lsq(A, L, P=None):
     return C, sigma, index, v, factor, P, iteration
 
 
+def adjust_lsq_batch(A, L, rows):
+    """
+    Equivalent to calling adjust_lsq for a group of systems (i.e. the Helmert transformations of many days) but the
+    systems are solved at once using stacked linear algebra and the robust reweighting iterations of all the systems
+    are done in lockstep. Systems have the same number of unknowns and are padded with zero rows
+    :param A: array (systems x max rows x unknowns) with the design matrices
+    :param L: array (systems x max rows) with the observations
+    :param rows: number of valid rows of each system
+    :return: lists with C, sigma, index, v, factor, P and iterations of each system (as in adjust_lsq)
+    """
+    LIMIT = 2.5
+
+    from scipy.stats import chi2
+
+    systems, max_rows, unknowns = A.shape
+
+    dof = (rows - unknowns).astype(float)
+    X1 = chi2.ppf(1 - 0.05 / 2, dof)
+    X2 = chi2.ppf(0.05 / 2, dof)
+
+    valid = np.arange(max_rows)[np.newaxis, :] < rows[:, np.newaxis]
+
+    factor = np.ones(systems)
+    So = np.ones(systems)
+    iteration = np.zeros(systems, dtype=int)
+
+    P = valid.astype(float)
+    C = np.zeros((systems, unknowns))
+    v = np.zeros((systems, max_rows))
+    s = np.zeros((systems, max_rows))
+
+    # systems that have not passed the Chi2 test
+    active = np.arange(systems)
+
+    while active.size and iteration[active[0]] <= 10:
+
+        W = np.sqrt(P[active])
+
+        Aw = np.multiply(W[:, :, None], A[active])
+        Lw = np.multiply(W, L[active])
+
+        # least squares solution of each system (zero rows do not change the solution)
+        C[active] = np.einsum('dpr,dr->dp', np.linalg.pinv(Aw), Lw)
+
+        v[active] = np.einsum('drp,dp->dr', A[active], C[active]) - L[active]
+
+        # unit variance
+        So[active] = np.sqrt(np.sum(np.multiply(P[active], np.square(v[active])), axis=1) / dof[active])
+
+        x = np.power(So[active], 2) * dof[active]
+
+        # obtain the overall uncertainty predicted by lsq
+        factor[active] = factor[active] * So[active]
+
+        # calculate the normalized sigmas
+        s[active] = np.abs(np.divide(v[active], factor[active][:, None]))
+
+        iteration[active] += 1
+
+        # systems that didn't pass the Chi2 test
+        fail = np.logical_or(x < X2[active], x > X1[active])
+
+        for d in active[fail]:
+            # reweigh by Mike's method of equal weight until 2 sigma
+            f = np.ones((max_rows,))
+
+            sw = np.power(10, LIMIT - s[d][s[d] > LIMIT])
+            sw[sw < np.finfo(np.float).eps] = np.finfo(np.float).eps
+
+            f[s[d] > LIMIT] = sw
+
+            P[d] = np.square(np.divide(f, factor[d])) * valid[d]
+
+        active = active[fail]
+
+    # some statistics
+    SS = np.linalg.pinv(np.einsum('drp,dr,drq->dpq', A, P, A))
+
+    sigma = So[:, None] * np.sqrt(np.diagonal(SS, axis1=1, axis2=2))
+
+    # mark observations with sigma <= LIMIT
+    index = s <= LIMIT
+
+    return ([C[d] for d in range(systems)], [sigma[d] for d in range(systems)],
+            [index[d][:rows[d]] for d in range(systems)],
+            [v[d][:rows[d]] for d in range(systems)], factor.tolist(), [P[d][:rows[d]] for d in range(systems)],
+            iteration.tolist())
+
+
+def align_batch(polyhedrons, targets, set_aligned=True, scale=False):
+    """
+    Equivalent to calling Polyhedron.align for each polyhedron and its target, but the Helmert transformations of all
+    the polyhedrons are estimated at once with adjust_lsq_batch. The polyhedrons are modified in place and the helmert,
+    wrms, stations_used and iterations (reported by Polyhedron.info) are set
+    :param polyhedrons: list of polyhedrons to align
+    :param targets: list of target polyhedrons
+    :param set_aligned: mark the polyhedrons as aligned
+    :param scale: estimate the scale factor
+    :return: nothing
+    """
+    if not polyhedrons:
+        return
+
+    designs = []
+    residuals = []
+    used = []
+
+    for poly, target in zip(polyhedrons, targets):
+        # figure out common stations
+        intersect = np.intersect1d(target.vertices['stn'], poly.vertices['stn'])
+
+        ft = np.isin(target.vertices['stn'], intersect)
+        fl = np.isin(poly.vertices['stn'], intersect)
+
+        st = target.vertices[ft]
+        sl = poly.vertices[fl]
+
+        designs.append(np.concatenate((poly.ax(scale)[fl], poly.ay(scale)[fl], poly.az(scale)[fl]), axis=0))
+        residuals.append(np.concatenate((st['x'] - sl['x'], st['y'] - sl['y'], st['z'] - sl['z']), axis=0))
+        used.append(len(intersect))
+
+    rows = np.array([r.shape[0] for r in residuals])
+
+    # pad the systems with zero rows
+    A = np.zeros((len(designs), rows.max(), designs[0].shape[1]))
+    L = np.zeros((len(designs), rows.max()))
+
+    for d, (a, r) in enumerate(zip(designs, residuals)):
+        A[d, :rows[d]] = a
+        L[d, :rows[d]] = r
+
+    C, _, _, _, wrms, _, it = adjust_lsq_batch(A, L, rows)
+
+    for d, poly in enumerate(polyhedrons):
+        poly.helmert = C[d]
+        poly.wrms = wrms[d]
+        poly.stations_used = used[d]
+        poly.iterations = it[d]
+
+        # apply the transformation to all the vertices
+        poly.align(helmert=C[d], set_aligned=set_aligned, scale=scale)
+
+
 def print_residuals(NetworkCode, StationCode, residuals, lat, lon, components=('N', 'E', 'U')):
 
     # check if sending NEU or XYZ
@@ -102,24 +281,176 @@ def print_residuals(NetworkCode, StationCode, residuals, lat, lon, components=('
     tqdm.write(' -- %s.%s\n' % (NetworkCode, StationCode) + r)
 
 
-class Stack(list):
+def periodic_space(etm_objects, stations, f_vector, target_periods=None):
+    """
+    Convert the periodic terms of a group of stations to XYZ. The stations that share the same frequencies are
+    rotated at once
+    :param etm_objects: dictionary net.stn -> periodic etms record (with lat, lon)
+    :param stations: list of stations (net.stn) that defines the order of the output
+    :param f_vector: vector of frequencies that defines the order of the output
+    :param target_periods: if provided, the target periodic terms (NEU) are subtracted before the conversion
+    :return: ox, oy, oz with the XYZ terms stored as [freq, station, sin/cos]
+    """
+    o = np.zeros((3, len(f_vector), len(stations), 2))
+
+    # group the stations by frequencies
+    groups = dict()
+    for s, stn in enumerate(stations):
+        if stn in etm_objects:
+            groups.setdefault(tuple(etm_objects[stn]['freq']), []).append(s)
+
+    # NEU terms of each station (to report them)
+    neu = dict()
+
+    for freq, index in groups.items():
+        nf = len(freq)
+        rows = [etm_objects[stations[s]] for s in index]
+
+        # params are stored as [sin f1 ... sin fn, cos f1 ... cos fn] for each NEU component
+        params = np.array([r['params'] for r in rows], dtype=float).reshape((len(rows), 3, 2, nf))
+
+        if target_periods:
+            # inheritance invoked! we want to remove the difference between current periodic terms and target
+            # terms from the parent frame
+            for g, r in enumerate(rows):
+                t = target_periods['%s.%s' % (r['NetworkCode'], r['StationCode'])]
+                params[g] -= np.array([[[t['%.3f' % (1 / f)][c][k] for f in freq] for k in range(2)]
+                                       for c in ('n', 'e', 'u')])
+
+        for g, s in enumerate(index):
+            neu[s] = params[g].reshape((3, 2 * nf))
+
+        # convert from NEU to XYZ
+        R = rotlg2ct(np.array([r['lat'] for r in rows]), np.array([r['lon'] for r in rows]), len(rows))
+        xyz = np.einsum('ijg,gjkf->igkf', R, params)
+
+        fi = np.searchsorted(f_vector, freq)
+        o[:, fi[:, np.newaxis], np.array(index)[np.newaxis, :], :] = xyz.transpose((0, 3, 1, 2))
+
+    for s in sorted(neu.keys()):
+        r = etm_objects[stations[s]]
+        print_residuals(r['NetworkCode'], r['StationCode'], neu[s], r['lat'], r['lon'])
+
+    return o[0], o[1], o[2]
+
+
+def split_vertices(vertices):
+    """
+    Sort the vertices by date and station in a single pass and split them into per-day views, so that each Polyhedron
+    gets its vertices without filtering (and copying) the whole array
+    :param vertices: structured array with the vertices (stn, x, y, z, yr, dd, fy)
+    :return: dictionary of (year, doy) -> view of the vertices of that day, sorted by station
+    """
+    vertices = vertices[np.lexsort((vertices['stn'], vertices['dd'], vertices['yr']))]
+
+    yd = vertices['yr'].astype(int) * 1000 + vertices['dd']
+    days = np.unique(yd)
+
+    start = np.searchsorted(yd, days, side='left')
+    end = np.searchsorted(yd, days, side='right')
+
+    return dict(((int(d / 1000), int(d % 1000)), vertices[s:e]) for d, s, e in zip(days, start, end))
+
+
+def get_day(days, vertices, date):
+    """
+    :return: the view of the vertices of date from the output of split_vertices (empty if date is not present)
+    """
+    return days.get((date.year, date.doy), vertices[0:0])
+
+
+class StationIndex(object):
+    """
+    Station x epoch index of a list of polyhedrons. The vertices of the polyhedrons are moved to a single array (each
+    polyhedron keeps a view of its day) so that the coordinates modified in place by align and by the common mode and
+    frame transformations are seen by get_station without rebuilding the index
+    """
+    def __init__(self, polyhedrons):
+
+        if len(polyhedrons):
+            self.vertices = np.concatenate([poly.vertices for poly in polyhedrons])
+        else:
+            self.vertices = np.array([], dtype=[('stn', 'S8'), ('x', 'float64'), ('y', 'float64'), ('z', 'float64'),
+                                                ('yr', 'i4'), ('dd', 'i4'), ('fy', 'float64')])
+
+        offset = 0
+        for poly in polyhedrons:
+            poly.vertices = self.vertices[offset:offset + poly.rows]
+            offset += poly.rows
+
+        # stable sort: the polyhedrons are sorted by date, so each station's rows remain sorted by date
+        self.order = np.argsort(self.vertices['stn'], kind='mergesort')
+
+        stn = self.vertices['stn'][self.order]
+        start = np.where(np.append(True, stn[1:] != stn[:-1]))[0] if stn.size else np.array([], dtype=int)
+        end = np.append(start[1:], stn.size)
 
-    def __init__(self, cnn, project, name, redo=False, end_date=None):
+        self.index = dict((s, (i, j)) for s, i, j in zip(stn[start].tolist(), start, end))
 
+    def get_station(self, NetworkCode, StationCode):
+        """
+        Obtains the time series for a given station
+        :param NetworkCode:
+        :param StationCode:
+        :return: a numpy array with the time series [x, y, z, yr, doy, fyear]
+        """
+        s, e = self.index.get(NetworkCode + '.' + StationCode, (0, 0))
+
+        if s == e:
+            return np.array([])
+
+        v = self.vertices[self.order[s:e]]
+
+        return np.column_stack((v['x'], v['y'], v['z'], v['yr'], v['dd'], v['fy']))
+
+    def get_series(self):
+        """
+        Obtains the time series of all the stations at once
+        :return: a numpy array with the time series [x, y, z, yr, doy, fyear] sorted by station and the dictionary
+                 with the (start, end) rows of each station (net.stn)
+        """
+        v = self.vertices[self.order]
+
+        return np.column_stack((v['x'], v['y'], v['z'], v['yr'], v['dd'], v['fy'])), self.index
+
+
+class Stack(list):
+
+    def __init__(self, cnn, project, name, redo=False, end_date=None, store=None, checkpoint=None):
+        """
+        :param cnn: connection to the database
+        :param project: GAMIT project
+        :param name: name of the stack
+        :param redo: ignore the contents of the stacks table
+        :param end_date: last date of the stack
+        :param store: time series store to load the GAMIT solutions (redo only)
+        :param checkpoint: checkpoint file (see save_checkpoint). If it exists, the stack resumes from it. Pass None
+                           to ignore it
+        """
         super(Stack, self).__init__()
 
         self.project = project.lower()
         self.name = name.lower()
         self.cnn = cnn
+        self.redo = redo
         self.position_space = None
         self.velocity_space = None
         self.periodic_space = None
         self.transformations = []
+        # last completed iteration of the stacking process (see save_checkpoint)
+        self.iteration = -1
 
         if end_date is None:
             end_date = Date(datetime=datetime.now())
 
-        if redo:
+        # fingerprint of each day of the project: used to find new or changed days
+        self.gamit_days = day_fingerprints(self.cnn, 'gamit_soln', '"Project" = \'%s\'' % project, end_date)
+
+        if checkpoint is not None and os.path.isfile(checkpoint) and self.load_checkpoint(checkpoint):
+            # the polyhedrons were loaded from the checkpoint
+            pass
+
+        elif redo:
             # if redoing the stack, ignore the contents of the stacks table
             print ' >> Redoing stack'
 
@@ -127,91 +458,84 @@ class Stack(list):
 
             print ' >> Loading GAMIT solutions for project %s...' % project
 
-            gamit_vertices = self.cnn.query_float(
-                'SELECT "NetworkCode" || \'.\' || "StationCode", "X", "Y", "Z", "Year", "DOY", "FYear" '
-                'FROM gamit_soln WHERE "Project" = \'%s\' AND ("Year", "DOY") <= (%i, %i)'
-                'ORDER BY "NetworkCode", "StationCode"' % (project, end_date.year, end_date.doy))
+            if store is not None:
+                # load the GAMIT solutions from the time series store
+                self.gamit_vertices = store.get_vertices(end_date)
 
-            self.gamit_vertices = np.array(gamit_vertices, dtype=[('stn', 'S8'), ('x', 'float64'), ('y', 'float64'),
-                                                                  ('z', 'float64'), ('yr', 'i4'), ('dd', 'i4'),
-                                                                  ('fy', 'float64')])
+                dates = store.get_dates(end_date)
 
-            dates = self.cnn.query_float('SELECT "Year", "DOY" FROM gamit_soln WHERE "Project" = \'%s\' '
-                                         'AND ("Year", "DOY") <= (%i, %i) '
-                                         'GROUP BY "Year", "DOY" ORDER BY "Year", "DOY"'
-                                         % (project, end_date.year, end_date.doy))
+                self.stations = store.get_stations(end_date)
+            else:
+                gamit_vertices = self.cnn.query_float(
+                    'SELECT "NetworkCode" || \'.\' || "StationCode", "X", "Y", "Z", "Year", "DOY", "FYear" '
+                    'FROM gamit_soln WHERE "Project" = \'%s\' AND ("Year", "DOY") <= (%i, %i)'
+                    'ORDER BY "NetworkCode", "StationCode"' % (project, end_date.year, end_date.doy))
 
-            self.dates = [Date(year=int(d[0]), doy=int(d[1])) for d in dates]
+                self.gamit_vertices = np.array(gamit_vertices, dtype=[('stn', 'S8'), ('x', 'float64'),
+                                                                      ('y', 'float64'), ('z', 'float64'),
+                                                                      ('yr', 'i4'), ('dd', 'i4'), ('fy', 'float64')])
 
-            self.stations = self.cnn.query_float('SELECT "NetworkCode", "StationCode" FROM gamit_soln '
-                                                 'WHERE "Project" = \'%s\' AND ("Year", "DOY") <= (%i, %i) '
-                                                 'GROUP BY "NetworkCode", "StationCode" '
-                                                 'ORDER BY "NetworkCode", "StationCode"'
-                                                 % (project, end_date.year, end_date.doy), as_dict=True)
+                dates = self.cnn.query_float('SELECT "Year", "DOY" FROM gamit_soln WHERE "Project" = \'%s\' '
+                                             'AND ("Year", "DOY") <= (%i, %i) '
+                                             'GROUP BY "Year", "DOY" ORDER BY "Year", "DOY"'
+                                             % (project, end_date.year, end_date.doy))
+
+                self.stations = self.cnn.query_float('SELECT "NetworkCode", "StationCode" FROM gamit_soln '
+                                                     'WHERE "Project" = \'%s\' AND ("Year", "DOY") <= (%i, %i) '
+                                                     'GROUP BY "NetworkCode", "StationCode" '
+                                                     'ORDER BY "NetworkCode", "StationCode"'
+                                                     % (project, end_date.year, end_date.doy), as_dict=True)
+
+            self.dates = DateArray(year=[d[0] for d in dates], doy=[d[1] for d in dates]).dates()
+
+            days = split_vertices(self.gamit_vertices)
 
             for d in tqdm(self.dates, ncols=160, desc=' >> Initializing the stack polyhedrons'):
-                self.append(Polyhedron(self.gamit_vertices, project, d))
+                self.append(Polyhedron(get_day(days, self.gamit_vertices, d), project, d, sliced=True))
 
         else:
             print ' >> Preserving the existing stack ' + name
             print ' >> Determining differences between stack %s and GAMIT solutions for project %s...' % (name, project)
 
+            # compare the fingerprint of each day of the stack against the fingerprint of the GAMIT solutions (single
+            # aggregate query on each table)
+            stack_fingerprints = day_fingerprints(self.cnn, 'stacks', '"Project" = \'%s\' AND "name" = \'%s\''
+                                                  % (project, name), end_date)
+
             # build a dates vector
-            dates = self.cnn.query_float('SELECT "Year", "DOY" FROM stacks WHERE "name" = \'%s\' '
-                                         'AND ("Year", "DOY") <= (%i, %i) '
-                                         'UNION '
-                                         'SELECT "Year", "DOY" FROM gamit_soln WHERE "Project" = \'%s\' '
-                                         'AND ("Year", "DOY") <= (%i, %i) '
-                                         'ORDER BY "Year", "DOY"'
-                                         % (name, end_date.year, end_date.doy, project, end_date.year, end_date.doy))
+            dates = sorted(set(stack_fingerprints.keys()) | set(self.gamit_days.keys()))
 
-            self.dates = [Date(year=d[0], doy=d[1]) for d in dates]
+            self.dates = DateArray(year=[d[0] for d in dates], doy=[d[1] for d in dates]).dates()
 
-            for d in tqdm(self.dates, ncols=160, desc=' >> Checking station count for each day', disable=None):
-                try:
-                    s = self.cnn.query_float('SELECT count("X") FROM stacks WHERE "Project" = \'%s\' '
-                                             'AND "name" = \'%s\' AND "Year" = %i AND "DOY" = %i'
-                                             % (project, name, d.year, d.doy))
-                    g = self.cnn.query_float('SELECT count("X") FROM gamit_soln WHERE "Project" = \'%s\' '
-                                             'AND "Year" = %i AND "DOY" = %i'
-                                             % (project, d.year, d.doy))
-                    if s[0] < g[0]:
-                        self.cnn.query('DELETE FROM stacks WHERE "Project" = \'%s\' '
-                                       'AND "name" = \'%s\' AND "Year" = %i AND "DOY" = %i'
-                                       % (project, name, d.year, d.doy))
-                except Exception as e:
-                    # if value error is risen, then append the gamit vertices
-                    tqdm.write(' -- Error while processing %s: %s' % (d.yyyyddd(), str(e)))
+            # days with new or changed GAMIT solutions. Days of the stack without GAMIT solutions are kept
+            changed = sorted([d for d, v in self.gamit_days.items() if not same_day(stack_fingerprints.get(d), v)])
 
-            # load the vertices that don't have differences wrt to the GAMIT solution
-            stack_vertices = self.cnn.query_float(
-                'SELECT "NetworkCode" || \'.\' || "StationCode", "X", "Y", "Z", "Year", "DOY", "FYear" FROM stacks '
-                'WHERE ("Year", "DOY") NOT IN ('
-                ' SELECT "Year", "DOY" FROM ('
-                ' SELECT "NetworkCode", "StationCode", "Year", "DOY", \'not in stack\' '
-                '  AS note FROM gamit_soln WHERE "Project" = \'%s\' EXCEPT '
-                ' SELECT "NetworkCode", "StationCode", "Year", "DOY", \'not in stack\' '
-                '  AS note FROM stacks WHERE "Project" = \'%s\' AND "name" = \'%s\''
-                ' ) AS missing_stack GROUP BY "Year", "DOY" ORDER BY "Year", "DOY") AND '
-                '"Project" = \'%s\' AND "name" = \'%s\' AND ("Year", "DOY") <= (%i, %i) '
-                'ORDER BY "NetworkCode", "StationCode"'
-                % (project, project, name, project, name, end_date.year, end_date.doy))
+            stale = [d for d in changed if d in stack_fingerprints]
+
+            if stale:
+                tqdm.write(' -- %i days of the stack have new or changed GAMIT solutions' % len(stale))
+
+                self.cnn.query('DELETE FROM stacks WHERE "Project" = \'%s\' AND "name" = \'%s\' '
+                               'AND ("Year", "DOY") IN (%s)'
+                               % (project, name, ','.join(['(%i, %i)' % d for d in stale])))
 
             print ' >> Loading pre-existing stack %s' % name
 
-            # load the vertices that were different
-            gamit_vertices = self.cnn.query_float(
-                'SELECT "NetworkCode" || \'.\' || "StationCode", "X", "Y", "Z", "Year", "DOY", "FYear" FROM gamit_soln '
-                'WHERE ("Year", "DOY") IN ('
-                ' SELECT "Year", "DOY" FROM ('
-                ' SELECT "NetworkCode", "StationCode", "Year", "DOY", \'not in stack\' '
-                '  AS note FROM gamit_soln WHERE "Project" = \'%s\' EXCEPT '
-                ' SELECT "NetworkCode", "StationCode", "Year", "DOY", \'not in stack\' '
-                '  AS note FROM stacks WHERE "Project" = \'%s\' AND "name" = \'%s\''
-                ' ) AS missing_stack GROUP BY "Year", "DOY" ORDER BY "Year", "DOY") AND '
-                '"Project" = \'%s\' AND ("Year", "DOY") <= (%i, %i) '
-                'ORDER BY "NetworkCode", "StationCode"'
-                % (project, project, name, project, end_date.year, end_date.doy))
+            # after removing the stale days, all the vertices of the stack are valid
+            stack_vertices = self.cnn.query_float(
+                'SELECT "NetworkCode" || \'.\' || "StationCode", "X", "Y", "Z", "Year", "DOY", "FYear" FROM stacks '
+                'WHERE "Project" = \'%s\' AND "name" = \'%s\' AND ("Year", "DOY") <= (%i, %i) '
+                'ORDER BY "NetworkCode", "StationCode"' % (project, name, end_date.year, end_date.doy))
+
+            # load the vertices of the days that are new or changed
+            if changed:
+                gamit_vertices = self.cnn.query_float(
+                    'SELECT "NetworkCode" || \'.\' || "StationCode", "X", "Y", "Z", "Year", "DOY", "FYear" '
+                    'FROM gamit_soln WHERE "Project" = \'%s\' AND ("Year", "DOY") IN (%s) '
+                    'ORDER BY "NetworkCode", "StationCode"'
+                    % (project, ','.join(['(%i, %i)' % d for d in changed])))
+            else:
+                gamit_vertices = []
 
             self.stack_vertices = np.array(stack_vertices, dtype=[('stn', 'S8'), ('x', 'float64'), ('y', 'float64'),
                                                                   ('z', 'float64'), ('yr', 'i4'), ('dd', 'i4'),
@@ -230,15 +554,119 @@ class Stack(list):
                                                  % (name, end_date.year, end_date.doy,
                                                     project, end_date.year, end_date.doy), as_dict=True)
 
+            stack_days = split_vertices(self.stack_vertices)
+            gamit_days = split_vertices(self.gamit_vertices)
+
             for d in tqdm(self.dates, ncols=160, desc=' >> Initializing the stack polyhedrons', disable=None):
                 try:
                     # try to append the stack vertices
-                    self.append(Polyhedron(self.stack_vertices, project, d, aligned=True))
+                    self.append(Polyhedron(get_day(stack_days, self.stack_vertices, d), project, d, aligned=True,
+                                           sliced=True))
 
                 except ValueError:
                     # if value error is risen, then append the gamit vertices
                     tqdm.write(' -- Appending %s from GAMIT solutions' % d.yyyyddd())
-                    self.append(Polyhedron(self.gamit_vertices, project, d, aligned=False))
+                    self.append(Polyhedron(get_day(gamit_days, self.gamit_vertices, d), project, d, aligned=False,
+                                           sliced=True))
+
+        # station x epoch index used to extract the time series
+        self.index = StationIndex(self)
+
+    def save_checkpoint(self, filename, iteration):
+        """
+        Save the state of the stack (coordinates and alignment state of each day) after completing an iteration. A
+        stack created with this checkpoint file resumes from this state
+        :param filename: checkpoint file (npz)
+        :param iteration: iteration that was completed
+        :return: nothing
+        """
+        self.iteration = iteration
+
+        meta = {'project': self.project, 'name': self.name, 'redo': self.redo, 'iteration': iteration,
+                'gamit_days': [[d[0], d[1], v[0], v[1]] for d, v in sorted(self.gamit_days.items())],
+                'transformations': self.transformations}
+
+        # write to a temporary file and rename to avoid leaving a partial checkpoint
+        tmp = filename + '.tmp.npz'
+
+        np.savez(tmp, meta=np.array(json.dumps(meta)), vertices=self.index.vertices,
+                 rows=np.array([poly.rows for poly in self], dtype=int),
+                 year=np.array([poly.date.year for poly in self], dtype=int),
+                 doy=np.array([poly.date.doy for poly in self], dtype=int),
+                 aligned=np.array([poly.aligned for poly in self], dtype=bool),
+                 aligned_at_init=np.array([poly.aligned_at_init for poly in self], dtype=bool))
+
+        os.rename(tmp, filename)
+
+    def load_checkpoint(self, filename):
+        """
+        Load the polyhedrons from a checkpoint file. Days with new or changed GAMIT solutions since the checkpoint
+        are loaded from gamit_soln (unaligned) and days that are no longer in gamit_soln are dropped
+        :param filename: checkpoint file (npz)
+        :return: True if the checkpoint was loaded, False if it belongs to another stack
+        """
+        data = np.load(filename)
+        meta = json.loads(str(data['meta']))
+
+        if meta['project'] != self.project or meta['name'] != self.name or meta['redo'] != self.redo:
+            print ' >> Ignoring checkpoint %s: it belongs to a different stack or mode' % filename
+            return False
+
+        print ' >> Resuming stack %s from checkpoint %s (%i iterations completed)' \
+              % (self.name, filename, meta['iteration'] + 1)
+
+        old_days = dict(((d[0], d[1]), (d[2], d[3])) for d in meta['gamit_days'])
+
+        changed = sorted([d for d, v in self.gamit_days.items() if not same_day(old_days.get(d), v)])
+
+        vertices = data['vertices']
+        offsets = np.append(0, np.cumsum(data['rows']))
+
+        polyhedrons = dict()
+        for k in range(data['rows'].size):
+            d = (int(data['year'][k]), int(data['doy'][k]))
+
+            if d not in self.gamit_days:
+                # the GAMIT solutions of this day were removed since the checkpoint
+                tqdm.write(' -- Dropping %i %03i from the checkpoint: no GAMIT solutions' % d)
+
+            elif d not in changed:
+                poly = Polyhedron(vertices[offsets[k]:offsets[k + 1]], self.project, Date(year=d[0], doy=d[1]),
+                                  aligned=bool(data['aligned'][k]), sliced=True)
+                poly.aligned_at_init = bool(data['aligned_at_init'][k])
+
+                polyhedrons[d] = poly
+
+        if changed:
+            print ' >> Loading %i days with new or changed GAMIT solutions' % len(changed)
+
+            gamit_vertices = self.cnn.query_float(
+                'SELECT "NetworkCode" || \'.\' || "StationCode", "X", "Y", "Z", "Year", "DOY", "FYear" '
+                'FROM gamit_soln WHERE "Project" = \'%s\' AND ("Year", "DOY") IN (%s)'
+                % (self.project, ','.join(['(%i, %i)' % d for d in changed])))
+
+            gamit_vertices = np.array(gamit_vertices, dtype=[('stn', 'S8'), ('x', 'float64'), ('y', 'float64'),
+                                                             ('z', 'float64'), ('yr', 'i4'), ('dd', 'i4'),
+                                                             ('fy', 'float64')])
+
+            days = split_vertices(gamit_vertices)
+
+            for d in changed:
+                polyhedrons[d] = Polyhedron(days[d], self.project, Date(year=d[0], doy=d[1]), sliced=True)
+
+        for d in sorted(polyhedrons.keys()):
+            self.append(polyhedrons[d])
+
+        self.dates = [poly.date for poly in self]
+
+        self.stations = [{'NetworkCode': stn.split('.')[0], 'StationCode': stn.split('.')[1]}
+                         for stn in np.unique(vertices['stn'] if not changed else
+                                              np.concatenate((vertices['stn'], gamit_vertices['stn']))).tolist()]
+
+        self.transformations = meta['transformations']
+        self.iteration = meta['iteration']
+
+        return True
 
     def get_station(self, NetworkCode, StationCode):
         """
@@ -248,16 +676,7 @@ class Stack(list):
         :return: a numpy array with the time series [x, y, z, yr, doy, fyear]
         """
 
-        stnstr = NetworkCode + '.' + StationCode
-
-        ts = []
-
-        for poly in self:
-            p = poly.vertices[poly.vertices['stn'] == stnstr]
-            if p.size:
-                ts.append([p['x'][0], p['y'][0], p['z'][0], p['yr'][0], p['dd'][0], p['fy'][0]])
-
-        return np.array(ts)
+        return self.index.get_station(NetworkCode, StationCode)
 
     def calculate_etms(self):
         """
@@ -277,22 +696,31 @@ class Stack(list):
             except pyETM.pyETMException as e:
                 tqdm.write(' -- ' + str(e))
 
+    def load_periodic_terms(self):
+        """
+        Load the periodic terms of all the stations of the stack (and their location) with a single query
+        :return: list of etms records sorted by station
+        """
+        return self.cnn.query_float('SELECT DISTINCT ON (etms."NetworkCode", etms."StationCode") '
+                                    'etms."NetworkCode", etms."StationCode", stations.lat, stations.lon, '
+                                    'stations.auto_x, stations.auto_y, stations.auto_z, '
+                                    'frequencies as freq, params FROM etms '
+                                    'JOIN stations ON '
+                                    'etms."NetworkCode" = stations."NetworkCode" AND '
+                                    'etms."StationCode" = stations."StationCode" '
+                                    'WHERE "object" = \'periodic\' AND soln = \'gamit\' AND stack = \'%s\' '
+                                    'AND frequencies <> \'{}\' '
+                                    'ORDER BY etms."NetworkCode", etms."StationCode"' % self.name, as_dict=True)
+
     def remove_common_modes(self, target_periods=None):
 
+        # load all the periodic terms
+        periodic = self.load_periodic_terms()
+
         if target_periods is None:
             tqdm.write(' >> Removing periodic common modes...')
 
-            # load all the periodic terms
-            etm_objects = self.cnn.query_float('SELECT etms."NetworkCode", etms."StationCode", stations.lat, '
-                                               'stations.lon, '
-                                               'frequencies as freq, params FROM etms '
-                                               'LEFT JOIN stations ON '
-                                               'etms."NetworkCode" = stations."NetworkCode" AND '
-                                               'etms."StationCode" = stations."StationCode" '
-                                               'WHERE "object" = \'periodic\' AND soln = \'gamit\' AND stack = \'%s\' '
-                                               'AND frequencies <> \'{}\' '
-                                               'ORDER BY etms."NetworkCode", etms."StationCode"'
-                                               % self.name, as_dict=True)
+            etm_objects = periodic
         else:
             use_stations = []
             for s in target_periods.keys():
@@ -303,114 +731,30 @@ class Stack(list):
 
             tqdm.write(' >> Inheriting periodic components...')
 
-            # load the periodic terms of the stations that will produce the inheritance
-            etm_objects = self.cnn.query_float('SELECT etms."NetworkCode", etms."StationCode", stations.lat, '
-                                               'stations.lon, '
-                                               'frequencies as freq, params FROM etms '
-                                               'LEFT JOIN stations ON '
-                                               'etms."NetworkCode" = stations."NetworkCode" AND '
-                                               'etms."StationCode" = stations."StationCode" '
-                                               'WHERE "object" = \'periodic\' AND soln = \'gamit\' AND stack = \'%s\' '
-                                               'AND frequencies <> \'{}\' AND etms."NetworkCode" || \'.\' || '
-                                               'etms."StationCode" IN (\'%s\') '
-                                               'ORDER BY etms."NetworkCode", etms."StationCode"'
-                                               % (self.name, '\', \''.join(use_stations)), as_dict=True)
-
-        # load the frequencies to subtract
-        frequencies = self.cnn.query_float('SELECT frequencies FROM etms WHERE soln = \'gamit\' AND '
-                                           'object = \'periodic\' AND frequencies <> \'{}\' AND stack = \'%s\' '
-                                           'GROUP BY frequencies' % self.name, as_dict=True)
-
-        # get the unique list of frequencies
-        f_vector = []
-
-        for freq in frequencies:
-            f_vector += [f for f in freq['frequencies']]
-
-        f_vector = np.array(list(set(f_vector)))
-
-        # initialize the vectors
-        ox = np.zeros((len(f_vector), len(etm_objects), 2))
-        oy = np.zeros((len(f_vector), len(etm_objects), 2))
-        oz = np.zeros((len(f_vector), len(etm_objects), 2))
-
-        # vector for residuals after alignment
-        rx = np.zeros((len(f_vector), len(etm_objects), 2))
-        ry = np.zeros((len(f_vector), len(etm_objects), 2))
-        rz = np.zeros((len(f_vector), len(etm_objects), 2))
-
-        tqdm.write(' -- Reporting periodic residuals (in mm) before %s'
-                   % ('inheritance' if target_periods else 'common mode removal'))
-
-        for s, p in enumerate(etm_objects):
+            # the periodic terms of the stations that will produce the inheritance
+            use_stations = set(use_stations)
+            etm_objects = [p for p in periodic if p['NetworkCode'] + '.' + p['StationCode'] in use_stations]
 
-            # DDG: should only activate this portion of the code if for any reason ETMs stored in database made with
-            # a stack different to what is being used here
-            # stn_ts = self.get_station(p['NetworkCode'], p['StationCode'])
+        # get the unique list of frequencies to subtract
+        f_vector = np.unique([f for p in periodic for f in p['freq']])
 
-            # self.cnn.query('DELETE FROM etms WHERE "soln" = \'gamit\' AND "NetworkCode" = \'%s\' AND '
-            #                '"StationCode" = \'%s\'' % (p['NetworkCode'], p['StationCode']))
-            # save the time series
-            # ts = pyETM.GamitSoln(self.cnn, stn_ts, p['NetworkCode'], p['StationCode'], self.project)
-            # create the ETM object
-            # pyETM.GamitETM(self.cnn, p['NetworkCode'], p['StationCode'], False, False, ts)
-            # REDUNDANT CALL, but leave anyways
-            q = self.cnn.query_float('SELECT frequencies as freq, * FROM etms '
-                                     'WHERE "object" = \'periodic\' AND soln = \'gamit\' '
-                                     'AND "NetworkCode" = \'%s\' AND '
-                                     '"StationCode" = \'%s\' AND stack = \'%s\''
-                                     % (p['NetworkCode'], p['StationCode'], self.name), as_dict=True)[0]
-
-            if target_periods:
-                n = []
-                e = []
-                u = []
-                # inheritance invoked! we want to remove the difference between current periodic terms and target
-                # terms from the parent frame
-                for k in range(2):
-                    for f in q['freq']:
-                        t = target_periods['%s.%s' % (p['NetworkCode'], p['StationCode'])]['%.3f' % (1 / f)]
-                        n += [t['n'][k]]
-                        e += [t['e'][k]]
-                        u += [t['u'][k]]
-
-                params = np.array(q['params']) - np.array([n, e, u]).flatten()
-            else:
-                # no inheritance: make a vector of current periodic terms to be removed as common modes
-                params = np.array(q['params'])
+        stations = [p['NetworkCode'] + '.' + p['StationCode'] for p in etm_objects]
 
-            params = params.reshape((3, params.shape[0] / 3))
-            param_count = params.shape[1] / 2
-
-            print_residuals(p['NetworkCode'], p['StationCode'], params, p['lat'], p['lon'])
-
-            # convert from NEU to XYZ
-            for j in range(params.shape[1]):
-                params[:, j] = np.array(lg2ct(params[0, j], params[1, j], params[2, j],
-                                              p['lat'], p['lon'])).flatten()
+        tqdm.write(' -- Reporting periodic residuals (in mm) before %s'
+                   % ('inheritance' if target_periods else 'common mode removal'))
 
-            for i, f in enumerate(p['freq']):
-                ox[f_vector == f, s] = params[0, i:i + param_count + 1:param_count]
-                oy[f_vector == f, s] = params[1, i:i + param_count + 1:param_count]
-                oz[f_vector == f, s] = params[2, i:i + param_count + 1:param_count]
+        ox, oy, oz = periodic_space(dict(zip(stations, etm_objects)), stations, f_vector, target_periods)
 
         # build the design matrix using the stations involved in inheritance or all stations if no inheritance
-        sql_where = ','.join(["'" + stn['NetworkCode'] + '.' + stn['StationCode'] + "'" for stn in etm_objects])
-
-        x = self.cnn.query_float('SELECT 0, -auto_z*1e-9, auto_y*1e-9, 1, 0, 0, auto_x*1e-9 FROM stations WHERE '
-                                 '"NetworkCode" || \'.\' || "StationCode" '
-                                 'IN (%s) ORDER BY "NetworkCode", "StationCode"' % sql_where)
+        auto_x = np.array([p['auto_x'] for p in etm_objects])
+        auto_y = np.array([p['auto_y'] for p in etm_objects])
+        auto_z = np.array([p['auto_z'] for p in etm_objects])
+        zeros = np.zeros(len(etm_objects))
+        ones = np.ones(len(etm_objects))
 
-        y = self.cnn.query_float('SELECT auto_z*1e-9, 0, -auto_x*1e-9, 0, 1, 0, auto_y*1e-9 FROM stations WHERE '
-                                 '"NetworkCode" || \'.\' || "StationCode" '
-                                 'IN (%s) ORDER BY "NetworkCode", "StationCode"' % sql_where)
-
-        z = self.cnn.query_float('SELECT -auto_y*1e-9, auto_x*1e-9, 0, 0, 0, 1, auto_z*1e-9 FROM stations WHERE '
-                                 '"NetworkCode" || \'.\' || "StationCode" '
-                                 'IN (%s) ORDER BY "NetworkCode", "StationCode"' % sql_where)
-        Ax = np.array(x)
-        Ay = np.array(y)
-        Az = np.array(z)
+        Ax = np.column_stack((zeros, -auto_z * 1e-9, auto_y * 1e-9, ones, zeros, zeros, auto_x * 1e-9))
+        Ay = np.column_stack((auto_z * 1e-9, zeros, -auto_x * 1e-9, zeros, ones, zeros, auto_y * 1e-9))
+        Az = np.column_stack((-auto_y * 1e-9, auto_x * 1e-9, zeros, zeros, zeros, ones, auto_z * 1e-9))
 
         A = np.row_stack((Ax, Ay, Az))
 
@@ -418,10 +762,15 @@ class Stack(list):
 
         # vector to display down-weighted stations
         st = dict()
-        st['stn'] = [s['NetworkCode'] + '.' + s['StationCode'] for s in etm_objects]
+        st['stn'] = stations
         xyzstn = ['X-%s' % ss for ss in st['stn']] + ['Y-%s' % ss for ss in st['stn']] + \
                  ['Z-%s' % ss for ss in st['stn']]
 
+        # the transformations are applied to all the vertices of the stack at once (the polyhedrons hold views of
+        # self.index.vertices). Epoch of each vertex: date of its polyhedron
+        vertices = self.index.vertices
+        fyear = np.repeat([poly.date.fyear for poly in self], [poly.rows for poly in self])
+
         # loop through the frequencies
         for freq in f_vector:
             for i, cs in enumerate((np.sin, np.cos)):
@@ -441,77 +790,41 @@ class Stack(list):
                 # save the transformation parameters to output to json file
                 solution_vector.append(['%s(2 * pi * 1/%.2f)' % (cs.__name__, np.divide(1., freq)), c.tolist()])
 
-                # loop through all the polyhedrons
-                for poly in tqdm(self, ncols=160, desc=' -- Applying transformation -> %s(2 * pi * 1/%.2f)' %
-                                                       (cs.__name__, np.divide(1., freq)), disable=None):
+                # subtract the inverted common modes from all the polyhedrons
+                x = vertices['x'] * 1e-9
+                y = vertices['y'] * 1e-9
+                z = vertices['z'] * 1e-9
+                w = cs(2 * pi * freq * 365.25 * fyear)
 
-                    # subtract the inverted common modes
-                    poly.vertices['x'] = poly.vertices['x'] - cs(2 * pi * freq * 365.25 * poly.date.fyear) * \
-                                         np.dot(poly.ax(scale=True), c)
-                    poly.vertices['y'] = poly.vertices['y'] - cs(2 * pi * freq * 365.25 * poly.date.fyear) * \
-                                         np.dot(poly.ay(scale=True), c)
-                    poly.vertices['z'] = poly.vertices['z'] - cs(2 * pi * freq * 365.25 * poly.date.fyear) * \
-                                         np.dot(poly.az(scale=True), c)
+                vertices['x'] -= w * (-z * c[1] + y * c[2] + c[3] + x * c[6])
+                vertices['y'] -= w * (z * c[0] - x * c[2] + c[4] + y * c[6])
+                vertices['z'] -= w * (-y * c[0] + x * c[1] + c[5] + z * c[6])
 
         tqdm.write(' -- Reporting periodic residuals (in mm) after %s\n'
                    '       365.25  182.62  365.25  182.62  \n'
                    '       sin     sin     cos     cos       '
                    % ('inheritance' if target_periods else 'common mode removal'))
 
-        for s, p in enumerate(etm_objects):
+        # DDG: etms need to be redone because we changed the stack!
+        if stations:
+            self.cnn.query('DELETE FROM etms WHERE "soln" = \'gamit\' AND stack = \'%s\' AND '
+                           '"NetworkCode" || \'.\' || "StationCode" IN (\'%s\')'
+                           % (self.name, '\', \''.join(stations)))
+
+        for p in tqdm(etm_objects, ncols=160, desc=' -- Updating the ETMs', disable=None):
             # redo the etm for this station
-            # DDG: etms need to be redone because we changed the stack!
             stn_ts = self.get_station(p['NetworkCode'], p['StationCode'])
 
-            self.cnn.query('DELETE FROM etms WHERE "soln" = \'gamit\' AND "NetworkCode" = \'%s\' AND '
-                           '"StationCode" = \'%s\' AND stack = \'%s\''
-                           % (p['NetworkCode'], p['StationCode'], self.name))
             # save the time series
             ts = pyETM.GamitSoln(self.cnn, stn_ts, p['NetworkCode'], p['StationCode'], self.name)
             # create the ETM object
             pyETM.GamitETM(self.cnn, p['NetworkCode'], p['StationCode'], False, False, ts)
 
-            # obtain the updated parameters
-            # they should exist for sure!
-            q = self.cnn.query_float('SELECT frequencies as freq, * FROM etms '
-                                     'WHERE "object" = \'periodic\' AND soln = \'gamit\' '
-                                     'AND "NetworkCode" = \'%s\' AND '
-                                     '"StationCode" = \'%s\' AND stack = \'%s\''
-                                     % (p['NetworkCode'], p['StationCode'], self.name), as_dict=True)[0]
-
-            if target_periods:
-                n = []
-                e = []
-                u = []
-                # inheritance invoked! we want to remove the difference between current periodic terms and target
-                # terms from the parent frame
-                for k in range(2):
-                    for f in q['freq']:
-                        t = target_periods['%s.%s' % (p['NetworkCode'], p['StationCode'])]['%.3f' % (1 / f)]
-                        n += [t['n'][k]]
-                        e += [t['e'][k]]
-                        u += [t['u'][k]]
-
-                residuals = (np.array(q['params']) - np.array([n, e, u]).flatten())
-            else:
-                # residuals are the minimized frequencies
-                residuals = np.array(q['params'])
-
-            # reshape the array to NEU
-            residuals = residuals.reshape((3, residuals.shape[0] / 3))
-            param_count = residuals.shape[1] / 2
-
-            print_residuals(p['NetworkCode'], p['StationCode'], residuals, p['lat'], p['lon'])
+        # obtain the updated parameters (they should exist for sure!): residuals are the minimized frequencies
+        periodic = self.load_periodic_terms()
 
-            # convert from NEU to XYZ
-            for j in range(residuals.shape[1]):
-                residuals[:, j] = np.array(lg2ct(residuals[0, j], residuals[1, j], residuals[2, j],
-                                           p['lat'], p['lon'])).flatten()
-
-            for i, f in enumerate(p['freq']):
-                rx[f_vector == f, s] = residuals[0, i:i + param_count + 1:param_count]
-                ry[f_vector == f, s] = residuals[1, i:i + param_count + 1:param_count]
-                rz[f_vector == f, s] = residuals[2, i:i + param_count + 1:param_count]
+        rx, ry, rz = periodic_space(dict((p['NetworkCode'] + '.' + p['StationCode'], p) for p in periodic),
+                                    stations, f_vector, target_periods)
 
         # save the position space residuals
         self.periodic_space = {'stations': {'codes': [p['NetworkCode'] + '.' + p['StationCode'] for p in etm_objects],
@@ -773,21 +1086,25 @@ class Stack(list):
         save the polyhedrons to the database
         :return: nothing
         """
+        columns = ['Project', 'NetworkCode', 'StationCode', 'X', 'Y', 'Z', 'FYear', 'Year', 'DOY',
+                   'sigmax', 'sigmay', 'sigmaz', 'name']
+        # a vertex that already exists in the stack is replaced
+        keys = ['name', 'NetworkCode', 'StationCode', 'Year', 'DOY']
+
+        rows = []
         for poly in tqdm(self, ncols=160, desc='Saving ' + self.name, disable=None):
             if not poly.aligned_at_init:
                 # this polyhedron was missing when we initialized the objects
                 # thus, this is a new stack or this polyhedron has been added: save it!
-                try:
-                    self.cnn.executemany('INSERT INTO stacks ("Project", "NetworkCode", "StationCode", "X", "Y", "Z", '
-                                         '"FYear", "Year", "DOY", sigmax, sigmay, sigmaz, name) VALUES '
-                                         '(%s, %s, %s, %f, %f, %f, %f, %i, %i, 0.000, 0.000, 0.000, %s)',
-                                         [(self.project, vert['stn'].split('.')[0], vert['stn'].split('.')[1],
-                                           float(vert['x']), float(vert['y']), float(vert['z']), float(vert['fy']),
-                                           int(vert['yr']), int(vert['dd']), self.name)
-                                          for vert in poly.vertices])
-                except (dbConnection.dbErrInsert, dbConnection.IntegrityError):
-                    # the element already exists in the database (polyhedron already aligned)
-                    pass
+                rows += [(self.project, stn.split('.')[0], stn.split('.')[1], x, y, z, fy, yr, dd, 0., 0., 0.,
+                          self.name) for stn, x, y, z, yr, dd, fy in poly.vertices.tolist()]
+
+                if len(rows) >= dbConnection.BULK_BATCH_SIZE:
+                    self.cnn.bulk_insert('stacks', rows, columns, keys)
+                    rows = []
+
+        if rows:
+            self.cnn.bulk_insert('stacks', rows, columns, keys)
 
     def to_json(self, json_file):
         json_dump = dict()
@@ -801,7 +1118,15 @@ class Stack(list):
 
 
 class Polyhedron(object):
-    def __init__(self, vertices, project, date, rot=True, aligned=False):
+    def __init__(self, vertices, project, date, rot=True, aligned=False, sliced=False):
+        """
+        :param vertices: structured array with the vertices (stn, x, y, z, yr, dd, fy)
+        :param project: name of the project
+        :param date: date of the polyhedron
+        :param rot: estimate rotations during the alignment
+        :param aligned: polyhedron already aligned (i.e. loaded from the stacks table)
+        :param sliced: vertices is already the view of date sorted by station (see split_vertices) and is used as is
+        """
 
         self.project = project
         self.date = date
@@ -816,10 +1141,13 @@ class Polyhedron(object):
         # initialize the vertices of the polyhedron
         # self.vertices = [v for v in vertices if v[5] == date.year and v[6] == date.doy]
 
-        self.vertices = vertices[np.logical_and(vertices['yr'] == date.year, vertices['dd'] == date.doy)]
-        # sort using network code station code to make sure that intersect (in align) will get the data in the correct
-        # order, otherwise the differences in X Y Z don't make sense...
-        self.vertices.sort(order='stn')
+        if sliced:
+            self.vertices = vertices
+        else:
+            self.vertices = vertices[np.logical_and(vertices['yr'] == date.year, vertices['dd'] == date.doy)]
+            # sort using network code station code to make sure that intersect (in align) will get the data in the
+            # correct order, otherwise the differences in X Y Z don't make sense...
+            self.vertices.sort(order='stn')
 
         if not self.vertices.size:
             raise ValueError('No polyhedron data found for ' + str(date))
@@ -972,35 +1300,46 @@ class Polyhedron(object):
 
 
 class Combination(Polyhedron):
-    def __init__(self, polyhedrons):
-
+    def __init__(self, polyhedrons, weights=None):
+        """
+        Combine (average) the coordinates of a list of polyhedrons
+        :param polyhedrons: list of polyhedrons
+        :param weights: optional list with the (positive) weight of each polyhedron (scalar or one value per
+                        vertex). If not provided, the simple mean of each station is computed
+        """
         # get the mean epoch
         date = [poly.date.mjd for poly in polyhedrons]
         date = Date(mjd=np.mean(date))
 
-        # get the set of stations
-        stn = []
-        for poly in polyhedrons:
-            stn += poly.vertices['stn'].tolist()
+        vertices = np.concatenate([poly.vertices for poly in polyhedrons])
 
-        stn = np.unique(stn)
+        if weights is None:
+            w = np.ones(vertices.shape[0])
+        else:
+            w = np.concatenate([np.broadcast_to(np.asarray(wp, dtype=float), (poly.rows,))
+                                for poly, wp in zip(polyhedrons, weights)])
 
-        # average the coordinates for each station
-        poly = []
-        for s in stn:
-            v = np.array([])
-            for p in polyhedrons:
-                if not v.size:
-                    v = p.vertices[p.vertices['stn'] == s]
-                else:
-                    v = np.concatenate((v, p.vertices[p.vertices['stn'] == s]))
+        # get the set of stations and the station of each vertex
+        stn, inverse = np.unique(vertices['stn'], return_inverse=True)
 
-            poly.append((s, np.mean(v['x']), np.mean(v['y']), np.mean(v['z']), date.year, date.doy, date.fyear))
+        # number of observations of each station
+        self.counts = np.bincount(inverse, minlength=stn.size)
 
-        pp = np.array(poly, dtype=[('stn', 'S8'), ('x', 'float64'), ('y', 'float64'), ('z', 'float64'),
-                                   ('yr', 'i4'), ('dd', 'i4'), ('fy', 'float64')])
+        sw = np.bincount(inverse, weights=w, minlength=stn.size)
 
-        super(Combination, self).__init__(pp, polyhedrons[0].project, date)
+        # average the coordinates for each station
+        pp = np.zeros(stn.size, dtype=[('stn', 'S8'), ('x', 'float64'), ('y', 'float64'), ('z', 'float64'),
+                                       ('yr', 'i4'), ('dd', 'i4'), ('fy', 'float64')])
+        pp['stn'] = stn
+        pp['x'] = np.bincount(inverse, weights=w * vertices['x'], minlength=stn.size) / sw
+        pp['y'] = np.bincount(inverse, weights=w * vertices['y'], minlength=stn.size) / sw
+        pp['z'] = np.bincount(inverse, weights=w * vertices['z'], minlength=stn.size) / sw
+        pp['yr'] = date.year
+        pp['dd'] = date.doy
+        pp['fy'] = date.fyear
+
+        # vertices are already sorted by station
+        super(Combination, self).__init__(pp, polyhedrons[0].project, date, sliced=True)
 
 
 def main():